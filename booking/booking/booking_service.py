@@ -1,49 +1,63 @@
 import uuid
 import redis
-from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 from flask import current_app
 from datetime import datetime
-from config import redis_client, db, ParkingSpot, Booking, socketio
-from booking.redis.redis_utils import redis_renew_lease, redis_delete_lease, redis_acquire_lease
+from config import redis_client, db, Booking
+from booking.catalog.catalog_cache import catalog_cache
+from booking.redis.circuit_breaker import redis_circuit
+from booking.redis.redis_utils import redis_validate_lease, redis_consume_lease, redis_reserve_lease
+from booking.emit_utils.outbox import record_spot_event
+from booking.redis.occupancy import slot_mask
 from booking.booking.idempotency import check_idempotency, store_idempotency_result
 from zoneinfo import ZoneInfo
-from booking.utils import calculate_price
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+from booking.utils import calculate_price, is_exclusion_violation
+from booking.booking.deadline import call_with_deadline
 
+# Seconds a validated lease is kept alive for, so it cannot expire while its booking is being inserted
+CONFIRM_LEASE_EXTENSION = 60
 
-@retry(
-    stop=stop_after_attempt(2),
-    wait=wait_exponential(multiplier=1, min=1, max=4),
-    retry=retry_if_exception_type(redis.RedisError),
-    reraise=True
-)
-def acquire_lease_safe(spot_id, user_id, parking_lot_id, booking_date, start_time, end_time, ttl=240,
-                       reservation_id=None):
-    """Try to acquire a lease with retries."""
+LEASE_VALIDATION_ERRORS = {
+    'expired': "Lease expired or not found",
+    'missing': "Lease metadata not found",
+    'mismatch': "Lease metadata validation failed"
+}
 
-    redis_available = socketio.server.manager.redis_available
 
-    if not redis_available:
+def acquire_lease_safe(spot_id, user_id, parking_lot_id, booking_date, start_time, end_time, sid, deadline, ttl=240):
+    """Try to acquire a lease, retrying transient Redis errors within the request's deadline."""
+
+    if not redis_circuit.available:
         raise redis.RedisError("Redis circuit open - using fallback mode")
 
     try:
-        success = acquire_lease(
+        result = call_with_deadline(
+            deadline,
+            'lease',
+            acquire_lease,
             spot_id=spot_id,
             user_id=user_id,
             parking_lot_id=parking_lot_id,
             booking_date=booking_date,
             start_time=start_time,
             end_time=end_time,
-            ttl=ttl,
-            reservation_id=reservation_id
+            sid=sid,
+            ttl=ttl
         )
-        return success
     except redis.RedisError as e:
         current_app.logger.warning(f"Redis error: {e}")
+        redis_circuit.record_failure(e)
         raise e
 
+    redis_circuit.record_success()
+    return result
+
+
+def acquire_lease(spot_id, user_id, parking_lot_id, booking_date, start_time, end_time, sid, ttl=240):
+    """Reserve the window for the socket in one round trip.
 
-def acquire_lease(spot_id, user_id, parking_lot_id, booking_date, start_time, end_time, ttl=240, reservation_id=None):
+    Returns (reservation_id, released): reservation_id is None if another lease overlaps the window, and
+    released is the (spot_id, booking_date, start, end) window the socket's previous lease gave up, if any."""
 
     def ensure_24h_format(time_str):
         try:
@@ -59,55 +73,39 @@ def acquire_lease(spot_id, user_id, parking_lot_id, booking_date, start_time, en
     start_time_24h = ensure_24h_format(start_time)
     end_time_24h = ensure_24h_format(end_time)
 
-    lease_key = f"spot_lease:{spot_id}_{booking_date}"
-
-    # Idempotency check first
-    if reservation_id is not None:
-        existing_lease = redis_client.get(lease_key)
-        if existing_lease and existing_lease == reservation_id:
-            print(f"Idempotent success - reservation {reservation_id} already exists")
-            return reservation_id
-
-    # Generate new ID if needed
-    if reservation_id is None:
-        reservation_id = str(uuid.uuid4())
-
-    print(f"Attempting to acquire lease for spot {spot_id}")
-    print(f"Key: {lease_key}")
-    print(f"Reservation ID: {reservation_id}")
-    print(f"User: {user_id}, Lot: {parking_lot_id}")
-    print(f"Date: {booking_date}, Time: {start_time}-{end_time}")
-
-    lease_data = {
-        'user_id': str(user_id),
-        'spot_id': str(spot_id),
-        'parking_lot_id': str(parking_lot_id),
-        'booking_date': booking_date,
-        'start_time': start_time_24h,
-        'end_time': end_time_24h,
-        'created_at': datetime.now(ZoneInfo("Europe/Nicosia")).isoformat()
-    }
-
-    # Store metadata with TTL
-    try:
-        redis_client.hset(f"lease_data:{reservation_id}", mapping=lease_data)
-        redis_client.expire(f"lease_data:{reservation_id}", ttl + 60)
-    except Exception as e:
-        print(f"Failed to store lease metadata: {str(e)}")
-        return None
+    current_app.logger.info(
+        f"Attempting to acquire lease for spot {spot_id} - user: {user_id}, lot: {parking_lot_id}, "
+        f"date: {booking_date}, time: {start_time}-{end_time}")
+
+    # Idempotency, lease metadata, the window itself and conn:{sid} are all handled by the reserve script
+    result = redis_reserve_lease(
+        redis_client,
+        sid,
+        str(uuid.uuid4()),
+        parking_lot_id,
+        spot_id,
+        booking_date,
+        start_time_24h,
+        end_time_24h,
+        str(user_id),
+        datetime.now(ZoneInfo("Europe/Nicosia")).isoformat(),
+        ttl
+    )
+    current_app.logger.debug(f"Redis reserve result: {result}")
 
-    # Now acquire the lease
-    result = redis_acquire_lease(redis_client, lease_key, reservation_id, ttl)
-    print(f"Redis acquire result: {result}")
+    if result is None:
+        return None, None
 
-    if not result:
-        print(f"FAILED - Could not acquire lease for spot {spot_id}")
-        # Clean up metadata if lease acquisition failed
-        redis_client.delete(f"lease_data:{reservation_id}")
-        return None
+    status, reservation_id, released = result
+    if status == 'taken':
+        current_app.logger.info(f"FAILED - Another lease overlaps {start_time_24h}-{end_time_24h} on spot {spot_id}")
+        return None, None
 
-    print(f"SUCCESS - Lease acquired for spot {spot_id}")
-    return reservation_id
+    if status == 'existing':
+        current_app.logger.info(f"Idempotent success - reservation {reservation_id} already holds this window")
+    else:
+        current_app.logger.info(f"SUCCESS - Lease acquired for spot {spot_id}")
+    return reservation_id, released
 
 
 def confirm_booking(reservation_id, spot_id, user_id, booking_data, idempotency_key=None):
@@ -125,119 +123,63 @@ def confirm_booking(reservation_id, spot_id, user_id, booking_data, idempotency_
             current_app.logger.error(f"Idempotency check failed: {str(e)}")
             idempotency_key = None
 
-    lease_key = f"spot_lease:{spot_id}_{booking_data['booking_date']}"
-
-    current_app.logger.info(f"Validating existing lease: {lease_key}")
-    current_lease = redis_client.get(lease_key)
-
-    if current_lease is None:
-        current_app.logger.error(f"Lease not found or expired: {lease_key}")
-        result = {"status": "error", "message": "Lease expired or not found"}
-        if idempotency_key:
-            store_idempotency_result(idempotency_key, result)
-        return result, 409
-
-    if isinstance(current_lease, bytes):
-        current_lease = current_lease.decode('utf-8')
-
-    current_app.logger.info(f"Lease validation - current: {current_lease}, expected: {reservation_id}")
-
-    if current_lease != reservation_id:
-        current_app.logger.error(f"ease validation failed - mismatch")
-        result = {"status": "error", "message": "Lease validation failed - spot taken by another user"}
-        if idempotency_key:
-            store_idempotency_result(idempotency_key, result)
-        return result, 409
-
-    current_app.logger.info(f"Lease validation successful for reservation: {reservation_id}")
-
     try:
-        with db.session.begin_nested():
-            current_app.logger.info(f"Acquiring database lock for spot: {spot_id}")
-            spot = db.session.execute(
-                select(ParkingSpot)
-                .where(ParkingSpot.id == spot_id)
-                .with_for_update()
-            ).scalar_one()
-            current_app.logger.info(f"Database lock acquired for spot: {spot_id}")
-
-            current_lease_after_lock = redis_client.get(lease_key)
-            if current_lease_after_lock and isinstance(current_lease_after_lock, bytes):
-                current_lease_after_lock = current_lease_after_lock.decode('utf-8')
-
-            current_app.logger.info(
-                f"Lease consistency check after lock - key: {lease_key}, current: {current_lease_after_lock}, expected: {reservation_id}")
-
-            if not current_lease_after_lock or current_lease_after_lock != reservation_id:
-                current_app.logger.warning(f"Lease lost after acquiring lock, attempting to renew...")
-                success = redis_renew_lease(redis_client, lease_key, reservation_id, 240)
-                if not success:
-                    current_app.logger.error(f"Lease lost and could not be renewed")
-                    result = {"status": "error", "message": "Lease lost and could not be renewed"}
-                    if idempotency_key:
-                        store_idempotency_result(idempotency_key, result)
-                    return result, 409
-                else:
-                    current_app.logger.info("Lease successfully renewed")
-
-            current_app.logger.info(f"Validating lease metadata: {reservation_id}")
-            lease_data = redis_client.hgetall(f"lease_data:{reservation_id}")
-            if not lease_data:
-                current_app.logger.error(f"Lease metadata not found: {reservation_id}")
-                result = {"status": "error", "message": "Lease metadata not found"}
-                if idempotency_key:
-                    store_idempotency_result(idempotency_key, result)
-                return result, 409
-
-            lease_user_id = lease_data.get(b'user_id', b'').decode() if b'user_id' in lease_data else lease_data.get(
-                'user_id', '')
-            lease_spot_id = lease_data.get(b'spot_id', b'').decode() if b'spot_id' in lease_data else lease_data.get(
-                'spot_id', '')
-
-            current_app.logger.info(
-                f"Lease metadata validation - user: {lease_user_id} vs {user_id}, spot: {lease_spot_id} vs {spot_id}")
-
-            # Validate lease ownership
-            if (lease_user_id != str(user_id) or lease_spot_id != str(spot_id)):
-                current_app.logger.error(f"Lease metadata validation failed - mismatch")
-                result = {"status": "error", "message": "Lease metadata validation failed"}
-                if idempotency_key:
-                    store_idempotency_result(idempotency_key, result)
-                return result, 409
-
-            start_time = datetime.strptime(booking_data['start_time'], '%H:%M').time()
-            end_time = datetime.strptime(booking_data['end_time'], '%H:%M').time()
-
-            current_app.logger.info(f"Checking spot availability for {spot_id} at {start_time}-{end_time}")
-
-            # Check database conflicts while holding the lock
-            conflict_count = Booking.query.filter(
-                Booking.spot_id == spot.id,
-                Booking.parking_lot_id == booking_data['parking_lot_id'],
-                Booking.bookingDate == booking_data['booking_date'],
-                Booking.startTime < end_time,
-                Booking.endTime > start_time
-            ).count()
-
-            current_app.logger.info(f"Atomic availability check - conflicts: {conflict_count}")
-
-            if conflict_count > 0:
-                current_app.logger.error(f"Spot no longer available: {spot_id} (conflicts: {conflict_count})")
-                result = {"status": "error", "message": "Spot no longer available"}
-                if idempotency_key:
-                    store_idempotency_result(idempotency_key, result)
-                return result, 409
-
-            # Create booking
+        # Ownership, user, spot and window in one EVALSHA, which also keeps the lease alive through the insert
+        current_app.logger.info(f"Validating lease: {reservation_id}")
+        lease_status = redis_validate_lease(
+            redis_client,
+            reservation_id,
+            booking_data['parking_lot_id'],
+            str(spot_id),
+            booking_data['booking_date'],
+            str(user_id),
+            datetime.strptime(booking_data['start_time'], '%H:%M').strftime('%H:%M'),
+            datetime.strptime(booking_data['end_time'], '%H:%M').strftime('%H:%M'),
+            CONFIRM_LEASE_EXTENSION
+        )
+        current_app.logger.info(f"Lease validation result for {reservation_id}: {lease_status}")
+
+        if lease_status is None:
+            raise redis.RedisError("Lease validation unavailable")
+
+        if lease_status != 'ok':
+            result = {"status": "error", "message": LEASE_VALIDATION_ERRORS[lease_status]}
+            if idempotency_key:
+                store_idempotency_result(idempotency_key, result)
+            return result, 409
+
+        spot = catalog_cache.get_spot(spot_id)
+        if not spot:
+            current_app.logger.error(f"Spot not found: {spot_id}")
+            result = {"status": "error", "message": "Spot not found"}
+            if idempotency_key:
+                store_idempotency_result(idempotency_key, result)
+            return result, 409
+
+        # No spot row lock or conflict count: excl_bookings_spot_time rejects overlapping inserts,
+        # so bookings of different windows on the same spot no longer serialise on each other
+        try:
             current_app.logger.info("Creating booking record")
-            booking = create_booking_from_data(spot, user_id, booking_data)
-            db.session.add(booking)
+            with db.session.begin_nested():
+                booking = create_booking_from_data(spot, user_id, booking_data)
+                db.session.add(booking)
+                record_spot_event(spot.id, booking.parking_lot_id, booking.bookingDate,
+                                  booking.startTime, booking.endTime, False)
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            if not is_exclusion_violation(e):
+                raise
+            current_app.logger.error(f"Spot no longer available: {spot_id} (exclusion violation)")
+            result = {"status": "error", "message": "Spot no longer available"}
+            if idempotency_key:
+                store_idempotency_result(idempotency_key, result)
+            return result, 409
 
         # Clean up Redis lease after successful booking
         current_app.logger.info(f"Cleaning up lease after successful booking: {reservation_id}")
-        lease_key = f"spot_lease:{spot_id}_{booking_data['booking_date']}"
-        redis_delete_lease(redis_client, lease_key, reservation_id)
-        redis_client.delete(f"lease_data:{reservation_id}")
+        redis_consume_lease(redis_client, reservation_id, booking.parking_lot_id, spot.id, booking_data['booking_date'],
+                            slot_mask(booking.startTime, booking.endTime))
 
         result = {"status": "success", "booking_id": booking.id}
         current_app.logger.info(f"🎉 Booking confirmed successfully! ID: {booking.id}")
@@ -250,9 +192,8 @@ def confirm_booking(reservation_id, spot_id, user_id, booking_data, idempotency_
     except Exception as e:
         db.session.rollback()
         current_app.logger.error(f"Booking confirmation failed: {str(e)}", exc_info=True)
+        # Not cached under the idempotency key, so a retry of the same payment can still succeed
         result = {"status": "error", "message": "Internal server error"}
-        if idempotency_key:
-            store_idempotency_result(idempotency_key, result)
         return result, 500
 
 
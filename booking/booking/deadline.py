@@ -0,0 +1,99 @@
+import time
+import random
+import logging
+import threading
+import redis
+from sqlalchemy import text
+from config import app, socketio
+
+logger = logging.getLogger(__name__)
+
+# Jittered backoff between attempts: full jitter over 20, 40, 80 ms
+RETRY_BASE_DELAY = 0.02
+RETRY_MAX_DELAY = 0.08
+RETRY_MAX_ATTEMPTS = 3
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, stage):
+        super().__init__(f"Booking deadline exceeded at {stage}")
+        self.stage = stage
+
+
+class Deadline:
+    """Latency budget of one booking request, shared by every stage it goes through"""
+
+    def __init__(self, budget_ms):
+        self.budget = budget_ms / 1000
+        self.expires_at = time.monotonic() + self.budget
+
+    def remaining(self):
+        return max(self.expires_at - time.monotonic(), 0)
+
+    def expired(self):
+        return self.remaining() == 0
+
+    def check(self, stage):
+        """Raise DeadlineExceeded (and count it) if the budget is spent before stage starts"""
+        if self.expired():
+            deadline_metrics.record_exhausted(stage)
+            raise DeadlineExceeded(stage)
+
+    def apply_statement_timeout(self, session, stage):
+        """Cap the statements of the session's current transaction at the remaining budget"""
+        self.check(stage)
+        session.execute(text("SELECT set_config('statement_timeout', :timeout, true)"),
+                        {'timeout': str(max(int(self.remaining() * 1000), 1))})
+
+
+class DeadlineMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.retries = {}
+        self.exhausted = {}
+
+    def record_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def record_retry(self, stage):
+        with self.lock:
+            self.retries[stage] = self.retries.get(stage, 0) + 1
+
+    def record_exhausted(self, stage):
+        with self.lock:
+            self.exhausted[stage] = self.exhausted.get(stage, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'budget_ms': app.config['BOOKING_DEADLINE_MS'],
+                'requests': self.requests,
+                'retries': dict(self.retries),
+                'exhausted': dict(self.exhausted)
+            }
+
+
+def call_with_deadline(deadline, stage, func, *args, retry_on=(redis.RedisError,), **kwargs):
+    """Call func, retrying retry_on errors after short jittered pauses while the deadline allows.
+
+    The last error is re-raised once attempts run out or the next pause would overrun the budget."""
+    for attempt in range(RETRY_MAX_ATTEMPTS):
+        deadline.check(stage)
+        try:
+            return func(*args, **kwargs)
+        except retry_on as e:
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            if attempt == RETRY_MAX_ATTEMPTS - 1:
+                raise
+            if deadline.remaining() <= delay:
+                deadline_metrics.record_exhausted(stage)
+                raise
+            logger.warning(f"{stage} attempt {attempt + 1} failed, retrying in {delay * 1000:.0f}ms: {str(e)}")
+            deadline_metrics.record_retry(stage)
+            socketio.sleep(delay)
+
+
+# Global instance
+deadline_metrics = DeadlineMetrics()
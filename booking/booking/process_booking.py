@@ -5,79 +5,90 @@ from flask import current_app, request
 from flask_login import current_user
 from flask_socketio import emit
 
-from booking.booking import booking_service
 from booking.booking.booking_service import acquire_lease_safe
+from booking.booking.deadline import Deadline, DeadlineExceeded, deadline_metrics
+from booking.catalog.catalog_cache import catalog_cache
 from booking.emit_utils.emit import emit_to_relevant_rooms_about_booking
-from booking.pending_bookings.pending_bookings_db import store_pending_booking, delete_pending_booking
-from booking.redis.redis_utils import redis_hget, redis_hset, redis_safe_release_lease
+from booking.redis.circuit_breaker import redis_circuit
+from booking.pending_bookings.pending_bookings_db import store_pending_booking, delete_pending_booking, \
+    find_conflicting_spots
+from booking.redis.redis_utils import redis_safe_release_lease
 from booking.stripe.create_stripe_session import create_stripe_session, create_stripe_session_direct
-from booking.utils import calculate_price
-from config import ParkingSpot, redis_client, db, Booking, PendingBooking, socketio
+from booking.utils import calculate_price, SpotTakenError
+from config import redis_client, socketio, db
 
 
 @socketio.on('book_spot')
 def book_spot(data):
+    # One budget for the whole request: lease retries, the database fallback and checkout queueing draw from it
+    deadline = Deadline(current_app.config['BOOKING_DEADLINE_MS'])
+    deadline_metrics.record_request()
     try:
         current_app.logger.info(f"book_spot event received: {data}")
 
-        # Check Redis health
-        redis_available = socketio.server.manager.redis_available
-
-        if redis_available:
+        # Circuit breaker state, kept current by background probes
+        if redis_circuit.available:
             # Try Redis-based booking first
             try:
-                return process_redis_booking(data, request.sid)
-            except (redis.exceptions.ConnectionError, Exception) as e:
-                if isinstance(e, redis.exceptions.ConnectionError):
-                    booking_service.redis_circuit_open = True
-                    current_app.logger.warning("Redis connection failed - opening circuit breaker")
-
+                return process_redis_booking(data, request.sid, deadline)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
                 current_app.logger.warning(f"Redis booking failed, falling back to direct: {str(e)}")
-                return process_direct_booking(data, request.sid)
+                return process_direct_booking(data, request.sid, deadline)
         else:
             # Redis is down, use direct booking
             current_app.logger.info("Redis unavailable - using direct booking")
-            return process_direct_booking(data, request.sid)
+            return process_direct_booking(data, request.sid, deadline)
 
+    except DeadlineExceeded as e:
+        current_app.logger.warning(f"book_spot gave up: {str(e)}")
+        emit('booking_failed', {'reason': 'Booking is taking too long. Please try again.'}, room=request.sid)
     except Exception as e:
         current_app.logger.error(f"book_spot error: {str(e)}", exc_info=True)
         emit('booking_failed', {'reason': 'Booking failed'}, room=request.sid)
 
 
 
-def process_redis_booking(data, sid):
+def process_redis_booking(data, sid, deadline):
     """Process booking using Redis lease system"""
     try:
-        spot = ParkingSpot.query.get(data.get('spotId'))
+        spot = catalog_cache.get_spot(data.get('spotId'))
         if not spot:
             emit('booking_failed', {'reason': 'Invalid spot'}, room=sid)
             return
 
-        conn_data = redis_hget(redis_client, "active_connections", sid) or {}
-        existing_reservation_id = conn_data.get('reservation_id')
-
         start_time_str = f"{data.get('startHour')}:{data.get('startMinute')}"
         end_time_str = f"{data.get('endHour')}:{data.get('endMinute')}"
 
-        # Redis connection check
-        redis_client.ping()
-
-        reservation_id = acquire_lease_safe(
+        # One round trip: connection errors surface here and send book_spot to the direct path
+        reservation_id, released = acquire_lease_safe(
             spot_id=spot.id,
             user_id=current_user.get_id(),
             parking_lot_id=data.get('parkingLotId'),
             booking_date=data.get('bookingDate'),
             start_time=start_time_str,
             end_time=end_time_str,
-            reservation_id=existing_reservation_id
+            sid=sid,
+            deadline=deadline
         )
 
         if not reservation_id:
             emit('booking_failed', {'reason': 'Spot already taken'}, room=sid)
             return
 
-        conn_data['reservation_id'] = reservation_id
-        redis_hset(redis_client, "active_connections", sid, conn_data)
+        if released:
+            released_spot_id, released_date, released_start, released_end = released
+            released_spot = catalog_cache.get_spot(released_spot_id)
+            if released_spot:
+                emit_to_relevant_rooms_about_booking(
+                    released_spot,
+                    released_date,
+                    True,
+                    False,
+                    datetime.strptime(released_start, "%H:%M").time(),
+                    datetime.strptime(released_end, "%H:%M").time()
+                )
 
         emit_to_relevant_rooms_about_booking(
             spot,
@@ -88,33 +99,25 @@ def process_redis_booking(data, sid):
             datetime.strptime(end_time_str, "%H:%M").time()
         )
 
-        from booking.non_redis_cross_instance_worker.cross_instance_manager import broadcast_spot_update
-        broadcast_spot_update(
-            spot,
-            data.get('bookingDate'),
-            False,
-            datetime.strptime(start_time_str, "%H:%M").time(),
-            datetime.strptime(end_time_str, "%H:%M").time()
-        )
-
-        with db.session.begin_nested():
-            checkout_url = create_stripe_session(
-                data, start_time_str, end_time_str, spot, reservation_id
+        def release_on_checkout_failure():
+            redis_safe_release_lease(
+                redis_client, reservation_id, data.get('parkingLotId'), spot.id, data.get('bookingDate')
+            )
+            emit_to_relevant_rooms_about_booking(
+                spot,
+                data.get('bookingDate'),
+                True,
+                False,
+                datetime.strptime(start_time_str, "%H:%M").time(),
+                datetime.strptime(end_time_str, "%H:%M").time()
             )
 
-            if not checkout_url:
-                # Cleanup on failure
-                lease_key = f"spot_lease:{spot.id}_{data.get('bookingDate')}"
-                redis_safe_release_lease(redis_client, lease_key, reservation_id)
-                emit_to_relevant_rooms_about_booking(
-                    spot, data.get('bookingDate'), True, False
-                )
-                emit('booking_failed', {'reason': 'Payment system error'}, room=sid)
-                return
-
-            emit('payment_redirect', {'url': checkout_url}, room=sid)
+        # Stripe is called from the checkout stage, which emits payment_redirect to this sid
+        create_stripe_session(
+            data, start_time_str, end_time_str, spot, reservation_id, sid, release_on_checkout_failure, deadline
+        )
 
-    except redis.exceptions.ConnectionError:
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError, DeadlineExceeded):
         raise
     except Exception as e:
         current_app.logger.error(f"Redis booking error: {str(e)}")
@@ -122,12 +125,12 @@ def process_redis_booking(data, sid):
 
 
 
-def process_direct_booking(data, sid):
+def process_direct_booking(data, sid, deadline):
     """Handle direct booking when Redis is down - with WebSocket updates"""
     try:
         current_app.logger.info("Processing direct booking fallback")
 
-        spot = ParkingSpot.query.get(data.get('spotId'))
+        spot = catalog_cache.get_spot(data.get('spotId'))
         if not spot:
             emit('booking_failed', {'reason': 'Invalid spot'})
             return
@@ -148,78 +151,77 @@ def process_direct_booking(data, sid):
             end_time
         )
 
-        from booking.non_redis_cross_instance_worker.cross_instance_manager import broadcast_spot_update
-        broadcast_spot_update(
-            spot,
-            data.get('bookingDate'),
-            False,
-            start_time,
-            end_time
+        # Whatever is left of the budget bounds every statement until store_pending_booking commits
+        deadline.apply_statement_timeout(db.session, 'direct_booking')
+
+        # One round trip for both tables; the exclusion constraints still decide races after this check
+        booked_spot_ids, pending_spot_ids = find_conflicting_spots(
+            int(data.get('parkingLotId')), booking_date, start_time, end_time, spot_id=spot.id
         )
 
-        # Check for conflicts after emitting
-        with db.session.begin_nested():
-            conflict_count = Booking.query.filter(
-                Booking.spot_id == int(data.get('spotId')),
-                Booking.parking_lot_id == int(data.get('parkingLotId')),
-                Booking.bookingDate == booking_date,
-                Booking.startTime < end_time,
-                Booking.endTime > start_time
-            ).count()
-
-            if conflict_count > 0:
-                current_app.logger.error(f"Spot {data.get('spotId')} already booked")
-                emit_to_relevant_rooms_about_booking(
-                    spot,
-                    data.get('bookingDate'),
-                    True,
-                    False
-                )
-                emit('booking_failed', {'reason': 'This spot was just booked by someone else'})
-                return
-
-            # Check for conflicting pending bookings
-            conflicting_pending = PendingBooking.query.filter(
-                PendingBooking.spot_id == int(data.get('spotId')),
-                PendingBooking.parking_lot_id == int(data.get('parkingLotId')),
-                PendingBooking.booking_date == booking_date,
-                PendingBooking.start_time < end_time,
-                PendingBooking.end_time > start_time
-            ).first()
-
-            if conflicting_pending:
-                current_app.logger.warning(
-                    f"Spot {data.get('spotId')} has pending booking: {conflicting_pending.reservation_id}")
-                emit_to_relevant_rooms_about_booking(
-                    spot,
-                    data.get('bookingDate'),
-                    True,
-                    False
-                )
-                emit('booking_failed',
-                     {'reason': 'This spot is currently being booked by someone else. Please try again in a moment.'})
-                return
+        if booked_spot_ids:
+            current_app.logger.error(f"Spot {data.get('spotId')} already booked")
+            emit_to_relevant_rooms_about_booking(
+                spot,
+                data.get('bookingDate'),
+                True,
+                False,
+                start_time,
+                end_time
+            )
+            emit('booking_failed', {'reason': 'This spot was just booked by someone else'})
+            return
+
+        if pending_spot_ids:
+            current_app.logger.warning(f"Spot {data.get('spotId')} has an active pending booking")
+            emit_to_relevant_rooms_about_booking(
+                spot,
+                data.get('bookingDate'),
+                True,
+                False,
+                start_time,
+                end_time
+            )
+            emit('booking_failed',
+                 {'reason': 'This spot is currently being booked by someone else. Please try again in a moment.'})
+            return
 
         amount = calculate_price(start_time, end_time, spot.pricePerHour)
         reservation_id = str(uuid.uuid4())
 
-        storage_success = store_pending_booking(
-            reservation_id=reservation_id,
-            user_id=current_user.get_id(),
-            parking_lot_id=data.get('parkingLotId'),
-            spot_id=data.get('spotId'),
-            booking_date=booking_date,
-            start_time=start_time,
-            end_time=end_time,
-            amount=amount
-        )
+        try:
+            storage_success = store_pending_booking(
+                reservation_id=reservation_id,
+                user_id=current_user.get_id(),
+                parking_lot_id=data.get('parkingLotId'),
+                spot_id=data.get('spotId'),
+                booking_date=booking_date,
+                start_time=start_time,
+                end_time=end_time,
+                amount=amount
+            )
+        except SpotTakenError as e:
+            current_app.logger.warning(str(e))
+            emit_to_relevant_rooms_about_booking(
+                spot,
+                data.get('bookingDate'),
+                True,
+                False,
+                start_time,
+                end_time
+            )
+            emit('booking_failed',
+                 {'reason': 'This spot is currently being booked by someone else. Please try again in a moment.'})
+            return
 
         if not storage_success:
             success = emit_to_relevant_rooms_about_booking(
                 spot,
                 data.get('bookingDate'),
                 False,
-                False
+                False,
+                start_time,
+                end_time
             )
 
             if not success:
@@ -227,32 +229,30 @@ def process_direct_booking(data, sid):
             emit('booking_failed', {'reason': 'Failed to process booking'})
             return
 
-        checkout_url = create_stripe_session_direct(
-            data,
-            start_time_str,
-            end_time_str,
-            spot,
-            reservation_id
-        )
-
-        if not checkout_url:
-            # Since booking failed emit_utils spot is available
-            success = emit_to_relevant_rooms_about_booking(
+        def release_on_checkout_failure():
+            delete_pending_booking(reservation_id)
+            emit_to_relevant_rooms_about_booking(
                 spot,
                 data.get('bookingDate'),
+                True,
                 False,
-                False
+                start_time,
+                end_time
             )
 
-            if not success:
-                current_app.logger.warning("Cross-instance broadcast failed - only updating local instance")
-            delete_pending_booking(reservation_id)
-            emit('booking_failed', {'reason': 'Payment system error'})
-            return
-
-        emit('payment_redirect', {'url': checkout_url})
+        create_stripe_session_direct(
+            data,
+            start_time_str,
+            end_time_str,
+            spot,
+            reservation_id,
+            sid,
+            release_on_checkout_failure,
+            deadline
+        )
 
     except Exception as e:
+        db.session.rollback()
         current_app.logger.error(f"Direct booking error: {str(e)}")
         # Since booking failed emit_utils spot is available
         if 'spot' in locals():
@@ -0,0 +1,131 @@
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+from config import app, redis_client, ParkingLot, ParkingSpot
+
+logger = logging.getLogger(__name__)
+
+CATALOG_INVALIDATION_CHANNEL = 'catalog_invalidations'
+
+# Field names mirror the models so records can be passed wherever a ParkingSpot/ParkingLot was read
+SpotRecord = namedtuple('SpotRecord', ['id', 'parkingLotId', 'spotNumber', 'svgCoords', 'pricePerHour'])
+LotRecord = namedtuple('LotRecord', ['id', 'name', 'image_filename', 'spots'])
+
+
+class CatalogCache:
+    """Bounded, TTL'd in-process cache of immutable parking lot and spot records"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # ('spot' | 'lot', id) -> (expires_at, record)
+
+    def get_spot(self, spot_id):
+        spot_id = self._as_id(spot_id)
+        if spot_id is None:
+            return None
+
+        record = self._get(('spot', spot_id))
+        if record is None:
+            spot = ParkingSpot.query.get(spot_id)
+            if not spot:
+                return None
+            record = self._spot_record(spot)
+            self._put(('spot', spot_id), record)
+        return record
+
+    def get_lot(self, lot_id):
+        lot_id = self._as_id(lot_id)
+        if lot_id is None:
+            return None
+
+        record = self._get(('lot', lot_id))
+        if record is None:
+            lot = ParkingLot.query.get(lot_id)
+            if not lot:
+                return None
+            spots = tuple(self._spot_record(spot) for spot in lot.spots)
+            record = LotRecord(lot.id, lot.name, lot.image_filename, spots)
+            self._put(('lot', lot_id), record)
+            for spot in spots:
+                self._put(('spot', spot.id), spot)
+        return record
+
+    def invalidate_spot(self, spot_id, lot_id):
+        spot_id = int(spot_id)
+        with self.lock:
+            self.entries.pop(('spot', spot_id), None)
+            self.entries.pop(('lot', int(lot_id)), None)
+            # The spot may have been moved from another lot
+            for key, (_, record) in list(self.entries.items()):
+                if key[0] == 'lot' and any(spot.id == spot_id for spot in record.spots):
+                    del self.entries[key]
+
+    def invalidate_lot(self, lot_id):
+        lot_id = int(lot_id)
+        with self.lock:
+            self.entries.pop(('lot', lot_id), None)
+            for key, (_, record) in list(self.entries.items()):
+                if key[0] == 'spot' and record.parkingLotId == lot_id:
+                    del self.entries[key]
+
+    def _get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, record = entry
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return record
+
+    def _put(self, key, record):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, record)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    @staticmethod
+    def _spot_record(spot):
+        return SpotRecord(spot.id, spot.parkingLotId, spot.spotNumber, spot.svgCoords, spot.pricePerHour)
+
+    @staticmethod
+    def _as_id(value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+
+# Global instance
+catalog_cache = CatalogCache(app.config['CATALOG_CACHE_MAX_SIZE'], app.config['CATALOG_CACHE_TTL'])
+
+
+def invalidate_catalog(model):
+    """Drop a changed ParkingLot/ParkingSpot locally and tell the other instances to do the same"""
+    if isinstance(model, ParkingSpot):
+        message = {'kind': 'spot', 'id': model.id, 'lot_id': model.parkingLotId}
+    elif isinstance(model, ParkingLot):
+        message = {'kind': 'lot', 'id': model.id}
+    else:
+        return
+
+    handle_catalog_invalidation(message)
+    try:
+        redis_client.publish(CATALOG_INVALIDATION_CHANNEL, json.dumps(message))
+    except Exception as e:
+        logger.warning(f"Catalog invalidation not published, other instances rely on TTL: {str(e)}")
+
+
+def handle_catalog_invalidation(message):
+    if message['kind'] == 'spot':
+        catalog_cache.invalidate_spot(message['id'], message['lot_id'])
+    elif message['kind'] == 'lot':
+        catalog_cache.invalidate_lot(message['id'])
+    logger.info(f"Catalog cache invalidated: {message}")
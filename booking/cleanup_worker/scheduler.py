@@ -2,7 +2,9 @@ from datetime import datetime
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 from flask import current_app
-from config import app, PendingBooking, db, ActiveConnection
+from booking.pending_bookings.pending_bookings_db import purge_expired_holds
+from booking.redis.occupancy import clear_held
+from config import app, db, ActiveConnection
 
 
 def init_scheduler():
@@ -31,10 +33,12 @@ def cleanup_expired_pending_bookings():
     """Clean up expired pending bookings"""
     try:
         with app.app_context():
-            expired_count = PendingBooking.query.filter(PendingBooking.expires_at < datetime.now()).delete()
+            purged = purge_expired_holds()
             db.session.commit()
-            if expired_count > 0:
-                current_app.logger.info(f"Cleaned up {expired_count} expired pending bookings")
+            for held in purged:
+                clear_held(*held)
+            if purged:
+                current_app.logger.info(f"Cleaned up {len(purged)} expired pending bookings")
     except Exception as e:
         current_app.logger.error(f"Failed to clean up expired pending bookings: {str(e)}")
         db.session.rollback()
@@ -0,0 +1,68 @@
+import threading
+import logging
+from config import app, socketio
+
+logger = logging.getLogger(__name__)
+
+
+class SpotUpdateAggregator:
+    """Coalesces spot_update emissions per lot/date room into batched spot_updates frames"""
+
+    def __init__(self, window_ms):
+        self.window = window_ms / 1000
+        self.lock = threading.Lock()
+        # lot/date room -> ordered frames of [recipient rooms, {spot_id: available}]
+        self.pending = {}
+
+    def add(self, lot_room, recipients, spot_id, available):
+        if self.window <= 0:
+            emit_spot_updates(recipients, {spot_id: available})
+            return
+
+        recipients = recipients if isinstance(recipients, str) else tuple(recipients)
+
+        with self.lock:
+            frames = self.pending.get(lot_room)
+            first_update = frames is None
+            if first_update:
+                frames = self.pending[lot_room] = []
+
+            # Only merge into the newest frame so updates reach clients in the order they happened
+            if frames and frames[-1][0] == recipients:
+                frames[-1][1][spot_id] = available
+            else:
+                frames.append([recipients, {spot_id: available}])
+
+        if first_update:
+            socketio.start_background_task(self._flush_after_window, lot_room)
+
+    def _flush_after_window(self, lot_room):
+        socketio.sleep(self.window)
+
+        with self.lock:
+            frames = self.pending.pop(lot_room, [])
+
+        for recipients, deltas in frames:
+            emit_spot_updates(recipients, deltas)
+
+        logger.debug(f"Flushed {len(frames)} spot_updates frames for {lot_room}")
+
+
+
+def emit_spot_updates(recipients, deltas):
+    """One spot_updates frame with {spot_id: available} deltas to a room or a list of rooms of this instance.
+
+    Other instances receive the same deltas through the cross-instance transport, so the manager's queue is skipped"""
+    try:
+        socketio.emit(
+            'spot_updates',
+            {'updates': [{'spotId': spot_id, 'available': available} for spot_id, available in deltas.items()]},
+            to=recipients if isinstance(recipients, str) else list(recipients),
+            ignore_queue=True
+        )
+    except Exception as e:
+        logger.error(f"spot_updates emission error: {str(e)}")
+
+
+# Global instance
+spot_update_aggregator = SpotUpdateAggregator(app.config['SPOT_UPDATE_BATCH_WINDOW_MS'])
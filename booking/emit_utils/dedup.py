@@ -0,0 +1,49 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from config import app
+
+
+def spot_event_id(spot_id, booking_date, start_time, end_time, is_available):
+    """Stable id of a spot state change; every instance derives the same id for the same change"""
+    window = f"{_format_time(start_time)}-{_format_time(end_time)}"
+    key = f"{spot_id}|{booking_date}|{window}|{'free' if is_available else 'taken'}"
+    return hashlib.blake2b(key.encode(), digest_size=8).hexdigest()
+
+
+class RecentSpotEvents:
+    """Bounded LRU of the last event emitted per (spot, date), expiring after window_seconds.
+
+    A state change is a duplicate only if it matches the last one for its spot and date, whatever window
+    either covers, so taken -> freed -> taken still emits three times even when the free carries no window."""
+
+    def __init__(self, window_seconds, max_size=10000):
+        self.window = window_seconds
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # (spot, date) -> (event_id, emitted_at)
+
+    def first_time(self, spot_id, booking_date, event_id):
+        """Record event_id and return True unless it was just emitted"""
+        key = (int(spot_id), str(booking_date))
+        now = time.monotonic()
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            self.entries[key] = (event_id, now)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return previous is None or previous[0] != event_id or now - previous[1] > self.window
+
+
+def _format_time(value):
+    if not value:
+        return ''
+    if isinstance(value, str):
+        hours, minutes = value.split(':', 1)
+        return f"{int(hours):02d}:{int(minutes):02d}"
+    return value.strftime('%H:%M')
+
+
+# Global instance
+recent_spot_events = RecentSpotEvents(app.config['SPOT_EVENT_DEDUP_SECONDS'])
@@ -1,28 +1,29 @@
 from datetime import datetime
+from booking.emit_utils.aggregator import spot_update_aggregator, emit_spot_updates
+from booking.emit_utils.dedup import recent_spot_events, spot_event_id
 from booking.non_redis_cross_instance_worker.cross_instance_manager import broadcast_spot_update
-from booking.redis.redis_utils import redis_smembers, redis_hget
+from booking.redis.circuit_breaker import redis_circuit
+from booking.redis.redis_utils import redis_room_size
+from booking.utils import time_to_minutes
 from config import app, db, redis_client, ActiveConnection, socketio
 
+# A taken spot reaches every subscriber sharing a bucket with the booking, so with buckets wider than the
+# quarter-hour booking grid a subscriber whose window only touches the same hour also sees it
+TIME_BUCKET_MINUTES = app.config['SPOT_UPDATE_BUCKET_MINUTES']
+
 
 def emit_to_relevant_rooms_about_booking(spot, booking_date, is_available, return_confirmation, start_time=None,
                                          end_time=None):
     try:
-        # Check Redis availability
-        redis_available = socketio.server.manager.redis_available
-        app.logger.info(
-            f"Starting emission - Redis: {redis_available}, Spot: {spot.id}, Date: {booking_date}, Available: {is_available}")
+        event_id = spot_event_id(spot.id, booking_date, start_time, end_time, is_available)
+        if not recent_spot_events.first_time(spot.id, booking_date, event_id):
+            app.logger.info(f"Skipping duplicate spot event {event_id} - spot {spot.id} on {booking_date}")
+            return True if return_confirmation else None
 
         # Broadcast to other instances
-        broadcast_success = broadcast_spot_update(spot, booking_date, is_available, start_time, end_time)
-
-        # Emit to local instance
-        target_room = f"lot_{spot.parkingLotId}_{booking_date}"
+        broadcast_spot_update(spot, booking_date, is_available, start_time, end_time, event_id)
 
-        # Choose emission method based on Redis availability
-        if redis_available:
-            success = _emit_using_redis(target_room, spot, booking_date, is_available, start_time, end_time)
-        else:
-            success = _emit_using_database_fallback(target_room, spot, booking_date, is_available, start_time, end_time)
+        success = _emit_locally(spot.id, spot.parkingLotId, booking_date, is_available, start_time, end_time)
 
         return success if return_confirmation else None
 
@@ -31,46 +32,100 @@ def emit_to_relevant_rooms_about_booking(spot, booking_date, is_available, retur
         return False if return_confirmation else None
 
 
-def _emit_using_redis(target_room, spot, booking_date, is_available, start_time, end_time):
-    room_key = f"active_rooms:{target_room}"
-    sids = redis_smembers(redis_client, room_key)
+def emit_locally_about_booking(spot_id, parking_lot_id, booking_date, is_available, start_time=None, end_time=None):
+    """Emit to this instance's sockets only, unless this instance already emitted the same state change"""
+    event_id = spot_event_id(spot_id, booking_date, start_time, end_time, is_available)
+    if not recent_spot_events.first_time(spot_id, booking_date, event_id):
+        return True
+    return _emit_locally(spot_id, parking_lot_id, booking_date, is_available, start_time, end_time)
+
+
+def emit_spot_deltas_locally(deltas):
+    """Apply [spot_id, lot_id, date, available, start, end, event_id] deltas received from another instance"""
+    deltas = [
+        delta for delta in deltas
+        if recent_spot_events.first_time(delta[0], delta[2], delta[6])
+    ]
+
+    if redis_circuit.available:
+        by_room = {}
+        for spot_id, parking_lot_id, booking_date, is_available, start_time, end_time, _ in deltas:
+            by_room.setdefault(f"lot_{parking_lot_id}_{booking_date}", []).append(
+                (spot_id, is_available, start_time, end_time))
+        for room, updates in by_room.items():
+            emit_coalesced_spot_updates(room, updates)
+        return
+
+    for spot_id, parking_lot_id, booking_date, is_available, start_time, end_time, _ in deltas:
+        _emit_locally(
+            spot_id, parking_lot_id, booking_date, is_available,
+            datetime.strptime(start_time, '%H:%M').time() if start_time else None,
+            datetime.strptime(end_time, '%H:%M').time() if end_time else None
+        )
+
+
+def _emit_locally(spot_id, parking_lot_id, booking_date, is_available, start_time, end_time):
+    """Emit to this instance's sockets only; other instances get the update from the cross-instance transport"""
+    # Check Redis availability
+    redis_available = redis_circuit.available
+    app.logger.info(
+        f"Starting emission - Redis: {redis_available}, Spot: {spot_id}, Date: {booking_date}, Available: {is_available}")
 
-    if not sids:
-        app.logger.info(f"Room {target_room} not found or empty")
-        return False
+    target_room = f"lot_{parking_lot_id}_{booking_date}"
 
-    recipients = 0
-    skipped_no_overlap = 0
-    skipped_no_data = 0
-    skipped_wrong_date = 0
+    # Choose emission method based on Redis availability
+    if redis_available:
+        return _emit_using_redis(target_room, spot_id, booking_date, is_available, start_time, end_time)
+    return _emit_using_database_fallback(target_room, spot_id, booking_date, is_available, start_time, end_time)
 
-    for sid in sids:
-        conn_data = redis_hget(redis_client, "active_connections", sid)
-        if not conn_data:
-            skipped_no_data += 1
-            continue
 
-        conn_date = conn_data.get('bookingDate', '')
-        if conn_date != booking_date:
-            skipped_wrong_date += 1
-            app.logger.info(f"Skipping {sid} - wrong date: {conn_date} != {booking_date}")
-            continue
+def _emit_using_redis(target_room, spot_id, booking_date, is_available, start_time, end_time):
+    # A freed spot concerns everyone on the lot/date; a taken one only the overlapped time buckets.
+    # The manager resolves the rooms and de-duplicates sids, so no per-socket loop runs here.
+    if is_available or not start_time or not end_time:
+        spot_update_aggregator.add(target_room, target_room, spot_id, is_available)
+        app.logger.info(f"Redis emission queued - room {target_room}")
+    else:
+        bucket_rooms = time_bucket_rooms(target_room, start_time, end_time)
+        spot_update_aggregator.add(target_room, bucket_rooms, spot_id, is_available)
+        app.logger.info(f"Redis emission queued - {len(bucket_rooms)} bucket rooms of {target_room}")
 
-        if not _should_emit_based_on_time(conn_data, start_time, end_time, is_available):
-            skipped_no_overlap += 1
-            app.logger.info(f"Skipping {sid} - no time overlap")
-            continue
+    return redis_room_size(redis_client, target_room) > 0
 
-        socketio.emit('spot_update', {'spotId': spot.id, 'available': is_available}, room=sid)
-        recipients += 1
-        app.logger.info(f"Emitted to {sid}")
 
-    app.logger.info(
-        f"Redis emission - Recipients: {recipients}, Skipped: {skipped_no_overlap} time, {skipped_wrong_date} date, {skipped_no_data} no data")
-    return recipients > 0
+def emit_coalesced_spot_updates(target_room, updates):
+    """Emit a batch of (spot_id, is_available, start_time, end_time) updates of one lot/date room.
+
+    Only the latest update per spot is sent, as one spot_updates frame per recipient set."""
+    latest = {}
+    for spot_id, is_available, start_time, end_time in updates:
+        latest.pop(spot_id, None)
+        latest[spot_id] = (is_available, start_time, end_time)
+
+    frames = {}
+    for spot_id, (is_available, start_time, end_time) in latest.items():
+        if is_available or not start_time or not end_time:
+            recipients = target_room
+        else:
+            recipients = tuple(time_bucket_rooms(target_room, start_time, end_time))
+        frames.setdefault(recipients, {})[spot_id] = is_available
+
+    for recipients, deltas in frames.items():
+        emit_spot_updates(recipients, deltas)
+    return len(frames)
+
+
+def time_bucket_rooms(room_name, start_time, end_time):
+    """Names of the TIME_BUCKET_MINUTES rooms of a lot/date room that start_time-end_time overlaps"""
+    first_bucket = time_to_minutes(start_time) // TIME_BUCKET_MINUTES
+    last_bucket = -(-time_to_minutes(end_time) // TIME_BUCKET_MINUTES)
+    return [
+        f"{room_name}_t{bucket * TIME_BUCKET_MINUTES // 60:02d}{bucket * TIME_BUCKET_MINUTES % 60:02d}"
+        for bucket in range(first_bucket, last_bucket)
+    ]
 
 
-def _emit_using_database_fallback(target_room, spot, booking_date, is_available, start_time, end_time):
+def _emit_using_database_fallback(target_room, spot_id, booking_date, is_available, start_time, end_time):
     # Clean up expired connections first
     expired_count = ActiveConnection.query.filter(
         ActiveConnection.expires_at < datetime.now()
@@ -103,10 +158,11 @@ def _emit_using_database_fallback(target_room, spot, booking_date, is_available,
             app.logger.info(f"Skipping {conn.socket_id} - no time overlap")
             continue
 
+        # Local only: sockets on other instances are reached through their own fallback tables
         socketio.emit('spot_update', {
-            'spotId': spot.id,
+            'spotId': spot_id,
             'available': is_available
-        }, room=conn.socket_id)
+        }, room=conn.socket_id, ignore_queue=True)
         emitted_count += 1
         app.logger.info(f"Emitted to {conn.socket_id}")
 
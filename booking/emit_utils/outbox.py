@@ -0,0 +1,21 @@
+from sqlalchemy import text
+from config import db, OutboxEvent
+
+OUTBOX_CHANNEL = 'outbox_events'
+
+
+def record_spot_event(spot_id, parking_lot_id, booking_date, start_time, end_time, is_available):
+    """Stage a spot update in the caller's transaction; it is dispatched only if that transaction commits"""
+    db.session.add(OutboxEvent(
+        event_type='spot_freed' if is_available else 'spot_taken',
+        room=f"lot_{parking_lot_id}_{booking_date}",
+        payload={
+            'spot_id': int(spot_id),
+            'booking_date': str(booking_date),
+            'start_time': start_time.strftime('%H:%M'),
+            'end_time': end_time.strftime('%H:%M'),
+            'is_available': is_available
+        }
+    ))
+    # NOTIFY is transactional too: the dispatcher wakes on commit and never for a rollback
+    db.session.execute(text(f"NOTIFY {OUTBOX_CHANNEL}"))
@@ -1,107 +1,159 @@
+import json
+import uuid
+import select
 import threading
 import time
 import logging
-from datetime import datetime, timedelta
-from zoneinfo import ZoneInfo
-from config import app,ParkingSpot, PendingBooking
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy import text
+from booking.non_redis_cross_instance_worker.spot_delta_transport import SpotDeltaBroadcaster, SPOT_DELTAS_CHANNEL
+from config import app, db
 
 logger = logging.getLogger(__name__)
 
+BOOKING_EVENTS_CHANNEL = 'booking_events'
+# Lets listeners skip notifications this instance sent itself
+INSTANCE_ID = uuid.uuid4().hex[:12]
+
 
 class CrossInstanceManager:
+    """Relays pending bookings made on other instances, pushed over Postgres LISTEN/NOTIFY"""
+
     def __init__(self):
-        self.polling_interval = 3
-        self.polling_thread = None
+        self.listen_timeout = 60  # Only bounds how long stop() takes; an idle listener sends no queries
+        self.listener_thread = None
+        self.stream_thread = None
         self.running = False
-        self.last_processed_booking_ids = set()
+        self.max_processed_ids = 10000
+        self.last_processed_booking_ids = OrderedDict()
 
     def start(self):
-        if self.polling_thread and self.polling_thread.is_alive():
-            logger.info("⚠Polling thread already running")
+        if self.listener_thread and self.listener_thread.is_alive():
+            logger.info("⚠Listener thread already running")
             return
 
         self.running = True
-        self.polling_thread = threading.Thread(target=self._poll_database, daemon=True)
-        self.polling_thread.start()
-        logger.info("Database polling thread started")
-
-    def _poll_database(self):
-        """Poll database for recent bookings from OTHER instances"""
-        logger.info("Polling thread started - beginning database checks")
+        self.listener_thread = threading.Thread(target=self._listen, daemon=True)
+        self.listener_thread.start()
+        self.stream_thread = threading.Thread(target=spot_delta_broadcaster.read_stream, daemon=True)
+        self.stream_thread.start()
+        logger.info("Booking events listener and spot delta stream threads started")
+
+    def _listen(self):
+        """Hold one LISTEN connection and relay notifications; reconnect with backoff on failure"""
+        backoff = 1
         while self.running:
+            connection = None
             try:
                 with app.app_context():
-                    logger.debug("Checking for recent bookings from other instances...")
-                    self._check_recent_bookings_from_other_instances()
-                time.sleep(self.polling_interval)
-            except Exception as e:
-                logger.error(f"Polling error: {str(e)}")
-                time.sleep(self.polling_interval)
+                    connection = db.engine.raw_connection()
+                connection.detach()  # autocommit + LISTEN must not leak back into the pool
+                listener = connection.driver_connection
+                listener.autocommit = True
+                listener.cursor().execute(f"LISTEN {BOOKING_EVENTS_CHANNEL}; LISTEN {SPOT_DELTAS_CHANNEL}")
+                logger.info(f"Listening on {BOOKING_EVENTS_CHANNEL} and {SPOT_DELTAS_CHANNEL}")
+                backoff = 1
+
+                while self.running:
+                    if select.select([listener], [], [], self.listen_timeout) == ([], [], []):
+                        continue
+                    listener.poll()
+                    while listener.notifies:
+                        notification = listener.notifies.pop(0)
+                        if notification.channel == SPOT_DELTAS_CHANNEL:
+                            spot_delta_broadcaster.receive(notification.payload)
+                        else:
+                            self._handle_notification(notification.payload)
 
-    def _check_recent_bookings_from_other_instances(self):
-        """Check for recent bookings made on OTHER instances"""
+            except Exception as e:
+                logger.error(f"Booking events listener error: {str(e)}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+    def _handle_notification(self, payload):
         try:
-            # Look for bookings created in the last 5 seconds
-            recent_time = datetime.now(ZoneInfo("Europe/Nicosia")) - timedelta(seconds=5)
-
-            recent_bookings = PendingBooking.query.filter(
-                PendingBooking.created_at >= recent_time
-            ).all()
-
-            logger.debug(f"Found {len(recent_bookings)} recent bookings")
+            event = json.loads(payload)
+        except ValueError:
+            logger.warning(f"Malformed booking event: {payload}")
+            return
 
-            for booking in recent_bookings:
-                booking_id = f"pending_{booking.id}"
+        if event['i'] == INSTANCE_ID:
+            return  # This instance already emitted it locally
 
-                if booking_id not in self.last_processed_booking_ids:
-                    self.last_processed_booking_ids.add(booking_id)
-                    self._process_booking_from_other_instance(booking)
-                    logger.info(f"Processed cross-instance booking: {booking.id}")
+        booking_id = f"pending_{event['r']}"
+        if booking_id in self.last_processed_booking_ids:
+            return
+        self.last_processed_booking_ids[booking_id] = True
+        if len(self.last_processed_booking_ids) > self.max_processed_ids:
+            self.last_processed_booking_ids.popitem(last=False)
 
-        except Exception as e:
-            logger.error(f"Booking check error: {str(e)}")
+        with app.app_context():
+            self._process_booking_from_other_instance(event)
+        logger.info(f"Processed cross-instance booking: {event['r']}")
 
-    def _process_booking_from_other_instance(self, booking):
+    def _process_booking_from_other_instance(self, event):
         """Process a booking that came from another instance"""
         try:
-            logger.info(f"Processing booking from other instance: {booking.id}")
-            spot = ParkingSpot.query.get(booking.spot_id)
+            logger.info(f"Processing booking from other instance: {event['r']}")
+            from booking.catalog.catalog_cache import catalog_cache
+            spot = catalog_cache.get_spot(event['s'])
             if not spot:
-                logger.warning(f"Spot not found: {booking.spot_id}")
+                logger.warning(f"Spot not found: {event['s']}")
                 return
 
-            from booking.utils import emit_to_relevant_rooms_about_booking
+            from booking.emit_utils.emit import emit_locally_about_booking
 
-            emit_to_relevant_rooms_about_booking(
-                spot,
-                booking.booking_date,
+            emit_locally_about_booking(
+                spot.id,
+                spot.parkingLotId,
+                event['d'],
                 False,
-                False,
-                booking.start_time,
-                booking.end_time
+                datetime.strptime(event['st'], '%H:%M').time(),
+                datetime.strptime(event['et'], '%H:%M').time()
             )
 
-            logger.info(f"Emitted update for spot {booking.spot_id} from other instance")
+            logger.info(f"Emitted update for spot {event['s']} from other instance")
 
         except Exception as e:
             logger.error(f"Booking processing error: {str(e)}")
 
-    def broadcast_spot_update(self, spot, booking_date, available, start_time=None, end_time=None):
+    def broadcast_spot_update(self, spot, booking_date, available, start_time=None, end_time=None, event_id=None):
         """Broadcast spot update to other instances"""
         logger.info(f"Cross-instance broadcast requested for spot {spot.id}")
-        return True
+        return spot_delta_broadcaster.add(spot.id, spot.parkingLotId, booking_date, available, start_time, end_time,
+                                          event_id)
 
 
-# Global instance
+# Global instances
+spot_delta_broadcaster = SpotDeltaBroadcaster(INSTANCE_ID, app.config['SPOT_UPDATE_BATCH_WINDOW_MS'])
 cross_instance_manager = CrossInstanceManager()
 
 
+def notify_booking_event(reservation_id, spot_id, booking_date, start_time, end_time):
+    """Queue a NOTIFY in the caller's transaction; other instances hear it only if that transaction commits"""
+    payload = json.dumps({
+        'i': INSTANCE_ID,
+        'r': reservation_id,
+        's': int(spot_id),
+        'd': str(booking_date),
+        'st': start_time.strftime('%H:%M'),
+        'et': end_time.strftime('%H:%M')
+    }, separators=(',', ':'))
+    db.session.execute(text("SELECT pg_notify(:channel, :payload)"),
+                       {'channel': BOOKING_EVENTS_CHANNEL, 'payload': payload})
+
+
 def init_cross_instance_messaging():
     """Initialize cross-instance messaging"""
     logger.info("Initializing cross-instance messaging...")
     cross_instance_manager.start()
 
 
-def broadcast_spot_update(spot, booking_date, available, start_time=None, end_time=None):
+def broadcast_spot_update(spot, booking_date, available, start_time=None, end_time=None, event_id=None):
     logger.info(f"Broadcasting spot update: {spot.id}, available={available}")
-    return cross_instance_manager.broadcast_spot_update(spot, booking_date, available, start_time, end_time)
\ No newline at end of file
+    return cross_instance_manager.broadcast_spot_update(spot, booking_date, available, start_time, end_time,
+                                                        event_id)
\ No newline at end of file
@@ -0,0 +1,187 @@
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from sqlalchemy import text
+from booking.emit_utils.dedup import spot_event_id
+from booking.redis.circuit_breaker import redis_circuit
+from booking.redis.redis_client_factory import create_redis_client
+from config import app, db, redis_client, socketio
+
+logger = logging.getLogger(__name__)
+
+SPOT_DELTAS_STREAM = 'spot_deltas'
+SPOT_DELTAS_CHANNEL = 'spot_deltas'
+STREAM_MAX_LENGTH = 10000
+# pg_notify payloads are limited to 8000 bytes; a delta is ~60 bytes
+MAX_DELTAS_PER_MESSAGE = 100
+
+
+class RedisStreamTransport:
+    name = 'redis_stream'
+
+    def send(self, message):
+        redis_client.xadd(SPOT_DELTAS_STREAM, {'message': message}, maxlen=STREAM_MAX_LENGTH, approximate=True)
+
+
+class PostgresNotifyTransport:
+    name = 'pg_notify'
+
+    def send(self, message):
+        # Own autocommit connection: the broadcast must not wait for (or roll back with) the caller's transaction
+        with app.app_context(), db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.execute(text("SELECT pg_notify(:channel, :payload)"),
+                               {'channel': SPOT_DELTAS_CHANNEL, 'payload': message})
+
+
+class TransportMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = {}
+        self.send_failures = 0
+        self.received = 0
+        self.dropped = 0  # Sequence gaps seen from other instances
+        self.latency_ms_last = None
+        self.latency_ms_avg = None
+        self.latency_ms_max = 0.0
+
+    def record_sent(self, transport):
+        with self.lock:
+            self.sent[transport] = self.sent.get(transport, 0) + 1
+
+    def record_send_failure(self):
+        with self.lock:
+            self.send_failures += 1
+
+    def record_received(self, latency_ms, gap):
+        with self.lock:
+            self.received += 1
+            self.dropped += gap
+            self.latency_ms_last = latency_ms
+            self.latency_ms_max = max(self.latency_ms_max, latency_ms)
+            # Exponentially weighted so the figure tracks recent conditions
+            self.latency_ms_avg = latency_ms if self.latency_ms_avg is None else \
+                0.9 * self.latency_ms_avg + 0.1 * latency_ms
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'sent': dict(self.sent),
+                'send_failures': self.send_failures,
+                'received': self.received,
+                'dropped': self.dropped,
+                'latency_ms_last': self.latency_ms_last,
+                'latency_ms_avg': self.latency_ms_avg,
+                'latency_ms_max': self.latency_ms_max
+            }
+
+
+class SpotDeltaBroadcaster:
+    """Batches spot deltas and fans them out to the other instances.
+
+    Redis Streams carry them while Redis is up, Postgres NOTIFY while it is down. Every message holds the
+    sender's instance id and a per-sender sequence number, so receivers skip their own messages and count gaps."""
+
+    def __init__(self, instance_id, window_ms):
+        self.instance_id = instance_id
+        self.window = window_ms / 1000
+        self.lock = threading.Lock()
+        self.pending = []
+        self.sequence = 0
+        self.last_sequences = OrderedDict()  # sender -> last sequence seen, bounded to recent senders
+        self.metrics = TransportMetrics()
+        self.redis_transport = RedisStreamTransport()
+        self.postgres_transport = PostgresNotifyTransport()
+
+    def add(self, spot_id, parking_lot_id, booking_date, available, start_time=None, end_time=None, event_id=None):
+        if event_id is None:
+            event_id = spot_event_id(spot_id, booking_date, start_time, end_time, available)
+        delta = [int(spot_id), int(parking_lot_id), str(booking_date), available,
+                 _format_time(start_time), _format_time(end_time), event_id]
+        with self.lock:
+            first_delta = not self.pending
+            self.pending.append(delta)
+
+        if self.window <= 0:
+            self.flush()
+        elif first_delta:
+            socketio.start_background_task(self._flush_after_window)
+        return True
+
+    def _flush_after_window(self):
+        socketio.sleep(self.window)
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            deltas, self.pending = self.pending, []
+
+        for start in range(0, len(deltas), MAX_DELTAS_PER_MESSAGE):
+            self._send(deltas[start:start + MAX_DELTAS_PER_MESSAGE])
+
+    def _send(self, deltas):
+        with self.lock:
+            self.sequence += 1
+            sequence = self.sequence
+        message = json.dumps({'i': self.instance_id, 'n': sequence, 't': time.time(), 'd': deltas},
+                              separators=(',', ':'))
+
+        transports = [self.postgres_transport]
+        if redis_circuit.available:
+            transports.insert(0, self.redis_transport)
+
+        for transport in transports:
+            try:
+                transport.send(message)
+                self.metrics.record_sent(transport.name)
+                return
+            except Exception as e:
+                logger.warning(f"Spot delta broadcast over {transport.name} failed: {str(e)}")
+                if transport is self.redis_transport:
+                    redis_circuit.record_failure(e)
+        self.metrics.record_send_failure()
+        logger.error(f"Spot delta broadcast {sequence} lost - no transport available")
+
+    def receive(self, message):
+        try:
+            message = json.loads(message)
+        except ValueError:
+            logger.warning(f"Malformed spot delta message: {message}")
+            return
+
+        sender = message['i']
+        if sender == self.instance_id:
+            return
+
+        with self.lock:
+            last_sequence = self.last_sequences.pop(sender, None)
+            self.last_sequences[sender] = max(message['n'], last_sequence or 0)
+            if len(self.last_sequences) > 256:
+                self.last_sequences.popitem(last=False)
+        gap = max(message['n'] - last_sequence - 1, 0) if last_sequence is not None else 0
+        self.metrics.record_received((time.time() - message['t']) * 1000, gap)
+
+        from booking.emit_utils.emit import emit_spot_deltas_locally
+        with app.app_context():
+            emit_spot_deltas_locally(message['d'])
+
+    def read_stream(self):
+        """Blocking XREAD loop over the Redis stream; waits out Redis outages"""
+        stream_client = create_redis_client(app.config['REDIS_URL'], max_connections=1, socket_timeout=None)
+        last_id = '$'
+        while True:
+            try:
+                for _, entries in stream_client.xread({SPOT_DELTAS_STREAM: last_id}, block=5000) or []:
+                    for entry_id, fields in entries:
+                        last_id = entry_id
+                        self.receive(fields[b'message'])
+            except Exception as e:
+                logger.warning(f"Spot delta stream read error: {str(e)}")
+                time.sleep(5)
+
+
+def _format_time(value):
+    if value is None or isinstance(value, str):
+        return value
+    return value.strftime('%H:%M')
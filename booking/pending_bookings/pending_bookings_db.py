@@ -1,13 +1,25 @@
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 from flask import current_app
-from config import PendingBooking, db
+from sqlalchemy import select, delete, literal, union_all
+from sqlalchemy.exc import IntegrityError
+from booking.non_redis_cross_instance_worker.cross_instance_manager import notify_booking_event
+from booking.redis.occupancy import mark_held, clear_held
+from booking.utils import SpotTakenError, is_exclusion_violation
+from config import Booking, PendingBooking, db
 
 
 def store_pending_booking(reservation_id, user_id, parking_lot_id, spot_id,
                           booking_date, start_time, end_time, amount):
-    """Store booking in pending_bookings table"""
+    """Store booking in pending_bookings table.
+
+    Overlapping holds are rejected by excl_pending_bookings_spot_time and raise SpotTakenError"""
     try:
+        # Expired holds stay in the table until cleanup but must not trip the exclusion constraint
+        purged = purge_expired_holds(PendingBooking.spot_id == spot_id, PendingBooking.booking_date == booking_date)
+
+        expires_at = datetime.now(ZoneInfo("Europe/Nicosia")) + timedelta(minutes=4)
+
         pending_booking = PendingBooking(
             reservation_id=reservation_id,
             user_id=user_id,
@@ -17,11 +29,21 @@ def store_pending_booking(reservation_id, user_id, parking_lot_id, spot_id,
             start_time=start_time,
             end_time=end_time,
             amount=amount,
-            expires_at=datetime.now(ZoneInfo("Europe/Nicosia")) + timedelta(minutes=4)
+            expires_at=expires_at
         )
         db.session.add(pending_booking)
+        notify_booking_event(reservation_id, spot_id, booking_date, start_time, end_time)
         db.session.commit()
+        for held in purged:
+            clear_held(*held)
+        mark_held(parking_lot_id, spot_id, booking_date, start_time, end_time, expires_at)
         return True
+    except IntegrityError as e:
+        db.session.rollback()
+        if is_exclusion_violation(e):
+            raise SpotTakenError(f"Spot {spot_id} already held on {booking_date} {start_time}-{end_time}")
+        current_app.logger.error(f"Failed to store pending booking: {str(e)}")
+        return False
     except Exception as e:
         db.session.rollback()
         current_app.logger.error(f"Failed to store pending booking: {str(e)}")
@@ -31,8 +53,15 @@ def store_pending_booking(reservation_id, user_id, parking_lot_id, spot_id,
 def delete_pending_booking(reservation_id):
     """Delete from pending_bookings table"""
     try:
-        PendingBooking.query.filter_by(reservation_id=reservation_id).delete()
+        pending_booking = PendingBooking.query.filter_by(reservation_id=reservation_id).first()
+        if pending_booking is None:
+            return True
+
+        held = (pending_booking.parking_lot_id, pending_booking.spot_id, pending_booking.booking_date,
+                pending_booking.start_time, pending_booking.end_time)
+        db.session.delete(pending_booking)
         db.session.commit()
+        clear_held(*held)
         return True
     except Exception as e:
         db.session.rollback()
@@ -40,6 +69,47 @@ def delete_pending_booking(reservation_id):
         return False
 
 
+def purge_expired_holds(*criteria):
+    """Delete expired holds matching criteria in the current transaction.
+
+    Returns their (parking_lot_id, spot_id, booking_date, start_time, end_time) so the caller can clear
+    their held bits once it has committed"""
+    return db.session.execute(
+        delete(PendingBooking)
+        .where(PendingBooking.expires_at < datetime.now(), *criteria)
+        .returning(PendingBooking.parking_lot_id, PendingBooking.spot_id, PendingBooking.booking_date,
+                   PendingBooking.start_time, PendingBooking.end_time)
+        .execution_options(synchronize_session=False)
+    ).all()
+
+
+def find_conflicting_spots(parking_lot_id, booking_date, start_time, end_time, spot_id=None):
+    """Spots of a lot/date with a booking or an unexpired hold overlapping the window, in one statement.
+
+    Returns (booked_spot_ids, pending_spot_ids); spot_id narrows the check to a single spot"""
+    booked = select(Booking.spot_id, literal('booked').label('source')).where(
+        Booking.parking_lot_id == parking_lot_id,
+        Booking.bookingDate == booking_date,
+        Booking.startTime < end_time,
+        Booking.endTime > start_time
+    )
+    pending = select(PendingBooking.spot_id, literal('pending').label('source')).where(
+        PendingBooking.parking_lot_id == parking_lot_id,
+        PendingBooking.booking_date == booking_date,
+        PendingBooking.start_time < end_time,
+        PendingBooking.end_time > start_time,
+        PendingBooking.expires_at > datetime.now()
+    )
+    if spot_id is not None:
+        booked = booked.where(Booking.spot_id == spot_id)
+        pending = pending.where(PendingBooking.spot_id == spot_id)
+
+    booked_spot_ids, pending_spot_ids = set(), set()
+    for conflict_spot_id, source in db.session.execute(union_all(booked, pending)):
+        (booked_spot_ids if source == 'booked' else pending_spot_ids).add(conflict_spot_id)
+    return booked_spot_ids, pending_spot_ids
+
+
 # def get_pending_booking(reservation_id):
 #     """Retrieve pending booking data from database"""
 #     try:
@@ -0,0 +1,174 @@
+import time
+import logging
+import threading
+from collections import deque
+from booking.redis.redis_client_factory import create_redis_client
+from config import app
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Error rate is judged over this many seconds of reported calls, once there are at least MIN_CALLS of them
+ERROR_RATE_WINDOW_SECONDS = 10
+ERROR_RATE_MIN_CALLS = 20
+# Consecutive good probes a half-open circuit needs before it closes
+CLOSE_AFTER_PROBES = 2
+
+
+class RedisCircuitBreaker:
+    """Single source of truth for whether Redis may be used.
+
+    closed: Redis is used. A run of failed or slow PING probes, or a high error rate reported by callers,
+    opens the circuit. open: every caller takes its fallback path; after the cooldown the circuit turns
+    half-open. half_open: callers still fall back while probes test Redis; CLOSE_AFTER_PROBES good probes
+    close it, one bad probe reopens it."""
+
+    def __init__(self, probe_interval_ms, probe_timeout_ms, failure_threshold, error_rate, cooldown_ms):
+        self.probe_interval = probe_interval_ms / 1000
+        self.probe_timeout = probe_timeout_ms / 1000
+        self.failure_threshold = failure_threshold
+        self.error_rate = error_rate
+        self.cooldown = cooldown_ms / 1000
+
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.opened_at = None
+        self.consecutive_failures = 0
+        self.consecutive_successes = 0
+        self.calls = deque()  # (monotonic time, ok) reported by callers
+        self.transitions = 0
+        self.last_latency_ms = None
+        self.last_error = None
+        self.started = False
+        self.recovery_listeners = []
+
+    @property
+    def available(self):
+        return self.state == CLOSED
+
+    def add_recovery_listener(self, callback):
+        """Call callback() every time the circuit closes again after an outage"""
+        self.recovery_listeners.append(callback)
+
+    def record_success(self):
+        self._record_call(True)
+
+    def record_failure(self, error=None):
+        if error is not None:
+            self.last_error = str(error)
+        self._record_call(False)
+
+    def _record_call(self, ok):
+        now = time.monotonic()
+        with self.lock:
+            self.calls.append((now, ok))
+            while self.calls and self.calls[0][0] < now - ERROR_RATE_WINDOW_SECONDS:
+                self.calls.popleft()
+
+            if self.state != CLOSED or len(self.calls) < ERROR_RATE_MIN_CALLS:
+                return
+            failures = sum(1 for _, call_ok in self.calls if not call_ok)
+            if failures / len(self.calls) >= self.error_rate:
+                self._transition(OPEN, f"error rate {failures}/{len(self.calls)}")
+
+    def _record_probe(self, ok, latency_ms, error=None):
+        """Returns True when this probe closed the circuit"""
+        with self.lock:
+            self.last_latency_ms = latency_ms
+            if error is not None:
+                self.last_error = error
+
+            if ok:
+                self.consecutive_failures = 0
+                self.consecutive_successes += 1
+                if self.state == HALF_OPEN and self.consecutive_successes >= CLOSE_AFTER_PROBES:
+                    self._transition(CLOSED, f"{self.consecutive_successes} good probes")
+                    return True
+                return False
+
+            self.consecutive_successes = 0
+            self.consecutive_failures += 1
+            if self.state == HALF_OPEN:
+                self._transition(OPEN, f"probe failed in half-open: {error or f'{latency_ms:.0f}ms'}")
+            elif self.state == CLOSED and self.consecutive_failures >= self.failure_threshold:
+                self._transition(OPEN, f"{self.consecutive_failures} failed probes: {error or f'{latency_ms:.0f}ms'}")
+            return False
+
+    def _transition(self, state, reason):
+        """Must be called with self.lock held"""
+        logger.warning(f"Redis circuit {self.state} -> {state} ({reason})")
+        self.state = state
+        self.transitions += 1
+        self.consecutive_failures = 0
+        self.consecutive_successes = 0
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+        if state == CLOSED:
+            self.calls.clear()
+
+    def start(self):
+        """Start the background probe thread (once per process)"""
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        thread = threading.Thread(target=self._probe_loop, daemon=True)
+        thread.start()
+        logger.info("Redis circuit breaker probes started")
+
+    def _probe_loop(self):
+        # Own single-connection client so probes never queue behind application traffic in the shared pool
+        probe_client = create_redis_client(app.config['REDIS_URL'], max_connections=1, pool_timeout=self.probe_timeout,
+                                           socket_timeout=self.probe_timeout,
+                                           socket_connect_timeout=self.probe_timeout)
+        while True:
+            with self.lock:
+                if self.state == OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                    self._transition(HALF_OPEN, "cooldown elapsed")
+
+            started = time.monotonic()
+            try:
+                probe_client.ping()
+                latency_ms = (time.monotonic() - started) * 1000
+                closed = self._record_probe(latency_ms <= self.probe_timeout * 1000, latency_ms)
+            except Exception as e:
+                closed = self._record_probe(False, (time.monotonic() - started) * 1000, str(e))
+
+            if closed:
+                self._notify_recovery()
+
+            time.sleep(self.probe_interval)
+
+    def _notify_recovery(self):
+        # Outside the lock: listeners talk to Redis and may report calls back to the breaker
+        for callback in self.recovery_listeners:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Redis recovery listener {getattr(callback, '__name__', callback)} failed: {e}")
+
+    def snapshot(self):
+        with self.lock:
+            failures = sum(1 for _, ok in self.calls if not ok)
+            return {
+                'state': self.state,
+                'transitions': self.transitions,
+                'consecutive_probe_failures': self.consecutive_failures,
+                'last_probe_latency_ms': self.last_latency_ms,
+                'recent_calls': len(self.calls),
+                'recent_failures': failures,
+                'last_error': self.last_error
+            }
+
+
+# Global instance
+redis_circuit = RedisCircuitBreaker(
+    app.config['REDIS_PROBE_INTERVAL_MS'],
+    app.config['REDIS_PROBE_TIMEOUT_MS'],
+    app.config['REDIS_CIRCUIT_FAILURE_THRESHOLD'],
+    app.config['REDIS_CIRCUIT_ERROR_RATE'],
+    app.config['REDIS_CIRCUIT_COOLDOWN_MS']
+)
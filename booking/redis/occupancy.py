@@ -0,0 +1,130 @@
+import math
+import logging
+from datetime import datetime
+from booking.redis.circuit_breaker import redis_circuit
+from booking.redis.redis_utils import redis_lot_snapshot, redis_occupancy_update, redis_delete, occupancy_key
+from booking.utils import time_to_minutes
+from config import app, redis_client, Booking, PendingBooking
+
+logger = logging.getLogger(__name__)
+
+# One bit per 15 minute slot of the day, slot i in byte i // 8 (most significant bit first)
+SLOT_MINUTES = 15
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+
+
+def slot_mask(start_time, end_time):
+    """Bitmap of the slots a start_time-end_time window touches"""
+    mask = bytearray(SLOTS_PER_DAY // 8)
+    first_slot = time_to_minutes(start_time) // SLOT_MINUTES
+    last_slot = -(-time_to_minutes(end_time) // SLOT_MINUTES)
+    for slot in range(first_slot, min(last_slot, SLOTS_PER_DAY)):
+        mask[slot // 8] |= 0x80 >> (slot % 8)
+    return bytes(mask)
+
+
+def rebuild_occupancy(parking_lot_id, booking_date):
+    """Load confirmed and unexpired pending bookings of a lot/date into its bitmaps"""
+    fields = {}
+
+    def add(field, start_time, end_time):
+        mask = slot_mask(start_time, end_time)
+        current = fields.get(field)
+        fields[field] = mask if current is None else bytes(a | b for a, b in zip(current, mask))
+
+    bookings = Booking.query.filter(
+        Booking.parking_lot_id == parking_lot_id,
+        Booking.bookingDate == booking_date
+    ).with_entities(Booking.spot_id, Booking.startTime, Booking.endTime).all()
+    for spot_id, start_time, end_time in bookings:
+        add(str(spot_id), start_time, end_time)
+
+    now = datetime.now()
+    pending = PendingBooking.query.filter(
+        PendingBooking.parking_lot_id == parking_lot_id,
+        PendingBooking.booking_date == booking_date,
+        PendingBooking.expires_at > now
+    ).with_entities(PendingBooking.spot_id, PendingBooking.start_time, PendingBooking.end_time,
+                    PendingBooking.expires_at).all()
+    for spot_id, start_time, end_time, _ in pending:
+        add(f"held:{spot_id}", start_time, end_time)
+
+    # Held bits are only cleared by explicit releases; expire the bitmaps with the first hold so a lapsed
+    # hold can't keep showing its spot as taken
+    ttl = app.config['OCCUPANCY_BITMAP_TTL']
+    if pending:
+        ttl = min(ttl, hold_ttl(min(expires_at for _, _, _, _, expires_at in pending)))
+
+    logger.info(f"Rebuilt occupancy for lot {parking_lot_id} on {booking_date}: "
+                f"{len(bookings)} bookings, {len(pending)} pending")
+    return redis_occupancy_update(redis_client, parking_lot_id, booking_date, 'rebuild', fields, ttl)
+
+
+def hold_ttl(expires_at):
+    """Whole seconds (at least 1) until a hold expires"""
+    remaining = (expires_at - datetime.now(expires_at.tzinfo)).total_seconds()
+    return max(math.ceil(remaining), 1)
+
+
+def _update(parking_lot_id, booking_date, mode, fields, ttl=0):
+    # A write that didn't land leaves the bitmaps wrong; drop them so the next read rebuilds from the database
+    if redis_occupancy_update(redis_client, parking_lot_id, booking_date, mode, fields, ttl):
+        return True
+    invalidate_occupancy(parking_lot_id, booking_date)
+    return False
+
+
+def mark_booked(parking_lot_id, spot_id, booking_date, start_time, end_time):
+    return _update(parking_lot_id, booking_date, 'set', {str(spot_id): slot_mask(start_time, end_time)})
+
+
+def mark_held(parking_lot_id, spot_id, booking_date, start_time, end_time, expires_at):
+    """Set a hold's bits; the bitmaps expire no later than the hold does"""
+    return _update(parking_lot_id, booking_date, 'set', {f"held:{spot_id}": slot_mask(start_time, end_time)},
+                   hold_ttl(expires_at))
+
+
+def clear_held(parking_lot_id, spot_id, booking_date, start_time, end_time):
+    return _update(parking_lot_id, booking_date, 'clear', {f"held:{spot_id}": slot_mask(start_time, end_time)})
+
+
+def invalidate_occupancy(parking_lot_id, booking_date):
+    """Force the next availability read of a lot/date to rebuild from the database"""
+    return redis_delete(redis_client, occupancy_key(parking_lot_id, booking_date))
+
+
+def invalidate_all_occupancy():
+    """Drop every lot/date's bitmaps. Writes made while Redis was unreachable were lost, so after an outage
+    none of them can be trusted (a rebuild ORs into existing bits and would keep stale ones)"""
+    deleted = 0
+    batch = []
+    for key in redis_client.scan_iter(match='occupancy:*', count=500):
+        batch.append(key)
+        if len(batch) >= 500:
+            deleted += redis_client.delete(*batch)
+            batch = []
+    if batch:
+        deleted += redis_client.delete(*batch)
+    logger.info(f"Invalidated {deleted} occupancy bitmaps after Redis recovery")
+    return deleted
+
+
+def lot_availability(parking_lot_id, booking_date, start_time, end_time):
+    """(leased, booked, held) spot id sets overlapping the window, or None if Redis can't answer"""
+    start_minutes = time_to_minutes(start_time)
+    end_minutes = time_to_minutes(end_time)
+    mask = slot_mask(start_time, end_time)
+
+    snapshot = redis_lot_snapshot(redis_client, parking_lot_id, booking_date, start_minutes, end_minutes, mask)
+    if snapshot is False and rebuild_occupancy(parking_lot_id, booking_date):
+        snapshot = redis_lot_snapshot(redis_client, parking_lot_id, booking_date, start_minutes, end_minutes, mask)
+
+    # None means the snapshot itself failed; feed that to the breaker's error rate
+    if snapshot is None:
+        redis_circuit.record_failure()
+    else:
+        redis_circuit.record_success()
+    return snapshot or None
+
+
+redis_circuit.add_recovery_listener(invalidate_all_occupancy)
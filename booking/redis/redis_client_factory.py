@@ -0,0 +1,40 @@
+import redis
+
+# Shared by every connection the app opens, including the Socket.IO manager's
+CONNECTION_OPTIONS = {
+    'socket_connect_timeout': 2,
+    'socket_keepalive': True,
+    'health_check_interval': 30,
+}
+
+
+def create_redis_client(url, max_connections=50, pool_timeout=2, socket_timeout=2, socket_connect_timeout=None):
+    """Redis client on a bounded, blocking (greenlet-safe under eventlet) connection pool.
+
+    Callers wait up to pool_timeout seconds for a free connection instead of opening new ones.
+    Server-invalidated caching of read-mostly keys lives in booking/redis/tracked_cache.py.
+    """
+    connection_kwargs = dict(CONNECTION_OPTIONS, socket_timeout=socket_timeout)
+    if socket_connect_timeout is not None:
+        connection_kwargs['socket_connect_timeout'] = socket_connect_timeout
+
+    pool = redis.BlockingConnectionPool.from_url(
+        url,
+        max_connections=max_connections,
+        timeout=pool_timeout,
+        **connection_kwargs
+    )
+    return redis.Redis(connection_pool=pool)
+
+
+def redis_pool_stats(client):
+    """Connection pool usage of a client created by create_redis_client"""
+    pool = client.connection_pool
+    created = len(getattr(pool, '_connections', []))
+    idle = sum(1 for connection in list(pool.pool.queue) if connection is not None)
+    return {
+        'max_connections': pool.max_connections,
+        'created': created,
+        'in_use': created - idle,
+        'idle': idle
+    }
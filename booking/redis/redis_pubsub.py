@@ -1,9 +1,14 @@
+import json
 import threading
 import redis
+from datetime import datetime
 from flask import current_app
 from config import redis_client
-from booking.utils import emit_to_relevant_rooms_about_booking
-from config import ParkingSpot, app
+from booking.redis.redis_client_factory import create_redis_client
+from booking.redis.redis_utils import redis_delete_lease
+from booking.catalog.catalog_cache import catalog_cache, handle_catalog_invalidation, CATALOG_INVALIDATION_CHANNEL
+from booking.emit_utils.emit import emit_to_relevant_rooms_about_booking
+from config import app
 
 
 def start_redis_expiration_listener():
@@ -25,7 +30,8 @@ def start_redis_expiration_listener():
 
                 # Create a new connection for pub/sub
                 try:
-                    pubsub_redis = redis.from_url(current_app.config['REDIS_URL'])
+                    # Dedicated connection without a read timeout - listen() blocks between events
+                    pubsub_redis = create_redis_client(current_app.config['REDIS_URL'], max_connections=1, socket_timeout=None)
                     pubsub = pubsub_redis.pubsub()
                 except redis.exceptions.ConnectionError:
                     app.logger.warning("Redis unavailable - expiration listener paused")
@@ -35,38 +41,49 @@ def start_redis_expiration_listener():
                 pubsub.psubscribe('__keyevent@0__:expired')
                 app.logger.info("Subscribed to Redis expiry events")
 
+                # Admin edits on any instance drop cached catalog records here
+                pubsub.subscribe(CATALOG_INVALIDATION_CHANNEL)
+
                 app.logger.info("Redis expiration listener started")
 
                 for message in pubsub.listen():
-                    if message['type'] == 'pmessage':
+                    if message['type'] == 'message':
+                        handle_catalog_invalidation(json.loads(message['data']))
+
+                    elif message['type'] == 'pmessage':
                         expired_key = message['data'].decode('utf-8')
                         app.logger.info(f"Received expiry event: {expired_key}")
 
-                        if expired_key.startswith('spot_lease:'):
-                            # Extract spot_id and date from key: spot_lease:{spot_id}_{date}
+                        if expired_key.startswith('lease_expiry:'):
+                            # lease_expiry:{lot}:{date}:{spot_id}:{reservation_id}
                             key_parts = expired_key.split(':')
-                            if len(key_parts) < 2:
+                            if len(key_parts) != 5:
                                 continue
 
-                            spot_date_parts = key_parts[1].split('_')
-                            if len(spot_date_parts) < 2:
-                                continue
+                            _, parking_lot_id, booking_date, spot_id, reservation_id = key_parts
 
-                            spot_id = spot_date_parts[0]
-                            booking_date = '_'.join(spot_date_parts[1:])
+                            app.logger.info(f"Lease {reservation_id} expired for spot {spot_id} on {booking_date}")
 
-                            app.logger.info(f"Lease expired for spot {spot_id} on {booking_date}")
+                            # Drop the expired window; only that window is freed, other leases on the spot stay
+                            window = redis_delete_lease(redis_client, reservation_id, parking_lot_id, spot_id,
+                                                        booking_date)
+                            # Every instance hears the expiry; only the one whose delete found the lease announces it
+                            if window is None:
+                                continue
+                            start_time, end_time = (datetime.strptime(t, '%H:%M').time() for t in window)
 
                             # Get the spot from database
                             with app.app_context():
-                                spot = ParkingSpot.query.get(spot_id)
+                                spot = catalog_cache.get_spot(spot_id)
                                 if spot:
                                     # Emit update that spot is now available
                                     emit_to_relevant_rooms_about_booking(
                                         spot,
                                         booking_date,
                                         True,
-                                        False
+                                        False,
+                                        start_time,
+                                        end_time
                                     )
                                     app.logger.info(f"Emitted expiry update for spot {spot_id}")
                                 else:
@@ -1,8 +1,11 @@
 import json
+import logging
 import redis
 
 from config import redis_client
 
+logger = logging.getLogger(__name__)
+
 
 def redis_health_check(redis_client):
     try:
@@ -11,100 +14,581 @@ def redis_health_check(redis_client):
         return False
 
 
-LEASE_ACQUIRE_SCRIPT = """
-return redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2])
+def lease_index_key(parking_lot_id, booking_date):
+    """Per lot/date index of held leases: field = reservation_id, value = spot|start|end|expires_at"""
+    return f"lease_idx:{parking_lot_id}:{booking_date}"
+
+
+def spot_lease_key(spot_id, booking_date):
+    """Per spot/date hash of held windows: field = reservation_id, value = start|end|expires_at"""
+    return f"spot_lease:{spot_id}_{booking_date}"
+
+
+def lease_expiry_key(parking_lot_id, booking_date, spot_id, reservation_id):
+    """Expires with its lease; the key name tells the expiry listener which window was freed"""
+    return f"lease_expiry:{parking_lot_id}:{booking_date}:{spot_id}:{reservation_id}"
+
+
+def _lease_keys(reservation_id, parking_lot_id, spot_id, booking_date):
+    return [
+        spot_lease_key(spot_id, booking_date),
+        lease_index_key(parking_lot_id, booking_date),
+        lease_expiry_key(parking_lot_id, booking_date, spot_id, reservation_id)
+    ]
+
+
+# KEYS[1] = spot_lease:{spot}_{date}, KEYS[2] = lease_idx:{lot}:{date}, KEYS[3] = conn:{sid}
+# ARGV = new reservation_id, ttl, spot_id, start 'HH:MM', end 'HH:MM', parking_lot_id, booking_date, user_id,
+#        created_at, lease metadata ttl
+# The socket's current reservation is reused: if it already holds this window it is returned as 'existing',
+# otherwise its old window is released once the new one is secured (unless it is mid-payment).
+# Returns {'taken'}, {'existing', reservation_id} or {'acquired', reservation_id[, released spot, date, start, end]}
+LEASE_RESERVE_SCRIPT = """
+local function minutes(hhmm)
+  local h, m = string.match(hhmm, '^(%d+):(%d+)$')
+  return tonumber(h) * 60 + tonumber(m)
+end
+
+local now = tonumber(redis.call('TIME')[1])
+local ttl = tonumber(ARGV[2])
+
+local reservation_id = redis.call('HGET', KEYS[3], 'reservation_id')
+local held = {}
+if reservation_id then
+  held = redis.call('HMGET', 'lease_data:' .. reservation_id,
+                    'spot_id', 'booking_date', 'parking_lot_id', 'start_time', 'end_time', 'payment_context')
+  if held[1] == ARGV[3] and held[2] == ARGV[7] and held[4] == ARGV[4] and held[5] == ARGV[5] then
+    local window = redis.call('HGET', KEYS[1], reservation_id)
+    local expires_at = window and tonumber(string.match(window, '|(%d+)$'))
+    if expires_at and expires_at > now then
+      return {'existing', reservation_id}
+    end
+  end
+  if held[6] then
+    -- That lease is paying: leave it alone and reserve under a new id
+    reservation_id = false
+    held = {}
+  end
+end
+reservation_id = reservation_id or ARGV[1]
+
+local requested_start = minutes(ARGV[4])
+local requested_end = minutes(ARGV[5])
+local latest = now + ttl
+local windows = redis.call('HGETALL', KEYS[1])
+for i = 1, #windows, 2 do
+  local lease_start, lease_end, expires_at = string.match(windows[i + 1], '^([%d:]+)|([%d:]+)|(%d+)$')
+  expires_at = tonumber(expires_at)
+  if expires_at <= now then
+    redis.call('HDEL', KEYS[1], windows[i])
+    redis.call('HDEL', KEYS[2], windows[i])
+  elseif windows[i] ~= reservation_id then
+    if requested_start < minutes(lease_end) and requested_end > minutes(lease_start) then
+      return {'taken'}
+    end
+    latest = math.max(latest, expires_at)
+  end
+end
+
+-- One lease per socket: drop the window this reservation held before
+local released = {}
+if held[1] then
+  redis.call('HDEL', 'spot_lease:' .. held[1] .. '_' .. held[2], reservation_id)
+  redis.call('HDEL', 'lease_idx:' .. held[3] .. ':' .. held[2], reservation_id)
+  redis.call('DEL', 'lease_expiry:' .. held[3] .. ':' .. held[2] .. ':' .. held[1] .. ':' .. reservation_id)
+  if held[1] ~= ARGV[3] or held[2] ~= ARGV[7] or held[4] ~= ARGV[4] or held[5] ~= ARGV[5] then
+    released = {held[1], held[2], held[4], held[5]}
+  end
+end
+
+local window = ARGV[4] .. '|' .. ARGV[5] .. '|' .. (now + ttl)
+redis.call('HSET', KEYS[1], reservation_id, window)
+redis.call('EXPIRE', KEYS[1], latest - now)
+redis.call('HSET', KEYS[2], reservation_id, ARGV[3] .. '|' .. window)
+if redis.call('TTL', KEYS[2]) < ttl then
+  redis.call('EXPIRE', KEYS[2], ttl)
+end
+redis.call('SET', 'lease_expiry:' .. ARGV[6] .. ':' .. ARGV[7] .. ':' .. ARGV[3] .. ':' .. reservation_id,
+           reservation_id, 'EX', ttl)
+
+local lease_data_key = 'lease_data:' .. reservation_id
+redis.call('DEL', lease_data_key)
+redis.call('HSET', lease_data_key, 'user_id', ARGV[8], 'spot_id', ARGV[3], 'parking_lot_id', ARGV[6],
+           'booking_date', ARGV[7], 'start_time', ARGV[4], 'end_time', ARGV[5], 'created_at', ARGV[9])
+redis.call('EXPIRE', lease_data_key, ARGV[10])
+
+if redis.call('EXISTS', KEYS[3]) == 1 then
+  redis.call('HSET', KEYS[3], 'reservation_id', reservation_id)
+end
+
+return {'acquired', reservation_id, unpack(released)}
+"""
+
+def occupancy_key(parking_lot_id, booking_date):
+    """Per lot/date slot bitmaps: field = spot_id (bookings) or held:{spot_id} (pending bookings), plus 'built'"""
+    return f"occupancy:{parking_lot_id}:{booking_date}"
+
+
+# KEYS[1] = lease_idx:{lot}:{date}, KEYS[2] = occupancy:{lot}:{date}
+# ARGV = requested start minute, requested end minute, requested slot mask
+# Returns false until the occupancy bitmaps have been built from the database
+LOT_SNAPSHOT_SCRIPT = """
+if redis.call('HEXISTS', KEYS[2], 'built') == 0 then
+  return false
+end
+
+local now = tonumber(redis.call('TIME')[1])
+local requested_start = tonumber(ARGV[1])
+local requested_end = tonumber(ARGV[2])
+local entries = redis.call('HGETALL', KEYS[1])
+local leased = {}
+for i = 1, #entries, 2 do
+  local spot, sh, sm, eh, em, expires_at = string.match(entries[i + 1], '^(%d+)|(%d+):(%d+)|(%d+):(%d+)|(%d+)$')
+  if expires_at and tonumber(expires_at) > now then
+    local lease_start = tonumber(sh) * 60 + tonumber(sm)
+    local lease_end = tonumber(eh) * 60 + tonumber(em)
+    if requested_start < lease_end and requested_end > lease_start then
+      leased[#leased + 1] = spot
+    end
+  elseif expires_at then
+    redis.call('HDEL', KEYS[1], entries[i])
+  end
+end
+
+local booked, held = {}, {}
+local bitmaps = redis.call('HGETALL', KEYS[2])
+for i = 1, #bitmaps, 2 do
+  local field, slots = bitmaps[i], bitmaps[i + 1]
+  if field ~= 'built' then
+    for j = 1, #ARGV[3] do
+      if bit.band(string.byte(slots, j) or 0, string.byte(ARGV[3], j)) ~= 0 then
+        if string.sub(field, 1, 5) == 'held:' then
+          held[#held + 1] = string.sub(field, 6)
+        else
+          booked[#booked + 1] = field
+        end
+        break
+      end
+    end
+  end
+end
+
+return {leased, booked, held}
 """
 
-LEASE_RENEW_SCRIPT = """
-if redis.call('GET', KEYS[1]) == ARGV[1] then
-  return redis.call('EXPIRE', KEYS[1], ARGV[2])
+# KEYS[1] = occupancy:{lot}:{date}
+# ARGV = 'set' | 'clear' | 'rebuild', ttl, then field / slot mask pairs
+# 'rebuild' ORs database state into whatever concurrent writers already set, then marks the bitmaps built
+OCCUPANCY_UPDATE_SCRIPT = """
+for i = 3, #ARGV, 2 do
+  local current = redis.call('HGET', KEYS[1], ARGV[i]) or ''
+  local mask = ARGV[i + 1]
+  local updated = {}
+  for j = 1, #mask do
+    local byte = string.byte(current, j) or 0
+    if ARGV[1] == 'clear' then
+      byte = bit.band(byte, 255 - string.byte(mask, j))
+    else
+      byte = bit.bor(byte, string.byte(mask, j))
+    end
+    updated[j] = string.char(byte)
+  end
+  redis.call('HSET', KEYS[1], ARGV[i], table.concat(updated))
 end
-return 0
+
+if ARGV[1] == 'rebuild' then
+  redis.call('HSET', KEYS[1], 'built', 1)
+  redis.call('EXPIRE', KEYS[1], ARGV[2])
+elseif tonumber(ARGV[2]) > 0 then
+  -- Only ever shortens the TTL: a hold's bits must not outlive the hold
+  local remaining = redis.call('TTL', KEYS[1])
+  if remaining < 0 or remaining > tonumber(ARGV[2]) then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+  end
+end
+return 1
 """
 
+# KEYS[1] = spot_lease:{spot}_{date}, KEYS[2] = lease_idx:{lot}:{date}, KEYS[3] = lease_expiry:...,
+# KEYS[4] = lease_data:{reservation_id}
+# ARGV = reservation_id, user_id, spot_id, start 'HH:MM', end 'HH:MM', ttl
+# Checks the window is still held by this reservation for this user, spot and time, then makes sure it
+# outlives the booking transaction by at least ttl seconds.
+# Returns 'ok', 'expired' (window gone), 'missing' (no lease metadata) or 'mismatch'
+LEASE_VALIDATE_SCRIPT = """
+local window = redis.call('HGET', KEYS[1], ARGV[1])
+local now = tonumber(redis.call('TIME')[1])
+local times, expires_at
+if window then
+  times, expires_at = string.match(window, '^(.*)|(%d+)$')
+end
+if not expires_at or tonumber(expires_at) <= now then
+  return 'expired'
+end
+
+local lease = redis.call('HMGET', KEYS[4], 'user_id', 'spot_id', 'start_time', 'end_time')
+if not lease[1] then
+  return 'missing'
+end
+if lease[1] ~= ARGV[2] or lease[2] ~= ARGV[3] or lease[3] ~= ARGV[4] or lease[4] ~= ARGV[5] then
+  return 'mismatch'
+end
+
+local ttl = tonumber(ARGV[6])
+if tonumber(expires_at) < now + ttl then
+  local extended_until = now + ttl
+  redis.call('HSET', KEYS[1], ARGV[1], times .. '|' .. extended_until)
+  if redis.call('TTL', KEYS[1]) < ttl then
+    redis.call('EXPIRE', KEYS[1], ttl)
+  end
+  local entry = redis.call('HGET', KEYS[2], ARGV[1])
+  if entry then
+    redis.call('HSET', KEYS[2], ARGV[1], string.match(entry, '^(.*)|%d+$') .. '|' .. extended_until)
+    if redis.call('TTL', KEYS[2]) < ttl then
+      redis.call('EXPIRE', KEYS[2], ttl)
+    end
+  end
+  redis.call('SET', KEYS[3], ARGV[1], 'EX', ttl)
+end
+if redis.call('TTL', KEYS[4]) < ttl then
+  redis.call('EXPIRE', KEYS[4], ttl)
+end
+return 'ok'
+"""
+
+# KEYS[1] = spot_lease:{spot}_{date}, KEYS[2] = lease_idx:{lot}:{date}, KEYS[3] = lease_expiry:...,
+# KEYS[4] = lease_data:{reservation_id}, KEYS[5] = occupancy:{lot}:{date}
+# ARGV = reservation_id, spot_id, booked slot mask
+# After the booking committed: drop the lease and its metadata and mark the slots booked, if the bitmaps are built
+# (unbuilt bitmaps pick the booking up from the database on their next rebuild)
+LEASE_CONSUME_SCRIPT = """
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('DEL', KEYS[3], KEYS[4])
+
+if redis.call('HEXISTS', KEYS[5], 'built') == 1 then
+  local current = redis.call('HGET', KEYS[5], ARGV[2]) or ''
+  local updated = {}
+  for j = 1, #ARGV[3] do
+    updated[j] = string.char(bit.bor(string.byte(current, j) or 0, string.byte(ARGV[3], j)))
+  end
+  redis.call('HSET', KEYS[5], ARGV[2], table.concat(updated))
+end
+return 1
+"""
+
+# KEYS[1] = spot_lease:{spot}_{date}, KEYS[2] = lease_idx:{lot}:{date}, KEYS[3] = lease_expiry:...
+# ARGV = reservation_id, '1' to also drop lease_data:{reservation_id}
+# Returns the released 'start|end|expires_at' window, or false if the reservation held none
 LEASE_DELETE_SCRIPT = """
-if redis.call('GET', KEYS[1]) == ARGV[1] then
-  return redis.call('DEL', KEYS[1])
+local window = redis.call('HGET', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('DEL', KEYS[3])
+if ARGV[2] == '1' then
+  redis.call('DEL', 'lease_data:' .. ARGV[1])
 end
-return 0
+return window
 """
 
-# ADD THIS NEW LUA SCRIPT FOR SAFE RELEASE
-LEASE_SAFE_RELEASE_SCRIPT = """
-if redis.call('GET', KEYS[1]) == ARGV[1] then
-    redis.call('DEL', KEYS[1])
-    redis.call('DEL', 'lease_data:' .. ARGV[1])
-    return 1
-else
-    return 0
+
+# Connections not refreshed by a heartbeat within this window are expired by Redis
+CONNECTION_TTL = 120
+
+
+def conn_key(sid):
+    """Per-socket hash: user_id, connected_at, parkingLotId, bookingDate, startTime, endTime, reservation_id"""
+    return f"conn:{sid}"
+
+
+def room_members_key(room):
+    """Sorted set of the sids in a room, scored by the millisecond time their last heartbeat runs out.
+
+    A sid whose pod died without a disconnect stops being refreshed and drops out of the count, and the
+    key itself expires once no member refreshes it."""
+    return f"room_members:{room}"
+
+
+# Sets now_ms to the server's clock, so every pod scores heartbeats on the same clock
+REDIS_NOW_MS = """
+local clock = redis.call('TIME')
+local now_ms = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+"""
+
+# KEYS[1] = conn:{sid}, KEYS[2] = sid_rooms:{sid}
+# ARGV = sid, room, lot prefix, parkingLotId, bookingDate, startTime, endTime, ttl
+ROOM_JOIN_SCRIPT = REDIS_NOW_MS + """
+local ttl = tonumber(ARGV[8])
+local left = {}
+for _, room in ipairs(redis.call('SMEMBERS', KEYS[2])) do
+  if room ~= ARGV[2] and string.sub(room, 1, #ARGV[3]) == ARGV[3] then
+    redis.call('ZREM', 'room_members:' .. room, ARGV[1])
+    redis.call('SREM', KEYS[2], room)
+    left[#left + 1] = room
+  end
 end
+local members = 'room_members:' .. ARGV[2]
+redis.call('ZREMRANGEBYSCORE', members, '-inf', now_ms)
+redis.call('ZADD', members, now_ms + ttl * 1000, ARGV[1])
+redis.call('EXPIRE', members, ttl)
+redis.call('SADD', KEYS[2], ARGV[2])
+redis.call('EXPIRE', KEYS[2], ttl)
+
+redis.call('HSET', KEYS[1], 'parkingLotId', ARGV[4], 'bookingDate', ARGV[5], 'startTime', ARGV[6], 'endTime', ARGV[7])
+redis.call('EXPIRE', KEYS[1], ttl)
+
+return {left, redis.call('SMEMBERS', KEYS[2])}
+"""
+
+# KEYS[1] = conn:{sid}, KEYS[2] = sid_rooms:{sid}
+# ARGV = sid
+ROOM_LEAVE_SCRIPT = """
+local left = redis.call('SMEMBERS', KEYS[2])
+for _, room in ipairs(left) do
+  redis.call('ZREM', 'room_members:' .. room, ARGV[1])
+end
+redis.call('DEL', KEYS[2])
+
+local conn = redis.call('HGETALL', KEYS[1])
+local user_id = redis.call('HGET', KEYS[1], 'user_id')
+if user_id and user_id ~= 'anonymous' then
+  redis.call('SREM', 'user_sockets:' .. user_id, ARGV[1])
+end
+redis.call('DEL', KEYS[1])
+
+return {conn, left}
+"""
+
+# KEYS[1] = conn:{sid}, KEYS[2] = sid_rooms:{sid}, KEYS[3] = user_sockets:{user_id} (authenticated sockets only)
+# ARGV = sid, ttl
+CONNECTION_REFRESH_SCRIPT = REDIS_NOW_MS + """
+local ttl = tonumber(ARGV[2])
+local alive = redis.call('EXPIRE', KEYS[1], ttl)
+if KEYS[3] then
+  redis.call('EXPIRE', KEYS[3], ttl)
+end
+if redis.call('EXPIRE', KEYS[2], ttl) == 1 then
+  for _, room in ipairs(redis.call('SMEMBERS', KEYS[2])) do
+    redis.call('ZADD', 'room_members:' .. room, now_ms + ttl * 1000, ARGV[1])
+    redis.call('EXPIRE', 'room_members:' .. room, ttl)
+  end
+end
+return alive
+"""
+
+# KEYS[1] = room_members:{room}
+ROOM_SIZE_SCRIPT = REDIS_NOW_MS + """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now_ms)
+return redis.call('ZCARD', KEYS[1])
 """
 
 
 def init_redis_scripts(redis_client, app):
-    global lease_acquire_script, lease_renew_script, lease_delete_script, lease_safe_release_script
+    global lease_reserve_script, lot_snapshot_script, lease_validate_script, lease_consume_script
+    global lease_delete_script
+    global room_join_script, room_leave_script, connection_refresh_script, room_size_script, occupancy_update_script
     try:
-        lease_acquire_script = redis_client.register_script(LEASE_ACQUIRE_SCRIPT)
-        lease_renew_script = redis_client.register_script(LEASE_RENEW_SCRIPT)
+        lease_reserve_script = redis_client.register_script(LEASE_RESERVE_SCRIPT)
+        lot_snapshot_script = redis_client.register_script(LOT_SNAPSHOT_SCRIPT)
+        occupancy_update_script = redis_client.register_script(OCCUPANCY_UPDATE_SCRIPT)
+        lease_validate_script = redis_client.register_script(LEASE_VALIDATE_SCRIPT)
+        lease_consume_script = redis_client.register_script(LEASE_CONSUME_SCRIPT)
         lease_delete_script = redis_client.register_script(LEASE_DELETE_SCRIPT)
-        lease_safe_release_script = redis_client.register_script(LEASE_SAFE_RELEASE_SCRIPT)
+        room_join_script = redis_client.register_script(ROOM_JOIN_SCRIPT)
+        room_leave_script = redis_client.register_script(ROOM_LEAVE_SCRIPT)
+        connection_refresh_script = redis_client.register_script(CONNECTION_REFRESH_SCRIPT)
+        room_size_script = redis_client.register_script(ROOM_SIZE_SCRIPT)
         app.logger.info("Redis scripts registered successfully")
     except Exception as e:
         app.logger.error(f"Failed to register Redis scripts: {str(e)}")
         raise
 
 
-def redis_acquire_lease(redis_client, key, value, ttl):
+def redis_reserve_lease(redis_client, sid, reservation_id, parking_lot_id, spot_id, booking_date, start_time,
+                        end_time, user_id, created_at, ttl):
+    """Reserve start_time-end_time ('HH:MM') of a spot/date for a socket in one EVALSHA: reuse or replace the
+    socket's reservation, acquire the window, write lease_data and record the reservation on conn:{sid}.
+
+    Returns (status, reservation_id, released) where status is 'acquired', 'existing' or 'taken' and released
+    is the (spot_id, booking_date, start, end) window the socket gave up, if any. None on a script error;
+    connection errors and timeouts are raised so the caller can retry or fall back to direct booking."""
     try:
-        print(f"   Redis SET {key} {value} NX EX {ttl}")
-        result = lease_acquire_script(keys=[key], args=[value, ttl])
-        print(f"   Redis SET result: {result}")
-        if result is None:
-            return False
-        elif result == b'OK' or result == 'OK':
-            return True
-        else:
-            print(f"Unexpected Redis response: {result}")
-            return False
+        result = lease_reserve_script(
+            keys=[spot_lease_key(spot_id, booking_date), lease_index_key(parking_lot_id, booking_date), conn_key(sid)],
+            args=[reservation_id, ttl, spot_id, start_time, end_time, parking_lot_id, booking_date, user_id,
+                  created_at, ttl + 60]
+        )
+    except (redis.ConnectionError, redis.TimeoutError):
+        raise
+    except redis.RedisError as e:
+        logger.error(f"Redis lease reserve error for spot {spot_id} on {booking_date}: {str(e)}")
+        return None
+
+    result = [value.decode('utf-8') for value in result]
+    status = result[0]
+    reservation_id = result[1] if len(result) > 1 else None
+    released = tuple(result[2:6]) if len(result) > 2 else None
+    return status, reservation_id, released
+
+
+def redis_validate_lease(redis_client, reservation_id, parking_lot_id, spot_id, booking_date, user_id, start_time,
+                         end_time, ttl):
+    """Check the reservation still holds the window for this user and extend it by ttl; one EVALSHA.
+
+    Returns 'ok', 'expired', 'missing' or 'mismatch', or None on error."""
+    keys = _lease_keys(reservation_id, parking_lot_id, spot_id, booking_date) + [f"lease_data:{reservation_id}"]
+    try:
+        result = lease_validate_script(keys=keys, args=[reservation_id, user_id, spot_id, start_time, end_time, ttl])
+        return result.decode('utf-8')
+    except redis.RedisError as e:
+        logger.error(f"Redis lease validate error for reservation {reservation_id}: {str(e)}")
+        return None
+
+
+def redis_consume_lease(redis_client, reservation_id, parking_lot_id, spot_id, booking_date, booked_mask):
+    """Drop a confirmed reservation's lease and metadata and set its booked slots in the occupancy bitmaps"""
+    keys = _lease_keys(reservation_id, parking_lot_id, spot_id, booking_date) + [
+        f"lease_data:{reservation_id}", occupancy_key(parking_lot_id, booking_date)
+    ]
+    try:
+        return lease_consume_script(keys=keys, args=[reservation_id, spot_id, booked_mask]) == 1
     except redis.RedisError as e:
-        print(f"Redis lease acquire error for key {key}: {str(e)}")
+        logger.error(f"Redis lease consume error for reservation {reservation_id}: {str(e)}")
         return False
 
 
-def redis_renew_lease(redis_client, key, value, ttl):
+def redis_delete_lease(redis_client, reservation_id, parking_lot_id, spot_id, booking_date):
+    """Release the reservation's window; returns its (start, end) 'HH:MM' strings, or None if none was held"""
     try:
-        return lease_renew_script(keys=[key], args=[value, ttl]) == 1
+        window = lease_delete_script(
+            keys=_lease_keys(reservation_id, parking_lot_id, spot_id, booking_date), args=[reservation_id, '0']
+        )
     except redis.RedisError as e:
-        print(f"Redis lease renew error for key {key}: {str(e)}")
+        logger.error(f"Redis lease delete error for reservation {reservation_id}: {str(e)}")
+        return None
+
+    if not window:
+        return None
+    start_time, end_time, _ = window.decode('utf-8').split('|')
+    return start_time, end_time
+
+
+def redis_safe_release_lease(redis_client, reservation_id, parking_lot_id, spot_id, booking_date):
+    """Safe lease release using Lua script (atomic operation), lease metadata included"""
+    from booking.redis.circuit_breaker import redis_circuit
+    if not redis_circuit.available:
+        logger.info(f"Redis circuit open - lease {reservation_id} is left to expire")
         return False
 
+    keys = _lease_keys(reservation_id, parking_lot_id, spot_id, booking_date)
+    try:
+        return bool(lease_delete_script(keys=keys, args=[reservation_id, '1']))
+    except redis.RedisError as e:
+        logger.error(f"Redis safe release error for reservation {reservation_id}: {str(e)}")
+        redis_circuit.record_failure(e)
+        # Fallback to individual deletes
+        redis_client.hdel(keys[0], reservation_id)
+        redis_client.hdel(keys[1], reservation_id)
+        redis_client.delete(keys[2])
+        redis_client.delete(f"lease_data:{reservation_id}")
+        return True
+
 
-def redis_delete_lease(redis_client, key, value):
+def redis_lot_snapshot(redis_client, parking_lot_id, booking_date, start_minutes, end_minutes, slot_mask):
+    """Spot ids leased, booked and held on a lot/date within the requested window, in one EVALSHA.
+
+    Returns (leased, booked, held) sets of ints, False if the occupancy bitmaps are not built, None on error."""
     try:
-        return lease_delete_script(keys=[key], args=[value]) == 1
+        result = lot_snapshot_script(
+            keys=[lease_index_key(parking_lot_id, booking_date), occupancy_key(parking_lot_id, booking_date)],
+            args=[start_minutes, end_minutes, slot_mask]
+        )
     except redis.RedisError as e:
-        print(f"Redis lease delete error for key {key}: {str(e)}")
+        logger.error(f"Redis lot snapshot error for lot {parking_lot_id} on {booking_date}: {str(e)}")
+        return None
+
+    if not result:
         return False
+    return tuple({int(spot_id) for spot_id in spot_ids} for spot_ids in result)
 
 
-# ADD THIS NEW FUNCTION FOR SAFE RELEASE
-def redis_safe_release_lease(redis_client, key, value):
-    """Safe lease release using Lua script (atomic operation)"""
+def redis_occupancy_update(redis_client, parking_lot_id, booking_date, mode, fields, ttl=0):
+    """Set, clear or rebuild slot bitmaps; fields maps bitmap field -> slot mask"""
+    args = [mode, ttl]
+    for field, mask in fields.items():
+        args.extend([field, mask])
     try:
-        from config import socketio
-        redis_available = socketio.server.manager.redis_available
+        return occupancy_update_script(keys=[occupancy_key(parking_lot_id, booking_date)], args=args) == 1
+    except redis.RedisError as e:
+        logger.error(f"Redis occupancy {mode} error for lot {parking_lot_id} on {booking_date}: {str(e)}")
+        return False
+
 
-        if not redis_available:
-            raise redis.RedisError("Redis circuit open - using fallback mode")
+def redis_join_lot_room(redis_client, sid, room_name, parking_lot_id, booking_date, start_time, end_time):
+    """Atomically move a socket into a lot/date room, leaving its other rooms of the same lot.
 
-        result = lease_safe_release_script(keys=[key], args=[value])
-        return result == 1
+    Returns (rooms left, new membership)."""
+    try:
+        left, membership = room_join_script(
+            keys=[conn_key(sid), f"sid_rooms:{sid}"],
+            args=[sid, room_name, f"lot_{parking_lot_id}_", parking_lot_id, booking_date, start_time, end_time,
+                  CONNECTION_TTL]
+        )
+        return [r.decode('utf-8') for r in left], {r.decode('utf-8') for r in membership}
     except redis.RedisError as e:
-        print(f"Redis safe release error for key {key}: {str(e)}")
-        # Fallback to individual deletes
-        redis_client.delete(key)
-        redis_client.delete(f"lease_data:{value}")
+        logger.error(f"Redis room join error for sid {sid}: {str(e)}")
+        return [], set()
+
+
+def redis_leave_all_rooms(redis_client, sid):
+    """Atomically drop a socket from all its rooms and connection indexes.
+
+    Returns (connection data it had, rooms left)."""
+    try:
+        conn, left = room_leave_script(keys=[conn_key(sid), f"sid_rooms:{sid}"], args=[sid])
+    except redis.RedisError as e:
+        logger.error(f"Redis room leave error for sid {sid}: {str(e)}")
+        return {}, []
+
+    conn = [v.decode('utf-8') for v in conn]
+    return dict(zip(conn[::2], conn[1::2])), [r.decode('utf-8') for r in left]
+
+
+def redis_register_connection(redis_client, sid, user_id, connected_at):
+    """Create the socket's connection hash with an idle TTL and index it under its user"""
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hset(conn_key(sid), mapping={'user_id': user_id, 'connected_at': connected_at})
+        pipe.expire(conn_key(sid), CONNECTION_TTL)
+        if user_id != 'anonymous':
+            pipe.sadd(f"user_sockets:{user_id}", sid)
+            pipe.expire(f"user_sockets:{user_id}", CONNECTION_TTL)
+        pipe.execute()
         return True
+    except redis.RedisError as e:
+        logger.error(f"Redis connection register error for sid {sid}: {str(e)}")
+        return False
+
+
+def redis_refresh_connection(redis_client, sid, user_id):
+    """Heartbeat: push back the idle TTL of the socket's connection keys and its room memberships"""
+    keys = [conn_key(sid), f"sid_rooms:{sid}"]
+    if user_id != 'anonymous':
+        keys.append(f"user_sockets:{user_id}")
+    try:
+        return connection_refresh_script(keys=keys, args=[sid, CONNECTION_TTL]) == 1
+    except redis.RedisError as e:
+        logger.error(f"Redis connection refresh error for sid {sid}: {str(e)}")
+        return False
+
+
+def redis_room_size(redis_client, room):
+    """Number of sockets in a room whose heartbeat has not run out, pruning the ones that have"""
+    try:
+        return room_size_script(keys=[room_members_key(room)])
+    except redis.RedisError as e:
+        logger.error(f"Redis room size error for room {room}: {str(e)}")
+        return 0
 
 
 def redis_get(redis_client, key):
@@ -115,7 +599,7 @@ def redis_get(redis_client, key):
             return value.decode('utf-8')
         return value
     except redis.RedisError as e:
-        print(f"Redis GET error for key {key}: {str(e)}")
+        logger.error(f"Redis GET error for key {key}: {str(e)}")
         return None
 
 
@@ -123,7 +607,7 @@ def redis_sadd(redis_client, key, value):
     try:
         return redis_client.sadd(key, value)
     except redis.RedisError as e:
-        print(f"Redis SADD error for key {key}: {str(e)}")
+        logger.error(f"Redis SADD error for key {key}: {str(e)}")
         return 0
 
 
@@ -131,7 +615,7 @@ def redis_srem(redis_client, key, value):
     try:
         return redis_client.srem(key, value)
     except redis.RedisError as e:
-        print(f"Redis SREM error for key {key}: {str(e)}")
+        logger.error(f"Redis SREM error for key {key}: {str(e)}")
         return 0
 
 
@@ -140,17 +624,25 @@ def redis_smembers(redis_client, key):
         members = redis_client.smembers(key)
         return {m.decode('utf-8') for m in members} if members else set()
     except redis.RedisError as e:
-        print(f"Redis SMEMBERS error for key {key}: {str(e)}")
+        logger.error(f"Redis SMEMBERS error for key {key}: {str(e)}")
         return set()
 
 
+def redis_scard(redis_client, key):
+    try:
+        return redis_client.scard(key)
+    except redis.RedisError as e:
+        logger.error(f"Redis SCARD error for key {key}: {str(e)}")
+        return 0
+
+
 def redis_hset(redis_client, key, field, value):
     try:
         if isinstance(value, (dict, list)):
             value = json.dumps(value)
         return redis_client.hset(key, field, value)
     except redis.RedisError as e:
-        print(f"Redis HSET error for key {key}, field {field}: {str(e)}")
+        logger.error(f"Redis HSET error for key {key}, field {field}: {str(e)}")
         return 0
 
 
@@ -164,10 +656,25 @@ def redis_hget(redis_client, key, field):
                 return value.decode('utf-8')
         return None
     except redis.RedisError as e:
-        print(f"Redis HGET error for key {key}, field {field}: {str(e)}")
+        logger.error(f"Redis HGET error for key {key}, field {field}: {str(e)}")
         return None
 
 
+def redis_hmget(redis_client, key, fields):
+    """Fetch several plain string hash fields in one HMGET; missing fields are left out"""
+    fields = list(fields)
+    if not fields:
+        return {}
+
+    try:
+        values = redis_client.hmget(key, fields)
+    except redis.RedisError as e:
+        logger.error(f"Redis HMGET error for key {key}: {str(e)}")
+        return {}
+
+    return {field: value.decode('utf-8') for field, value in zip(fields, values) if value is not None}
+
+
 def redis_hgetall(key):
     """Safe hgetall that handles both bytes and string data"""
     try:
@@ -187,7 +694,7 @@ def redis_hgetall(key):
 
         return decoded_result
     except redis.RedisError as e:
-        print(f"Redis HGETALL error for key {key}: {str(e)}")
+        logger.error(f"Redis HGETALL error for key {key}: {str(e)}")
         return {}
 
 
@@ -195,7 +702,7 @@ def redis_hdel(redis_client, key, field):
     try:
         return redis_client.hdel(key, field)
     except redis.RedisError as e:
-        print(f"Redis HDEL error for key {key}, field {field}: {str(e)}")
+        logger.error(f"Redis HDEL error for key {key}, field {field}: {str(e)}")
         return 0
 
 
@@ -203,14 +710,5 @@ def redis_delete(redis_client, key):
     try:
         return redis_client.delete(key)
     except redis.RedisError as e:
-        print(f"Redis DELETE error for key {key}: {str(e)}")
+        logger.error(f"Redis DELETE error for key {key}: {str(e)}")
         return 0
-
-
-def redis_keys(redis_client, pattern):
-    try:
-        return [key.decode('utf-8') for key in redis_client.keys(pattern)]
-    except redis.RedisError as e:
-        print(f"Redis KEYS error for pattern {pattern}: {str(e)}")
-        return []
-
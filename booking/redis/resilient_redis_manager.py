@@ -7,44 +7,42 @@ logger = logging.getLogger(__name__)
 
 
 class ResilientRedisManager(RedisManager):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.redis_available = True
+    """Socket.IO Redis manager that defers to the Redis circuit breaker instead of tracking health itself"""
 
     def _listen(self):
         """Override to handle Redis connection failures gracefully"""
+        from booking.redis.circuit_breaker import redis_circuit
         while True:
+            if not redis_circuit.available:
+                # The breaker's probes decide when Redis is back; check again on their cadence
+                time.sleep(redis_circuit.probe_interval)
+                continue
+
             try:
-                if not self.redis_available:
-                    logger.warning("Redis unavailable - sleeping before retry")
-                    time.sleep(30)
-                # Try to use Redis normally
                 for message in super()._listen():
                     yield message
 
-                self.redis_available = True
-
-            except redis.exceptions.ConnectionError:
-                if self.redis_available:
-                    logger.error("Redis connection lost - entering fallback mode")
-                    self.redis_available = False
-                time.sleep(5)
+            except redis.exceptions.ConnectionError as e:
+                logger.error("Redis connection lost in pub/sub listener")
+                redis_circuit.record_failure(e)
+                time.sleep(redis_circuit.probe_interval)
 
             except Exception as e:
                 logger.error(f"Unexpected error in Redis listener: {e}")
-                time.sleep(10)
+                time.sleep(redis_circuit.probe_interval)
 
     def _publish(self, data):
         """Override to handle publish failures"""
-        if not self.redis_available:
-            logger.debug("Not publishing - Redis unavailable")
+        from booking.redis.circuit_breaker import redis_circuit
+        if not redis_circuit.available:
+            logger.debug("Not publishing - Redis circuit open")
             return
 
         try:
             super()._publish(data)
-        except redis.exceptions.ConnectionError:
-            if self.redis_available:
-                logger.error("Redis publish failed - marking as unavailable")
-                self.redis_available = False
+            redis_circuit.record_success()
+        except redis.exceptions.ConnectionError as e:
+            logger.error("Redis publish failed")
+            redis_circuit.record_failure(e)
         except Exception as e:
-            logger.error(f"Unexpected publish error: {e}")
\ No newline at end of file
+            logger.error(f"Unexpected publish error: {e}")
@@ -0,0 +1,148 @@
+import logging
+import threading
+from collections import OrderedDict
+import redis
+from config import app, redis_client
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = '__redis__:invalidate'
+RECONNECT_DELAY_SECONDS = 5
+
+
+class TrackedHashCache:
+    """In-process copies of read-mostly Redis hashes under one key prefix, invalidated by the server.
+
+    A dedicated listener connection turns on CLIENT TRACKING in broadcast mode for the prefix, redirected to
+    itself, and subscribes to __redis__:invalidate, so Redis names every key under the prefix that is written,
+    expires or is deleted. That works over RESP2 on Redis 6+, where redis-py's own client cache needs 7.4.
+    Invalidations sent while the listener is down are lost, so until it is subscribed again reads bypass
+    the cache."""
+
+    def __init__(self, client, url, prefix, max_size):
+        self.client = client
+        self.url = url
+        self.prefix = prefix
+        self.max_size = max_size
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> hash, or the token of a read still in flight
+        self.tracking = False
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.started = False
+        self.stopping = threading.Event()
+        self.connection = None
+
+    def hgetall(self, key):
+        """HGETALL key, from the cache while tracking is live. Raises redis.RedisError like the client"""
+        if not self.tracking:
+            return self.client.hgetall(key)
+
+        token = object()
+        with self.lock:
+            cached = self.entries.get(key)
+            if isinstance(cached, dict):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return dict(cached)
+            self.misses += 1
+            self.entries[key] = token
+
+        try:
+            value = self.client.hgetall(key)
+        except Exception:
+            with self.lock:
+                if self.entries.get(key) is token:
+                    del self.entries[key]
+            raise
+
+        with self.lock:
+            # An invalidation that arrived during the read dropped the token; the value may already be stale
+            if self.entries.get(key) is token:
+                self.entries[key] = dict(value)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        return value
+
+    def invalidate(self, keys=None):
+        """Drop keys (all entries if None)"""
+        with self.lock:
+            if keys is None:
+                self.entries.clear()
+            else:
+                for key in keys:
+                    self.entries.pop(key, None)
+            self.invalidations += 1
+
+    def start(self):
+        """Start the invalidation listener thread (once per process)"""
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        thread = threading.Thread(target=self._listen, daemon=True)
+        thread.start()
+        logger.info(f"Tracked cache for {self.prefix}* started")
+
+    def stop(self):
+        """Stop the listener; reads go straight to Redis from then on"""
+        self.stopping.set()
+        connection = self.connection
+        if connection is not None:
+            connection.disconnect()
+
+    def _listen(self):
+        # Own RESP2 connection without a read timeout: it only ever waits for invalidation messages
+        pool = redis.ConnectionPool.from_url(self.url, protocol=2, socket_timeout=None, socket_connect_timeout=2,
+                                             socket_keepalive=True)
+        while not self.stopping.is_set():
+            connection = self.connection = pool.make_connection()
+            try:
+                connection.send_command('CLIENT', 'ID')
+                client_id = connection.read_response()
+                connection.send_command('CLIENT', 'TRACKING', 'ON', 'REDIRECT', client_id, 'BCAST',
+                                        'PREFIX', self.prefix)
+                connection.read_response()
+                connection.send_command('SUBSCRIBE', INVALIDATION_CHANNEL)
+                connection.read_response()
+                self._set_tracking(True)
+
+                while True:
+                    message = connection.read_response()
+                    if message[0] == b'message':
+                        # None means the whole keyspace was flushed
+                        keys = message[2]
+                        self.invalidate(None if keys is None else [key.decode('utf-8') for key in keys])
+
+            except Exception as e:
+                if not self.stopping.is_set():
+                    logger.warning(f"Tracked cache for {self.prefix}* lost its invalidation stream: {str(e)}")
+            finally:
+                self._set_tracking(False)
+                connection.disconnect()
+            self.stopping.wait(RECONNECT_DELAY_SECONDS)
+
+    def _set_tracking(self, tracking):
+        # Whatever was cached before the stream (re)started may have missed invalidations
+        with self.lock:
+            self.tracking = tracking
+            self.entries.clear()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'prefix': self.prefix,
+                'tracking': self.tracking,
+                'size': sum(1 for value in self.entries.values() if isinstance(value, dict)),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations
+            }
+
+
+# Global instance
+lease_data_cache = TrackedHashCache(redis_client, app.config['REDIS_URL'], 'lease_data:',
+                                    app.config['REDIS_CLIENT_CACHE_SIZE'])
@@ -1,10 +1,22 @@
-from flask import Blueprint, render_template, request, jsonify
-from flask_login import login_required
+from functools import wraps
+from itertools import islice
+from flask import Blueprint, render_template, request, jsonify, abort
+from flask_login import login_required, current_user
 from booking.forms import BookingForm
+from booking.booking.deadline import deadline_metrics
+from booking.non_redis_cross_instance_worker.cross_instance_manager import spot_delta_broadcaster
+from booking.redis.circuit_breaker import redis_circuit
+from booking.redis.redis_client_factory import redis_pool_stats
+from booking.redis.tracked_cache import lease_data_cache
 from config import app, db, City, ParkingLot, Booking, ParkingSpot, socketio, redis_client, PendingBooking, ActiveConnection
 
 booking_bp = Blueprint('booking_bp', __name__, template_folder='templates')
 
+# /debug_redis lists at most this many keys per pattern, scanning this many per SCAN call
+DEBUG_KEY_SAMPLE = 100
+DEBUG_SCAN_COUNT = 500
+
+
 @booking_bp.route('/booking', methods=['GET', 'POST'])
 @login_required
 def booking_form():
@@ -28,28 +40,34 @@ def city_selected():
 
 
 
+def admin_required(func):
+    """Same gate as the Flask-Admin views: only db_admin users get operational internals"""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated or current_user.role != 'db_admin':
+            abort(403)
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
 @booking_bp.route('/debug_redis', methods=['GET'])
+@admin_required
 def debug_redis():
-    """Debug endpoint to check Redis connection and keys"""
+    """Debug endpoint to check Redis connection and sample lease keys"""
     try:
         # Test Redis connection
         redis_ok = redis_client.ping()
 
-        # Get all keys
-        all_keys = redis_client.keys('*')
-
-        # Get lease keys
-        lease_keys = redis_client.keys('spot_lease:*')
-        lease_data_keys = redis_client.keys('lease_data:*')
-
         # Get connection info
         info = redis_client.info()
 
         return jsonify({
             'redis_connected': redis_ok,
-            'total_keys': len(all_keys),
-            'lease_keys': [k.decode('utf-8') if isinstance(k, bytes) else k for k in lease_keys],
-            'lease_data_keys': [k.decode('utf-8') if isinstance(k, bytes) else k for k in lease_data_keys],
+            'total_keys': redis_client.dbsize(),
+            'lease_keys': _sample_keys('spot_lease:*'),
+            'lease_data_keys': _sample_keys('lease_data:*'),
             'redis_info': {
                 'used_memory': info.get('used_memory', 0),
                 'connected_clients': info.get('connected_clients', 0),
@@ -61,3 +79,23 @@ def debug_redis():
         return jsonify({'error': str(e)}), 500
 
 
+def _sample_keys(pattern):
+    """Up to DEBUG_KEY_SAMPLE keys matching pattern, found with incremental SCANs instead of a blocking KEYS"""
+    keys = islice(redis_client.scan_iter(match=pattern, count=DEBUG_SCAN_COUNT), DEBUG_KEY_SAMPLE)
+    return [k.decode('utf-8') if isinstance(k, bytes) else k for k in keys]
+
+
+@booking_bp.route('/admin/metrics', methods=['GET'])
+@admin_required
+def booking_metrics():
+    """In-process booking metrics; reads no Redis keys, so it is safe to poll in production"""
+    return jsonify({
+        'pool': redis_pool_stats(redis_client),
+        'lease_data_cache': lease_data_cache.snapshot(),
+        'cross_instance': spot_delta_broadcaster.metrics.snapshot(),
+        'booking_deadline': deadline_metrics.snapshot(),
+        'circuit': redis_circuit.snapshot()
+    })
+
+
+
@@ -0,0 +1,62 @@
+import threading
+import logging
+import stripe
+from booking.booking.deadline import deadline_metrics
+from config import app, socketio
+
+logger = logging.getLogger(__name__)
+
+
+class CheckoutStage:
+    """Creates Stripe checkout sessions in background tasks, at most max_workers at a time.
+
+    Runs outside the socket handler and any DB transaction; the outcome is pushed to the client's sid."""
+
+    def __init__(self, max_workers, queue_timeout):
+        self.slots = threading.BoundedSemaphore(max_workers)
+        self.queue_timeout = queue_timeout
+
+    def submit(self, sid, params, on_success=None, on_failure=None, deadline=None):
+        """params are the keyword arguments of stripe.checkout.Session.create, built in the request context.
+
+        With a deadline, queueing for a slot only waits for what is left of the request's budget."""
+        socketio.start_background_task(self._run, sid, params, on_success, on_failure, deadline)
+
+    def _run(self, sid, params, on_success, on_failure, deadline):
+        reservation_id = params['metadata']['reservation_id']
+
+        queue_timeout = self.queue_timeout if deadline is None else min(self.queue_timeout, deadline.remaining())
+        if not self.slots.acquire(timeout=queue_timeout):
+            if deadline is not None and deadline.expired():
+                deadline_metrics.record_exhausted('checkout')
+            logger.error(f"Checkout stage saturated - dropping checkout for {reservation_id}")
+            self._fail(sid, on_failure, 'Payment system busy. Please try again.')
+            return
+
+        try:
+            session = stripe.checkout.Session.create(**params)
+        except Exception as e:
+            logger.error(f"Stripe session creation failed for {reservation_id}: {str(e)}")
+            self._fail(sid, on_failure, 'Payment system error')
+            return
+        finally:
+            self.slots.release()
+
+        with app.app_context():
+            if on_success:
+                on_success(session)
+            socketio.emit('payment_redirect', {'url': session.url}, to=sid)
+
+    @staticmethod
+    def _fail(sid, on_failure, reason):
+        with app.app_context():
+            try:
+                if on_failure:
+                    on_failure()
+            except Exception as e:
+                logger.error(f"Checkout failure cleanup error: {str(e)}")
+            socketio.emit('booking_failed', {'reason': reason}, to=sid)
+
+
+# Global instance
+checkout_stage = CheckoutStage(app.config['STRIPE_CHECKOUT_WORKERS'], app.config['STRIPE_CHECKOUT_QUEUE_TIMEOUT'])
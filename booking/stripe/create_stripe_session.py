@@ -1,104 +1,68 @@
-import stripe
-import datetime
-from flask import url_for, current_app
+from datetime import datetime
+from flask import url_for
 from flask_login import current_user
 from booking.redis.redis_utils import redis_hset
+from booking.stripe.checkout_stage import checkout_stage
+from booking.utils import calculate_price
 from config import redis_client
 
 
-def create_stripe_session(data, start_time_str, end_time_str, spot, reservation_id):
-    """Create Stripe checkout session - mark lease as payment in progress"""
-    try:
-        lease_data_key = f"lease_data:{reservation_id}"
-        redis_hset(redis_client, lease_data_key, 'payment_context', 'true')
-        redis_client.expire(lease_data_key, 600)
+def create_stripe_session(data, start_time_str, end_time_str, spot, reservation_id, sid, on_failure=None,
+                          deadline=None):
+    """Queue a Stripe checkout session - mark lease as payment in progress.
 
-        start_time = datetime.strptime(start_time_str, "%H:%M").time()
-        end_time = datetime.strptime(end_time_str, "%H:%M").time()
-        hours = (end_time.hour - start_time.hour) + (end_time.minute - start_time.minute) / 60
-        price = max(round(hours * 2 * 100), 50)
+    The session is created by the checkout stage, which emits payment_redirect (or booking_failed) to sid"""
+    lease_data_key = f"lease_data:{reservation_id}"
+    redis_hset(redis_client, lease_data_key, 'payment_context', 'true')
+    redis_client.expire(lease_data_key, 600)
 
-        success_url = f"{url_for('booking_bp.payment_success', _external=True)}?session_id={{CHECKOUT_SESSION_ID}}"
-        cancel_url = url_for('booking_bp.booking_form', _external=True)
+    success_url = f"{url_for('booking_bp.payment_success', _external=True)}?session_id={{CHECKOUT_SESSION_ID}}"
+    params = _checkout_params(data, start_time_str, end_time_str, spot, reservation_id, success_url)
 
-        session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=[{
-                'price_data': {
-                    'currency': 'eur',
-                    'product_data': {
-                        'name': f'Parking Spot #{spot.spotNumber}',
-                        'description': f'{data.get("bookingDate")} {start_time_str}-{end_time_str}'
-                    },
-                    'unit_amount': price,
-                },
-                'quantity': 1,
-            }],
-            mode='payment',
-            success_url=success_url,
-            cancel_url=cancel_url,
-            metadata={
-                'reservation_id': reservation_id,
-                'spot_id': str(spot.id),
-                'parking_lot_id': data.get('parkingLotId'),
-                'booking_date': data.get('bookingDate'),
-                'start_time': start_time_str,
-                'end_time': end_time_str,
-                'user_id': str(current_user.get_id())
-            }
-        )
-
-        redis_client.hset(lease_data_key, 'stripe_session_id', session.id)
+    def on_success(session):
+        redis_hset(redis_client, lease_data_key, 'stripe_session_id', session.id)
 
-        return session.url
+    checkout_stage.submit(sid, params, on_success, on_failure, deadline)
 
-    except Exception as e:
-        current_app.logger.error(f"Stripe session creation failed: {str(e)}")
-        return None
 
+def create_stripe_session_direct(data, start_time_str, end_time_str, spot, reservation_id, sid, on_failure=None,
+                                 deadline=None):
+    """Queue a Stripe checkout session for direct booking (no Redis lease)"""
+    success_url = f"{url_for('booking_bp.payment_success_direct', _external=True)}?session_id={{CHECKOUT_SESSION_ID}}"
+    params = _checkout_params(data, start_time_str, end_time_str, spot, reservation_id, success_url)
+    params['metadata']['direct_booking'] = 'true'
 
+    checkout_stage.submit(sid, params, on_failure=on_failure, deadline=deadline)
 
-def create_stripe_session_direct(data, start_time_str, end_time_str, spot, reservation_id):
-    """Create Stripe checkout session for direct booking (no Redis lease)"""
-    try:
-        start_time = datetime.strptime(start_time_str, "%H:%M").time()
-        end_time = datetime.strptime(end_time_str, "%H:%M").time()
-        hours = (end_time.hour - start_time.hour) + (end_time.minute - start_time.minute) / 60
-        price = max(round(hours * spot.pricePerHour * 100), 50)
 
-        success_url = f"{url_for('booking_bp.payment_success_direct', _external=True)}?session_id={{CHECKOUT_SESSION_ID}}"
-        cancel_url = url_for('booking_bp.booking_form', _external=True)
+def _checkout_params(data, start_time_str, end_time_str, spot, reservation_id, success_url):
+    """Everything that needs the request context (urls, current user) is resolved here, before queueing"""
+    start_time = datetime.strptime(start_time_str, "%H:%M").time()
+    end_time = datetime.strptime(end_time_str, "%H:%M").time()
 
-        session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=[{
-                'price_data': {
-                    'currency': 'eur',
-                    'product_data': {
-                        'name': f'Parking Spot #{spot.spotNumber}',
-                        'description': f'{data.get("bookingDate")} {start_time_str}-{end_time_str}'
-                    },
-                    'unit_amount': price,
+    return {
+        'payment_method_types': ['card'],
+        'line_items': [{
+            'price_data': {
+                'currency': 'eur',
+                'product_data': {
+                    'name': f'Parking Spot #{spot.spotNumber}',
+                    'description': f'{data.get("bookingDate")} {start_time_str}-{end_time_str}'
                 },
-                'quantity': 1,
-            }],
-            mode='payment',
-            success_url=success_url,
-            cancel_url=cancel_url,
-            metadata={
-                'reservation_id': reservation_id,
-                'spot_id': str(spot.id),
-                'parking_lot_id': data.get('parkingLotId'),
-                'booking_date': data.get('bookingDate'),
-                'start_time': start_time_str,
-                'end_time': end_time_str,
-                'user_id': str(current_user.get_id()),
-                'direct_booking': 'true'
-            }
-        )
-
-        return session.url
-
-    except Exception as e:
-        current_app.logger.error(f"Direct Stripe session creation failed: {str(e)}")
-        return None
\ No newline at end of file
+                'unit_amount': calculate_price(start_time, end_time, spot.pricePerHour),
+            },
+            'quantity': 1,
+        }],
+        'mode': 'payment',
+        'success_url': success_url,
+        'cancel_url': url_for('booking_bp.booking_form', _external=True),
+        'metadata': {
+            'reservation_id': reservation_id,
+            'spot_id': str(spot.id),
+            'parking_lot_id': data.get('parkingLotId'),
+            'booking_date': data.get('bookingDate'),
+            'start_time': start_time_str,
+            'end_time': end_time_str,
+            'user_id': str(current_user.get_id())
+        }
+    }
@@ -0,0 +1,192 @@
+import logging
+import stripe
+from datetime import datetime
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from booking.booking.booking_service import confirm_booking
+from booking.catalog.catalog_cache import catalog_cache
+from booking.emit_utils.outbox import record_spot_event
+from booking.pending_bookings.pending_bookings_db import delete_pending_booking
+from booking.redis.occupancy import mark_booked
+from booking.socket.socket_con_management import disconnect_user
+from booking.utils import generate_qr_code, is_exclusion_violation
+from config import app, db, Booking, PendingBooking, PaymentConfirmation
+
+logger = logging.getLogger(__name__)
+
+# A worker that dies mid-batch leaves rows in 'processing'; other workers take them over after this long
+RECLAIM_AFTER_SECONDS = 300
+
+CLAIM_BATCH_QUERY = text("""
+    UPDATE payment_confirmations
+    SET status = 'processing', claimed_at = now(), attempts = attempts + 1
+    WHERE id IN (
+        SELECT id FROM payment_confirmations
+        WHERE status = 'pending'
+           OR (status = 'processing' AND claimed_at < now() - make_interval(secs => :reclaim_after))
+        ORDER BY id
+        LIMIT :batch_size
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id
+""")
+
+
+def enqueue_confirmation(checkout_session):
+    """Queue a paid checkout session; Stripe redelivers webhooks, so repeats are ignored"""
+    db.session.execute(
+        insert(PaymentConfirmation).values(
+            stripe_session_id=checkout_session['id'],
+            payment_intent=checkout_session.get('payment_intent'),
+            amount_total=checkout_session.get('amount_total'),
+            session_metadata=dict(checkout_session.get('metadata') or {}),
+            status='pending',
+            attempts=0,
+            created_at=datetime.now()
+        ).on_conflict_do_nothing(index_elements=['stripe_session_id'])
+    )
+    db.session.commit()
+
+
+def process_confirmation_batch(batch_size):
+    """Claim up to batch_size queued confirmations with SKIP LOCKED and settle each one. Returns the count."""
+    ids = db.session.execute(
+        CLAIM_BATCH_QUERY, {'batch_size': batch_size, 'reclaim_after': RECLAIM_AFTER_SECONDS}
+    ).scalars().all()
+    db.session.commit()
+    if not ids:
+        return 0
+
+    confirmations = PaymentConfirmation.query.filter(PaymentConfirmation.id.in_(ids)) \
+        .order_by(PaymentConfirmation.id).all()
+    for confirmation in confirmations:
+        try:
+            process_confirmation(confirmation)
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Payment confirmation {confirmation.stripe_session_id} failed: {str(e)}", exc_info=True)
+            # Errors after the booking committed (QR code, socket cleanup) must not refund it
+            if confirmation.status != 'processing':
+                continue
+            _retry_or_refund(confirmation, "Payment received! If your booking doesn't appear, contact support.")
+    return len(confirmations)
+
+
+def process_confirmation(confirmation):
+    metadata = confirmation.session_metadata
+    logger.info(f"Processing payment confirmation {confirmation.stripe_session_id} "
+                f"(attempt {confirmation.attempts}): {metadata}")
+
+    if metadata.get('direct_booking') == 'true':
+        _confirm_direct_booking(confirmation)
+        return
+
+    result, status_code = confirm_booking(
+        reservation_id=metadata['reservation_id'],
+        spot_id=metadata['spot_id'],
+        user_id=metadata['user_id'],
+        booking_data={
+            'parking_lot_id': metadata['parking_lot_id'],
+            'booking_date': metadata['booking_date'],
+            'start_time': metadata['start_time'],
+            'end_time': metadata['end_time']
+        },
+        idempotency_key=f"stripe_{confirmation.stripe_session_id}"
+    )
+
+    # Cached idempotent responses come back as 200 whatever their outcome, so go by the body
+    if result.get('status') == 'success':
+        generate_qr_code(result['booking_id'])
+        _finish(confirmation, 'confirmed', "Your booking and payment were successful!", result['booking_id'])
+        disconnect_user(metadata['user_id'])
+    elif status_code >= 500:
+        _retry_or_refund(confirmation, "Booking failed. Refund issued. Please try again.")
+    else:
+        _refund(confirmation, "Booking failed. Refund issued. Please try again.")
+
+
+def _confirm_direct_booking(confirmation):
+    """Booking made while Redis was down: the pending hold is the reservation"""
+    metadata = confirmation.session_metadata
+    spot = catalog_cache.get_spot(metadata['spot_id'])
+    if not spot:
+        _refund(confirmation, "Invalid spot. Refund issued.")
+        return
+
+    start_time = datetime.strptime(metadata['start_time'], '%H:%M').time()
+    end_time = datetime.strptime(metadata['end_time'], '%H:%M').time()
+    booking_date = datetime.strptime(metadata['booking_date'], '%Y-%m-%d').date()
+
+    conflicting_pending = PendingBooking.query.filter(
+        PendingBooking.spot_id == spot.id,
+        PendingBooking.parking_lot_id == int(metadata['parking_lot_id']),
+        PendingBooking.booking_date == booking_date,
+        PendingBooking.start_time < end_time,
+        PendingBooking.end_time > start_time,
+        PendingBooking.reservation_id != metadata['reservation_id']
+    ).first()
+
+    if conflicting_pending:
+        logger.warning(f"Conflict with pending booking: {conflicting_pending.reservation_id}")
+        delete_pending_booking(metadata['reservation_id'])
+        _refund(confirmation, "This spot was reserved by someone else while you were paying. Refund issued.")
+        return
+
+    # The booking, its outbox event and the confirmation's outcome commit together,
+    # so a retried row can never book twice
+    try:
+        booking = Booking(
+            userid=int(metadata['user_id']),
+            parking_lot_id=int(metadata['parking_lot_id']),
+            spot_id=spot.id,
+            bookingDate=booking_date,
+            startTime=start_time,
+            endTime=end_time,
+            amount=float(confirmation.amount_total or 0)
+        )
+        db.session.add(booking)
+        record_spot_event(spot.id, booking.parking_lot_id, booking_date, start_time, end_time, False)
+        db.session.flush()
+        _finish(confirmation, 'confirmed', "Your booking and payment were successful!", booking.id)
+    except IntegrityError as e:
+        db.session.rollback()
+        if not is_exclusion_violation(e):
+            raise
+        logger.error(f"Spot {spot.id} already booked by someone else")
+        delete_pending_booking(metadata['reservation_id'])
+        _refund(confirmation, "This spot was already booked by someone else. Refund issued.")
+        return
+
+    generate_qr_code(booking.id)
+    delete_pending_booking(metadata['reservation_id'])
+    mark_booked(booking.parking_lot_id, spot.id, booking_date, start_time, end_time)
+
+
+def _retry_or_refund(confirmation, message):
+    if confirmation.attempts < app.config['PAYMENT_CONFIRMATION_MAX_ATTEMPTS']:
+        confirmation.status = 'pending'
+        db.session.commit()
+        return
+    _refund(confirmation, message)
+
+
+def _refund(confirmation, message):
+    try:
+        refund = stripe.Refund.create(
+            payment_intent=confirmation.payment_intent,
+            idempotency_key=f"refund_{confirmation.stripe_session_id}"
+        )
+        logger.info(f"Refund issued: {refund.id}")
+        _finish(confirmation, 'refunded', message)
+    except stripe.error.StripeError as refund_error:
+        logger.error(f"Refund failed for {confirmation.stripe_session_id}: {str(refund_error)}")
+        _finish(confirmation, 'failed', "Booking failed. Please contact support for refund.")
+
+
+def _finish(confirmation, status, message, booking_id=None):
+    confirmation.status = status
+    confirmation.message = message
+    confirmation.booking_id = booking_id
+    confirmation.processed_at = datetime.now()
+    db.session.commit()
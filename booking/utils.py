@@ -4,6 +4,15 @@ from cryptography.fernet import Fernet
 from config import secrets, redis_client
 
 
+class SpotTakenError(Exception):
+    """An insert overlapped an existing booking or hold on the same spot"""
+
+
+def is_exclusion_violation(error):
+    """IntegrityError raised by one of the spot/time exclusion constraints"""
+    return getattr(getattr(error, 'orig', None), 'pgcode', None) == '23P01'
+
+
 def validate_lease(reservation_id, spot_id, user_id):
     try:
         lease_data = redis_client.hgetall(f"lease_data:{reservation_id}")
@@ -25,6 +34,14 @@ def calculate_price(startTime, endTime, spotPricePerHour):
     return max(price_cents, 50)
 
 
+def time_to_minutes(value):
+    """Minutes since midnight of a time or an 'HH:MM' string"""
+    if isinstance(value, str):
+        hours, minutes = value.split(':', 1)
+        return int(hours) * 60 + int(minutes)
+    return value.hour * 60 + value.minute
+
+
 def generate_qr_code(new_booking_id):
     key = secrets["FERNET_KEY"]
     cipher = Fernet(key.encode())
@@ -1,6 +1,5 @@
 import os
 import stripe
-import redis
 from datetime import datetime, timedelta
 from infisical_sdk import InfisicalSDKClient
 from flask import Flask, url_for, render_template
@@ -11,8 +10,10 @@ from flask_socketio import SocketIO
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin, LoginManager, current_user
 from flask_migrate import Migrate
-from sqlalchemy import MetaData
+from sqlalchemy import MetaData, text
+from sqlalchemy.dialects.postgresql import ExcludeConstraint
 from booking.redis.resilient_redis_manager import ResilientRedisManager
+from booking.redis.redis_client_factory import create_redis_client, CONNECTION_OPTIONS
 
 app = Flask(__name__)
 
@@ -45,12 +46,34 @@ login_manager.login_message_category = "warning"
 STRIPE_PUBLIC_KEY = secrets['STRIPE_PUBLIC_KEY']
 STRIPE_SECRET_KEY = secrets['STRIPE_SECRET_KEY']
 stripe.api_key = STRIPE_SECRET_KEY
+app.config['STRIPE_TIMEOUT'] = int(secrets.get('STRIPE_TIMEOUT', 10))
+app.config['STRIPE_CHECKOUT_WORKERS'] = int(secrets.get('STRIPE_CHECKOUT_WORKERS', 16))
+app.config['STRIPE_CHECKOUT_QUEUE_TIMEOUT'] = int(secrets.get('STRIPE_CHECKOUT_QUEUE_TIMEOUT', 5))
+stripe.default_http_client = stripe.RequestsClient(timeout=app.config['STRIPE_TIMEOUT'])
+stripe.max_network_retries = 1
+STRIPE_WEBHOOK_SECRET = secrets.get('STRIPE_WEBHOOK_SECRET')
+app.config['PAYMENT_CONFIRMATION_BATCH_SIZE'] = int(secrets.get('PAYMENT_CONFIRMATION_BATCH_SIZE', 20))
+app.config['PAYMENT_CONFIRMATION_MAX_ATTEMPTS'] = int(secrets.get('PAYMENT_CONFIRMATION_MAX_ATTEMPTS', 5))
+# Point at a local stub (e.g. stripe-mock on http://localhost:12111) to run checkout flows offline
+if secrets.get('STRIPE_API_BASE'):
+    stripe.api_base = secrets['STRIPE_API_BASE']
 
 # TODO Once deployed use actual link
 #socketio = SocketIO(app, cors_allowed_origins=["https://parqlive.com", "https://www.parqlive.com"], async_mode='eventlet')
 
 app.config['REDIS_URL'] = secrets['REDIS_URL']
-redis_client = redis.from_url(app.config['REDIS_URL'])
+app.config['REDIS_MAX_CONNECTIONS'] = int(secrets.get('REDIS_MAX_CONNECTIONS', 50))
+# Entries of the server-invalidated lease_data:* cache (booking/redis/tracked_cache.py)
+app.config['REDIS_CLIENT_CACHE_SIZE'] = int(secrets.get('REDIS_CLIENT_CACHE_SIZE', 10000))
+# Redis circuit breaker: background PINGs every probe interval, slower than the probe timeout counts as failed.
+# failure threshold consecutive bad probes (or that error rate among reported calls) open it; after the
+# cooldown it goes half-open and closes again on good probes
+app.config['REDIS_PROBE_INTERVAL_MS'] = int(secrets.get('REDIS_PROBE_INTERVAL_MS', 250))
+app.config['REDIS_PROBE_TIMEOUT_MS'] = int(secrets.get('REDIS_PROBE_TIMEOUT_MS', 300))
+app.config['REDIS_CIRCUIT_FAILURE_THRESHOLD'] = int(secrets.get('REDIS_CIRCUIT_FAILURE_THRESHOLD', 2))
+app.config['REDIS_CIRCUIT_ERROR_RATE'] = float(secrets.get('REDIS_CIRCUIT_ERROR_RATE', 0.5))
+app.config['REDIS_CIRCUIT_COOLDOWN_MS'] = int(secrets.get('REDIS_CIRCUIT_COOLDOWN_MS', 500))
+redis_client = create_redis_client(app.config['REDIS_URL'], max_connections=app.config['REDIS_MAX_CONNECTIONS'])
 
 from booking.redis.redis_utils import init_redis_scripts
 init_redis_scripts(redis_client, app)
@@ -59,12 +82,30 @@ socketio = SocketIO(
         app,
         cors_allowed_origins=["https://parqlive.com", "https://www.parqlive.com"],
         async_mode='eventlet',
-        client_manager=ResilientRedisManager(url=app.config['REDIS_URL']),
+        client_manager=ResilientRedisManager(url=app.config['REDIS_URL'], redis_options=CONNECTION_OPTIONS),
         logger=True,
         engineio_logger=True,
         manage_session=False
 )
 
+# Window over which spot updates for one lot/date are coalesced into a single frame (0 disables batching)
+app.config['SPOT_UPDATE_BATCH_WINDOW_MS'] = int(secrets.get('SPOT_UPDATE_BATCH_WINDOW_MS', 75))
+# Repeats of the same spot state change within this window are emitted once per instance
+app.config['SPOT_EVENT_DEDUP_SECONDS'] = float(secrets.get('SPOT_EVENT_DEDUP_SECONDS', 5))
+# Width of the time-bucket rooms taken-spot updates fan out through (must divide 60). Hour buckets cap a
+# subscription or an all-day booking at 24 rooms; 15 matches the booking grid exactly but allows 96
+app.config['SPOT_UPDATE_BUCKET_MINUTES'] = int(secrets.get('SPOT_UPDATE_BUCKET_MINUTES', 60))
+
+# Static lot/spot catalog kept in process; admin edits invalidate it on every instance
+app.config['CATALOG_CACHE_MAX_SIZE'] = int(secrets.get('CATALOG_CACHE_MAX_SIZE', 5000))
+app.config['CATALOG_CACHE_TTL'] = int(secrets.get('CATALOG_CACHE_TTL', 300))
+
+# Per lot/date slot bitmaps in Redis are rebuilt from the database at least this often (seconds)
+app.config['OCCUPANCY_BITMAP_TTL'] = int(secrets.get('OCCUPANCY_BITMAP_TTL', 300))
+
+# Latency budget of one book_spot; lease retries stop and the database path gives up once it is spent
+app.config['BOOKING_DEADLINE_MS'] = int(secrets.get('BOOKING_DEADLINE_MS', 4000))
+
 # DATABASE CONFIGURATION
 app.config['SQLALCHEMY_DATABASE_URI'] = secrets['SQLALCHEMY_DATABASE_URI']
 app.config['SQLALCHEMY_ECHO'] = True if secrets['SQLALCHEMY_ECHO'] == 'True' else False
@@ -164,6 +205,18 @@ class Booking(db.Model, UserMixin):
     parking_spot = db.relationship('ParkingSpot', back_populates='bookings')
     parking_lot = db.relationship('ParkingLot')  # New relationship
 
+    # Overlap lookups filter on lot/date or spot/date; the exclusion constraint makes double booking impossible
+    __table_args__ = (
+        db.Index('ix_bookings_lot_date_spot', 'parking_lot_id', 'bookingDate', 'spot_id'),
+        db.Index('ix_bookings_spot_date', 'spot_id', 'bookingDate'),
+        ExcludeConstraint(
+            ('spot_id', '='),
+            (text('tsrange("bookingDate" + "startTime", "bookingDate" + "endTime", \'[)\')'), '&&'),
+            name='excl_bookings_spot_time',
+            using='gist'
+        ),
+    )
+
 
     def __init__(self, userid, parking_lot_id, spot_id, bookingDate, startTime, endTime, amount):
         self.userid = userid
@@ -244,6 +297,12 @@ class PendingBooking(db.Model):
         db.Index('idx_pending_reservation_id', 'reservation_id'),
         db.Index('idx_pending_expires_at', 'expires_at'),
         db.Index('idx_pending_user_id', 'user_id'),
+        ExcludeConstraint(
+            ('spot_id', '='),
+            (text('tsrange(booking_date + start_time, booking_date + end_time, \'[)\')'), '&&'),
+            name='excl_pending_bookings_spot_time',
+            using='gist'
+        ),
     )
 
 
@@ -270,6 +329,45 @@ class ActiveConnection(db.Model):
         super().__init__(**kwargs)
         self.expires_at = datetime.now() + timedelta(minutes=5)
 
+class OutboxEvent(db.Model):
+    """Spot events written in the same transaction as the booking change, dispatched by misc/worker.py"""
+    __tablename__ = 'outbox'
+
+    id = db.Column(db.BigInteger, primary_key=True)
+    event_type = db.Column(db.String(50), nullable=False)
+    room = db.Column(db.String(255), nullable=False)  # lot_1_2025-09-15
+    payload = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.now, nullable=False)
+    dispatched = db.Column(db.Boolean, default=False, nullable=False)
+    dispatched_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('idx_outbox_undispatched', 'id', postgresql_where=text('NOT dispatched')),
+    )
+
+
+class PaymentConfirmation(db.Model):
+    """Durable queue of paid Stripe checkouts, filled by the webhook and drained by misc/payment_worker.py"""
+    __tablename__ = 'payment_confirmations'
+
+    id = db.Column(db.Integer, primary_key=True)
+    stripe_session_id = db.Column(db.String(255), unique=True, nullable=False)
+    payment_intent = db.Column(db.String(255), nullable=True)
+    amount_total = db.Column(db.Integer, nullable=True)  # cents
+    session_metadata = db.Column(db.JSON, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, processing, confirmed, refunded, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    booking_id = db.Column(db.Integer, nullable=True)
+    message = db.Column(db.String(255), nullable=True)  # Shown to the user on the redirect page
+    created_at = db.Column(db.DateTime, default=datetime.now, nullable=False)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    processed_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('idx_payment_confirmations_status', 'status', 'id'),
+    )
+
+
 class MainIndexLink(MenuLink):
     def get_url(self):
         return url_for('index')
@@ -286,6 +384,36 @@ class BookingView(ExtendedModelView):
     column_list = ('id', 'userid', 'parking_lot_id', 'spot_id', 'timeBooked', 'bookingDate', 'startTime', 'endTime', 'amount', 'spot_id')
     app.config['FLASK_ADMIN_FLUID_LAYOUT'] = True if secrets['FLASK_ADMIN_FLUID_LAYOUT'] == 'True' else False
 
+    def on_model_change(self, form, model, is_created):
+        # The edit may move the booking to another lot/date, so drop the bitmaps it was counted in
+        if not is_created:
+            from booking.redis.occupancy import invalidate_occupancy
+            state = db.inspect(model)
+            lot_history = state.attrs.parking_lot_id.history
+            date_history = state.attrs.bookingDate.history
+            invalidate_occupancy((lot_history.deleted or [model.parking_lot_id])[0],
+                                 (date_history.deleted or [model.bookingDate])[0])
+
+    def after_model_change(self, form, model, is_created):
+        from booking.redis.occupancy import invalidate_occupancy
+        invalidate_occupancy(model.parking_lot_id, model.bookingDate)
+
+    def after_model_delete(self, model):
+        from booking.redis.occupancy import invalidate_occupancy
+        invalidate_occupancy(model.parking_lot_id, model.bookingDate)
+
+
+class CatalogView(ExtendedModelView):
+    column_display_pk = True
+
+    def after_model_change(self, form, model, is_created):
+        from booking.catalog.catalog_cache import invalidate_catalog
+        invalidate_catalog(model)
+
+    def after_model_delete(self, model):
+        from booking.catalog.catalog_cache import invalidate_catalog
+        invalidate_catalog(model)
+
 
 class UserView(ExtendedModelView):
     column_display_pk = True
@@ -299,6 +427,8 @@ admin._menu = admin._menu[1:]
 admin.add_link(MainIndexLink(name='Home Page'))
 admin.add_view(BookingView(Booking  , db.session))
 admin.add_view(UserView(User, db.session))
+admin.add_view(CatalogView(ParkingLot, db.session))
+admin.add_view(CatalogView(ParkingSpot, db.session))
 
 
 
@@ -315,6 +445,12 @@ def startup():
     try:
         from booking.redis.redis_pubsub import start_redis_expiration_listener
         from booking.non_redis_cross_instance_worker.cross_instance_manager import init_cross_instance_messaging
+        from booking.redis.circuit_breaker import redis_circuit
+        from booking.redis.tracked_cache import lease_data_cache
+
+        # Probe Redis before anything starts relying on it
+        redis_circuit.start()
+        lease_data_cache.start()
 
         # Initialize cross-instance messaging
         init_cross_instance_messaging()
@@ -332,23 +468,4 @@ def startup():
 
 
 
-def with_redis_circuit(func):
-    """Decorator to automatically handle Redis circuit breaker"""
-
-    def wrapper(*args, **kwargs):
-        global redis_circuit_open
-
-        if redis_circuit_open:
-            raise Exception("Redis circuit open - use fallback")
-
-        try:
-            return func(*args, **kwargs)
-        except redis.exceptions.ConnectionError:
-            # Open circuit on connection failure
-            redis_circuit_open = True
-            app.logger.warning("Redis connection failed - opening circuit")
-            raise Exception("Redis unavailable")
-
-    return wrapper
-
 startup()
\ No newline at end of file
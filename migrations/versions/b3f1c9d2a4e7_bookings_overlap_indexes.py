@@ -0,0 +1,47 @@
+"""bookings overlap indexes and exclusion constraint
+
+Revision ID: b3f1c9d2a4e7
+Revises: 7e360c2dcbb9
+Create Date: 2025-08-04 18:12:40.311927
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3f1c9d2a4e7'
+down_revision = '7e360c2dcbb9'
+branch_labels = None
+depends_on = None
+
+
+BOOKING_RANGE = 'tsrange("bookingDate" + "startTime", "bookingDate" + "endTime", \'[)\')'
+
+
+def upgrade():
+    op.create_index('ix_bookings_lot_date_spot', 'bookings', ['parking_lot_id', 'bookingDate', 'spot_id'])
+    op.create_index('ix_bookings_spot_date', 'bookings', ['spot_id', 'bookingDate'])
+
+    # The constraint can't be added while double bookings exist, so name them instead of failing mid-DDL
+    overlaps = op.get_bind().execute(sa.text("""
+        SELECT a.id, b.id FROM bookings a
+        JOIN bookings b ON a.spot_id = b.spot_id AND a.id < b.id
+         AND a."bookingDate" = b."bookingDate"
+         AND a."startTime" < b."endTime" AND a."endTime" > b."startTime"
+        LIMIT 20
+    """)).fetchall()
+    if overlaps:
+        raise RuntimeError(f"Overlapping bookings must be resolved before adding excl_bookings_spot_time: {overlaps}")
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS btree_gist')
+    op.execute(f"""
+        ALTER TABLE bookings ADD CONSTRAINT excl_bookings_spot_time
+        EXCLUDE USING gist (spot_id WITH =, {BOOKING_RANGE} WITH &&)
+    """)
+
+
+def downgrade():
+    op.drop_constraint('excl_bookings_spot_time', 'bookings')
+    op.drop_index('ix_bookings_spot_date', table_name='bookings')
+    op.drop_index('ix_bookings_lot_date_spot', table_name='bookings')
@@ -0,0 +1,42 @@
+"""pending bookings exclusion constraint
+
+Revision ID: d8a2f5c61e09
+Revises: b3f1c9d2a4e7
+Create Date: 2025-08-06 11:47:02.584133
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8a2f5c61e09'
+down_revision = 'b3f1c9d2a4e7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Expired holds are only removed by the hourly cleanup and would otherwise block the constraint
+    op.execute('DELETE FROM pending_bookings WHERE expires_at < now()')
+
+    overlaps = op.get_bind().execute(sa.text("""
+        SELECT a.reservation_id, b.reservation_id FROM pending_bookings a
+        JOIN pending_bookings b ON a.spot_id = b.spot_id AND a.id < b.id
+         AND a.booking_date = b.booking_date
+         AND a.start_time < b.end_time AND a.end_time > b.start_time
+        LIMIT 20
+    """)).fetchall()
+    if overlaps:
+        raise RuntimeError(f"Overlapping pending bookings must be resolved before adding "
+                           f"excl_pending_bookings_spot_time: {overlaps}")
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS btree_gist')
+    op.execute("""
+        ALTER TABLE pending_bookings ADD CONSTRAINT excl_pending_bookings_spot_time
+        EXCLUDE USING gist (spot_id WITH =, tsrange(booking_date + start_time, booking_date + end_time, '[)') WITH &&)
+    """)
+
+
+def downgrade():
+    op.drop_constraint('excl_pending_bookings_spot_time', 'pending_bookings')
@@ -0,0 +1,41 @@
+"""payment confirmations queue
+
+Revision ID: e41b7a9c3f52
+Revises: d8a2f5c61e09
+Create Date: 2025-08-09 16:03:27.905118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e41b7a9c3f52'
+down_revision = 'd8a2f5c61e09'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('payment_confirmations',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('stripe_session_id', sa.String(length=255), nullable=False),
+    sa.Column('payment_intent', sa.String(length=255), nullable=True),
+    sa.Column('amount_total', sa.Integer(), nullable=True),
+    sa.Column('session_metadata', sa.JSON(), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('booking_id', sa.Integer(), nullable=True),
+    sa.Column('message', sa.String(length=255), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('claimed_at', sa.DateTime(), nullable=True),
+    sa.Column('processed_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id', name=op.f('pk_payment_confirmations')),
+    sa.UniqueConstraint('stripe_session_id', name=op.f('uq_payment_confirmations_stripe_session_id'))
+    )
+    op.create_index('idx_payment_confirmations_status', 'payment_confirmations', ['status', 'id'])
+
+
+def downgrade():
+    op.drop_index('idx_payment_confirmations_status', table_name='payment_confirmations')
+    op.drop_table('payment_confirmations')
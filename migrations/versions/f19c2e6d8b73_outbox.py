@@ -0,0 +1,35 @@
+"""outbox
+
+Revision ID: f19c2e6d8b73
+Revises: e41b7a9c3f52
+Create Date: 2025-08-12 10:21:55.640281
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f19c2e6d8b73'
+down_revision = 'e41b7a9c3f52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('outbox',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('event_type', sa.String(length=50), nullable=False),
+    sa.Column('room', sa.String(length=255), nullable=False),
+    sa.Column('payload', sa.JSON(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('dispatched', sa.Boolean(), nullable=False),
+    sa.Column('dispatched_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id', name=op.f('pk_outbox'))
+    )
+    op.create_index('idx_outbox_undispatched', 'outbox', ['id'], postgresql_where=sa.text('NOT dispatched'))
+
+
+def downgrade():
+    op.drop_index('idx_outbox_undispatched', table_name='outbox')
+    op.drop_table('outbox')
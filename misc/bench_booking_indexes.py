@@ -0,0 +1,85 @@
+import sys
+import time
+import logging
+from sqlalchemy import text
+from config import app, db
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Runs in its own schema with a copy of the bookings table, so the app's data is never touched
+BENCH_SCHEMA = 'booking_bench'
+
+# Same shape as the overlap filters in spot_availability, booking_service and payments
+QUERIES = {
+    'lot availability': """
+        SELECT spot_id FROM bookings
+        WHERE parking_lot_id = :lot AND "bookingDate" = :date
+          AND "startTime" < :end AND "endTime" > :start
+    """,
+    'spot conflict': """
+        SELECT count(*) FROM bookings
+        WHERE spot_id = :spot AND parking_lot_id = :lot AND "bookingDate" = :date
+          AND "startTime" < :end AND "endTime" > :start
+    """,
+}
+PARAMS = {'lot': 7, 'spot': 7 * 200 + 42, 'date': '2024-03-15', 'start': '10:00', 'end': '12:00'}
+
+
+def seed(rows, lots=50, spots_per_lot=200):
+    """rows bookings spread over lots * spots_per_lot spots, each spot booked back to back from 07:00"""
+    logger.info(f"Seeding {rows} bookings")
+    db.session.execute(text(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE"))
+    db.session.execute(text(f"CREATE SCHEMA {BENCH_SCHEMA}"))
+    db.session.execute(text(f"SET search_path TO {BENCH_SCHEMA}"))
+    db.session.execute(text("CREATE TABLE bookings (LIKE public.bookings INCLUDING DEFAULTS)"))
+    # 8 two-hour slots a day per spot; n walks spots first, then slots, then days
+    db.session.execute(text("""
+        INSERT INTO bookings (id, userid, parking_lot_id, spot_id, "timeBooked", "bookingDate", "startTime", "endTime", amount)
+        SELECT n, NULL, spot / :spots_per_lot, spot,
+               now(), date '2024-01-01' + (n / (:spot_count * 8))::int,
+               time '07:00' + ((n / :spot_count) % 8) * interval '2 hours',
+               time '09:00' + ((n / :spot_count) % 8) * interval '2 hours',
+               10
+        FROM (SELECT n, n % :spot_count + :spots_per_lot AS spot FROM generate_series(0, :rows - 1) AS n) s
+    """), {'rows': rows, 'spots_per_lot': spots_per_lot, 'spot_count': lots * spots_per_lot})
+    db.session.execute(text("ANALYZE bookings"))
+    db.session.commit()
+
+
+def explain(label):
+    db.session.execute(text(f"SET search_path TO {BENCH_SCHEMA}"))
+    for name, query in QUERIES.items():
+        plan = db.session.execute(text(f"EXPLAIN (ANALYZE, BUFFERS) {query}"), PARAMS).scalars().all()
+        print(f"\n=== {label}: {name} ===")
+        print("\n".join(plan))
+
+
+def add_indexes():
+    """The indexes and constraint from migration b3f1c9d2a4e7"""
+    started = time.monotonic()
+    db.session.execute(text(f"SET search_path TO {BENCH_SCHEMA}, public"))
+    db.session.execute(text('CREATE INDEX ix_bookings_lot_date_spot ON bookings (parking_lot_id, "bookingDate", spot_id)'))
+    db.session.execute(text('CREATE INDEX ix_bookings_spot_date ON bookings (spot_id, "bookingDate")'))
+    db.session.execute(text('CREATE EXTENSION IF NOT EXISTS btree_gist SCHEMA public'))
+    db.session.execute(text("""
+        ALTER TABLE bookings ADD CONSTRAINT excl_bookings_spot_time
+        EXCLUDE USING gist (spot_id WITH =, tsrange("bookingDate" + "startTime", "bookingDate" + "endTime", '[)') WITH &&)
+    """))
+    db.session.execute(text("ANALYZE bookings"))
+    db.session.commit()
+    logger.info(f"Indexes built in {time.monotonic() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000_000
+    with app.app_context():
+        try:
+            seed(rows)
+            explain("no indexes")
+            add_indexes()
+            explain("with indexes")
+        finally:
+            db.session.rollback()
+            db.session.execute(text(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE"))
+            db.session.commit()
@@ -2,7 +2,7 @@ import time
 import logging
 from sqlalchemy import text
 from booking.routes.views import emit_to_relevant_rooms_about_booking
-from config import app, db, ParkingSpot
+from config import app, db, ParkingSpot, redis_client
 from booking.redis.redis_utils import redis_delete_lease
 
 logging.basicConfig(level=logging.INFO)
@@ -48,7 +48,13 @@ def process_expired_lease(lease):
         )
 
         # Clean up Redis lease
-        redis_delete_lease(f"spot_lease:{lease.spot_id}", lease.reservation_id)
+        redis_delete_lease(
+            redis_client,
+            lease.reservation_id,
+            lease.parking_lot_id,
+            lease.spot_id,
+            lease.booking_date
+        )
 
         # Mark as processed
         db.session.execute(
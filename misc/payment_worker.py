@@ -0,0 +1,25 @@
+import time
+import logging
+from config import app
+from booking.stripe.payment_confirmations import process_confirmation_batch
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def drain_payment_confirmations():
+    """Worker that confirms queued Stripe payments in SKIP LOCKED batches; run as many as needed"""
+    logger.info("Payment confirmation worker started")
+    with app.app_context():
+        while True:
+            try:
+                processed = process_confirmation_batch(app.config['PAYMENT_CONFIRMATION_BATCH_SIZE'])
+                if not processed:
+                    time.sleep(1)  # Queue empty, sleep briefly
+            except Exception as e:
+                logger.error(f"Payment worker error: {str(e)}", exc_info=True)
+                time.sleep(5)
+
+
+if __name__ == '__main__':
+    drain_payment_confirmations()
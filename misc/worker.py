@@ -1,65 +1,96 @@
 import time
+import select
 import logging
+from collections import defaultdict
+from datetime import datetime
 from sqlalchemy import text
-from config import db, app, ParkingSpot
-from booking.routes.views import emit_to_relevant_rooms_about_booking
+from config import db, app
+from booking.emit_utils.outbox import OUTBOX_CHANNEL
+from booking.non_redis_cross_instance_worker.cross_instance_manager import spot_delta_broadcaster
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+BATCH_SIZE = 200
+# NOTIFY wakes the dispatcher; the timeout only covers notifications sent while it was reconnecting
+IDLE_TIMEOUT = 30
+
+
 def process_outbox():
+    """Worker that dispatches outbox events in SKIP LOCKED batches, woken by LISTEN/NOTIFY"""
     logger.info("Outbox worker started")
-
-    """Worker that processes outbox events with SKIP LOCKED"""
     with app.app_context():
         while True:
+            listener = None
             try:
-                # Get next event to process with SKIP LOCKED
-                query = text("""
-                    SELECT * FROM outbox 
-                    WHERE dispatched = false 
-                    ORDER BY created_at LIMIT 1 
-                    FOR UPDATE SKIP LOCKED
-                """)
-
-                event = db.session.execute(query).first()
-
-                if not event:
-                    time.sleep(1)  # No work, sleep briefly
-                    continue
-
-                # Process the event
-                process_event(event)
-
-                # Mark as dispatched
-                db.session.execute(
-                    text("UPDATE outbox SET dispatched = true, dispatched_at = NOW() WHERE id = :id"),
-                    {"id": event.id}
-                )
-                db.session.commit()
+                listener = db.engine.raw_connection()
+                listener.detach()  # autocommit + LISTEN must not leak back into the pool
+                listener.driver_connection.autocommit = True
+                listener.cursor().execute(f"LISTEN {OUTBOX_CHANNEL}")
+
+                while True:
+                    # Drain everything committed so far, then block until the next NOTIFY
+                    while dispatch_batch(BATCH_SIZE) == BATCH_SIZE:
+                        pass
+                    wait_for_notify(listener.driver_connection, IDLE_TIMEOUT)
 
             except Exception as e:
                 logging.error(f"Outbox processing error: {str(e)}")
                 db.session.rollback()
                 time.sleep(5)  # Sleep longer on error
+            finally:
+                if listener is not None:
+                    listener.close()
+
+
+def wait_for_notify(connection, timeout):
+    if select.select([connection], [], [], timeout) == ([], [], []):
+        return
+    connection.poll()
+    connection.notifies.clear()  # One wake-up drains every pending event
+
+
+def dispatch_batch(batch_size):
+    """Claim, emit and mark up to batch_size events in one transaction; returns the number claimed"""
+    events = db.session.execute(text("""
+        SELECT id, room, payload FROM outbox
+        WHERE NOT dispatched
+        ORDER BY id LIMIT :batch_size
+        FOR UPDATE SKIP LOCKED
+    """), {'batch_size': batch_size}).all()
+
+    if not events:
+        db.session.commit()
+        return 0
+
+    by_room = defaultdict(list)
+    for event in events:
+        by_room[event.room].append(event.payload)
+
+    for room, payloads in by_room.items():
+        dispatch_room(room, payloads)
+    # The dispatcher has no sockets of its own: publish the whole batch before marking it dispatched
+    spot_delta_broadcaster.flush()
+
+    db.session.execute(
+        text("UPDATE outbox SET dispatched = true, dispatched_at = :now WHERE id = ANY(:ids)"),
+        {'now': datetime.now(), 'ids': [event.id for event in events]}
+    )
+    db.session.commit()
+    logger.info(f"Dispatched {len(events)} outbox events to {len(by_room)} rooms")
+    return len(events)
+
+
+def dispatch_room(room, payloads):
+    """Queue a lot/date room's events on the cross-instance transport; receivers coalesce them per room"""
+    parking_lot_id = room.split('_')[1]
+    for payload in payloads:
+        spot_delta_broadcaster.add(payload['spot_id'], parking_lot_id, payload['booking_date'],
+                                   payload['is_available'], payload['start_time'], payload['end_time'])
 
-def process_event(event):
-    """Process a single outbox event"""
-    if event.event_type == 'booking_created':
-        payload = event.payload
-        # Emit WebSocket event
-        spot = ParkingSpot.query.get(payload['spot_id'])
-        emit_to_relevant_rooms_about_booking(
-            spot=spot,
-            booking_date=payload['booking_data']['booking_date'],
-            is_available=False,
-            return_confirmation=False,
-            start_time=payload['booking_data']['start_time'],
-            end_time=payload['booking_data']['end_time']
-        )
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     logger.info("Starting outbox processing worker...")
-    process_outbox()
\ No newline at end of file
+    process_outbox()
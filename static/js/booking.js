@@ -264,6 +264,13 @@ function parkingLotSelected() {
 
 let socket = null;
 
+// Keeps the server-side connection record alive; it expires if heartbeats stop
+setInterval(() => {
+    if (socket && socket.connected) {
+        socket.emit('heartbeat');
+    }
+}, 30000);
+
 function openWebSocketConnection(parkingLotId) {
     const bookingDate = document.getElementById("bookingDate").value;
     const startHour = document.querySelector('[name="startHour"]').value;
@@ -310,6 +317,10 @@ function openWebSocketConnection(parkingLotId) {
             console.log('Spot update received:', data);
             updateSpotAvailability(data.spotId, data.available);
         });
+        socket.on('spot_updates', (data) => {
+            console.log('Spot updates batch received:', data);
+            data.updates.forEach(update => updateSpotAvailability(update.spotId, update.available));
+        });
 
         socket.on('payment_redirect', (data) => {
             window.location.href = data.url;
@@ -0,0 +1,78 @@
+import os
+import sys
+import time
+import types
+import shutil
+import socket
+import subprocess
+from pathlib import Path
+import pytest
+import redis
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture
+def stub_module(monkeypatch):
+    """Install a stand-in module for an import that needs live services (config reads Infisical at import)"""
+    def install(name, **attrs):
+        module = types.ModuleType(name)
+        module.__dict__.update(attrs)
+        monkeypatch.setitem(sys.modules, name, module)
+        return module
+    return install
+
+
+@pytest.fixture
+def isolated_modules():
+    """Drop every module imported during the test so the next one re-imports it against its own stubs"""
+    before = set(sys.modules)
+    yield
+    for name in set(sys.modules) - before:
+        del sys.modules[name]
+
+
+def redis_server_binary():
+    path = os.environ.get('REDIS_SERVER') or shutil.which('redis-server')
+    if path is None:
+        try:
+            import redislite
+            path = redislite.__redis_executable__
+        except ImportError:
+            pass
+    return path
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not met in time")
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def redis_url():
+    """A throwaway redis-server on a free port; skipped where none is installed"""
+    binary = redis_server_binary()
+    if binary is None:
+        pytest.skip("no redis-server available")
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server = subprocess.Popen([binary, '--port', str(port), '--save', '', '--appendonly', 'no'],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"redis://127.0.0.1:{port}/0"
+    try:
+        wait_for(lambda: _pings(url))
+        yield url
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def _pings(url):
+    try:
+        return redis.Redis.from_url(url).ping()
+    except redis.ConnectionError:
+        return False
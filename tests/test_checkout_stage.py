@@ -0,0 +1,280 @@
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
+from urllib.parse import parse_qs
+import pytest
+import stripe
+from flask import Flask, Blueprint
+
+SID = 'sid-1'
+BOOKING_DATA = {'spotId': '3', 'parkingLotId': '2', 'bookingDate': '2026-10-20',
+                'startHour': '10', 'startMinute': '00', 'endHour': '11', 'endMinute': '00'}
+
+
+class StripeStubServer(ThreadingHTTPServer):
+    """Answers POST /v1/checkout/sessions like the Stripe API, optionally slowly or with an error"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StripeStubHandler)
+        self.requests = []
+        self.delay = 0
+        self.status = 200
+        self.release = threading.Event()
+        self.release.set()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class StripeStubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        params = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        server.requests.append((self.path, params))
+        server.release.wait(5)
+        time.sleep(server.delay)
+
+        if server.status != 200:
+            body = {'error': {'type': 'api_error', 'message': 'stub failure'}}
+        else:
+            session_id = f"cs_test_{len(server.requests)}"
+            body = {'id': session_id, 'object': 'checkout.session',
+                    'url': f"https://checkout.stripe.test/pay/{session_id}"}
+        payload = json.dumps(body).encode()
+        try:
+            self.send_response(server.status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client already timed out
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SocketIOStub:
+    def __init__(self):
+        self.emitted = []
+        self.tasks = []
+
+    def start_background_task(self, target, *args):
+        task = threading.Thread(target=target, args=args, daemon=True)
+        task.start()
+        self.tasks.append(task)
+        return task
+
+    def emit(self, event, data, to=None, room=None):
+        self.emitted.append((event, data, to or room))
+
+    def on(self, event):
+        return lambda handler: handler
+
+    def wait(self):
+        for task in self.tasks:
+            task.join(5)
+
+
+@pytest.fixture
+def stripe_stub(monkeypatch):
+    server = StripeStubServer()
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.01}, daemon=True)
+    thread.start()
+    monkeypatch.setattr(stripe, 'api_key', 'sk_test_stub')
+    monkeypatch.setattr(stripe, 'api_base', server.url)
+    monkeypatch.setattr(stripe, 'max_network_retries', 0)
+    monkeypatch.setattr(stripe, 'default_http_client', stripe.RequestsClient(timeout=1))
+    yield server
+    server.release.set()
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def env(stub_module, isolated_modules, stripe_stub, monkeypatch):
+    app = Flask(__name__)
+    app.config.update(STRIPE_CHECKOUT_WORKERS=2, STRIPE_CHECKOUT_QUEUE_TIMEOUT=1, BOOKING_DEADLINE_MS=250)
+    routes = Blueprint('booking_bp', __name__)
+    for endpoint in ('payment_success', 'payment_success_direct', 'booking_form'):
+        routes.add_url_rule(f"/{endpoint}", endpoint, lambda: '')
+    app.register_blueprint(routes)
+
+    socketio = SocketIOStub()
+    redis_client = mock.MagicMock()
+    stub_module('config', app=app, socketio=socketio, redis_client=redis_client, db=mock.MagicMock())
+
+    deps = SimpleNamespace(
+        acquire_lease_safe=mock.MagicMock(return_value=('res-1', None)),
+        catalog_cache=mock.MagicMock(),
+        emit_to_relevant_rooms_about_booking=mock.MagicMock(),
+        store_pending_booking=mock.MagicMock(return_value=True),
+        delete_pending_booking=mock.MagicMock(),
+        find_conflicting_spots=mock.MagicMock(return_value=(set(), set()))
+    )
+    deps.catalog_cache.get_spot.return_value = SimpleNamespace(id=3, parkingLotId=2, spotNumber=7, pricePerHour=5)
+    stub_module('booking.booking.booking_service', acquire_lease_safe=deps.acquire_lease_safe)
+    stub_module('booking.catalog.catalog_cache', catalog_cache=deps.catalog_cache)
+    stub_module('booking.emit_utils.emit',
+                emit_to_relevant_rooms_about_booking=deps.emit_to_relevant_rooms_about_booking)
+    stub_module('booking.redis.circuit_breaker', redis_circuit=SimpleNamespace(available=True))
+    stub_module('booking.pending_bookings.pending_bookings_db', store_pending_booking=deps.store_pending_booking,
+                delete_pending_booking=deps.delete_pending_booking,
+                find_conflicting_spots=deps.find_conflicting_spots)
+    stub_module('booking.utils', calculate_price=lambda start_time, end_time, price: 500,
+                SpotTakenError=type('SpotTakenError', (Exception,), {}))
+
+    from booking.booking import deadline, process_booking
+    from booking.stripe import checkout_stage, create_stripe_session
+    user = SimpleNamespace(get_id=lambda: '9')
+    monkeypatch.setattr(process_booking, 'current_user', user)
+    monkeypatch.setattr(create_stripe_session, 'current_user', user)
+    release_lease = mock.MagicMock()
+    monkeypatch.setattr(process_booking, 'redis_safe_release_lease', release_lease)
+
+    return SimpleNamespace(app=app, socketio=socketio, redis_client=redis_client, stripe=stripe_stub,
+                           deadline=deadline, process_booking=process_booking, checkout_stage=checkout_stage,
+                           release_lease=release_lease, **vars(deps))
+
+
+def checkout_params(reservation_id='res-1'):
+    return {'mode': 'payment', 'success_url': 'http://localhost/ok', 'metadata': {'reservation_id': reservation_id}}
+
+
+def test_checkout_session_is_created_and_redirect_pushed(env):
+    stage = env.checkout_stage.CheckoutStage(max_workers=2, queue_timeout=1)
+    on_success, on_failure = mock.MagicMock(), mock.MagicMock()
+
+    stage.submit(SID, checkout_params(), on_success, on_failure)
+    env.socketio.wait()
+
+    path, params = env.stripe.requests[0]
+    assert path == '/v1/checkout/sessions'
+    assert params['metadata[reservation_id]'] == ['res-1']
+    assert on_success.call_args.args[0].id == 'cs_test_1'
+    on_failure.assert_not_called()
+    assert env.socketio.emitted == [('payment_redirect', {'url': 'https://checkout.stripe.test/pay/cs_test_1'}, SID)]
+
+
+def test_stripe_error_fails_the_booking(env):
+    env.stripe.status = 500
+    stage = env.checkout_stage.CheckoutStage(max_workers=2, queue_timeout=1)
+    on_failure = mock.MagicMock()
+
+    stage.submit(SID, checkout_params(), on_failure=on_failure)
+    env.socketio.wait()
+
+    on_failure.assert_called_once()
+    assert env.socketio.emitted == [('booking_failed', {'reason': 'Payment system error'}, SID)]
+
+
+def test_slow_stripe_times_out(env, monkeypatch):
+    monkeypatch.setattr(stripe, 'default_http_client', stripe.RequestsClient(timeout=0.1))
+    env.stripe.delay = 0.5
+    stage = env.checkout_stage.CheckoutStage(max_workers=2, queue_timeout=1)
+    on_failure = mock.MagicMock()
+
+    started = time.monotonic()
+    stage.submit(SID, checkout_params(), on_failure=on_failure)
+    env.socketio.wait()
+
+    assert time.monotonic() - started < 0.5
+    on_failure.assert_called_once()
+    assert env.socketio.emitted == [('booking_failed', {'reason': 'Payment system error'}, SID)]
+
+
+def test_saturated_stage_rejects_instead_of_queueing_forever(env):
+    env.stripe.release.clear()  # hold the first session open in Stripe
+    stage = env.checkout_stage.CheckoutStage(max_workers=1, queue_timeout=0.1)
+    on_failure = mock.MagicMock()
+
+    stage.submit('sid-busy', checkout_params('res-busy'))
+    while not env.stripe.requests:
+        time.sleep(0.01)
+    stage.submit(SID, checkout_params(), on_failure=on_failure)
+    env.socketio.tasks[1].join(5)
+
+    on_failure.assert_called_once()
+    assert env.socketio.emitted == [('booking_failed', {'reason': 'Payment system busy. Please try again.'}, SID)]
+
+    env.stripe.release.set()
+    env.socketio.wait()
+    assert env.socketio.emitted[-1][0] == 'payment_redirect'
+    # The slot came back: the next checkout goes through
+    stage.submit(SID, checkout_params('res-2'))
+    env.socketio.wait()
+    assert env.socketio.emitted[-1][0] == 'payment_redirect'
+
+
+def test_queueing_is_bounded_by_the_request_deadline(env):
+    env.stripe.release.clear()
+    stage = env.checkout_stage.CheckoutStage(max_workers=1, queue_timeout=5)
+    stage.submit('sid-busy', checkout_params('res-busy'))
+    while not env.stripe.requests:
+        time.sleep(0.01)
+
+    started = time.monotonic()
+    stage.submit(SID, checkout_params(), deadline=env.deadline.Deadline(50))
+    env.socketio.tasks[1].join(5)
+
+    assert time.monotonic() - started < 1
+    assert env.socketio.emitted == [('booking_failed', {'reason': 'Payment system busy. Please try again.'}, SID)]
+    assert env.deadline.deadline_metrics.exhausted == {'checkout': 1}
+    env.stripe.release.set()
+
+
+def test_failing_cleanup_still_reports_the_failure(env):
+    env.stripe.status = 500
+    stage = env.checkout_stage.CheckoutStage(max_workers=2, queue_timeout=1)
+
+    stage.submit(SID, checkout_params(), on_failure=mock.MagicMock(side_effect=RuntimeError('cleanup broke')))
+    env.socketio.wait()
+
+    assert env.socketio.emitted == [('booking_failed', {'reason': 'Payment system error'}, SID)]
+
+
+def test_redis_booking_records_the_session_on_its_lease(env):
+    with env.app.test_request_context():
+        env.process_booking.process_redis_booking(dict(BOOKING_DATA), SID, env.deadline.Deadline(250))
+    env.socketio.wait()
+
+    _, params = env.stripe.requests[0]
+    assert params['metadata[user_id]'] == ['9']
+    assert params['line_items[0][price_data][unit_amount]'] == ['500']
+    env.redis_client.hset.assert_any_call('lease_data:res-1', 'payment_context', 'true')
+    env.redis_client.hset.assert_any_call('lease_data:res-1', 'stripe_session_id', 'cs_test_1')
+    assert env.socketio.emitted[-1][0] == 'payment_redirect'
+    env.release_lease.assert_not_called()
+
+
+def test_redis_booking_releases_its_lease_when_checkout_fails(env):
+    env.stripe.status = 500
+    with env.app.test_request_context():
+        env.process_booking.process_redis_booking(dict(BOOKING_DATA), SID, env.deadline.Deadline(250))
+    env.socketio.wait()
+
+    env.release_lease.assert_called_once_with(env.redis_client, 'res-1', '2', 3, '2026-10-20')
+    spot, booking_date, is_available = env.emit_to_relevant_rooms_about_booking.call_args.args[:3]
+    assert (spot.id, booking_date, is_available) == (3, '2026-10-20', True)
+    assert env.socketio.emitted == [('booking_failed', {'reason': 'Payment system error'}, SID)]
+
+
+def test_direct_booking_releases_its_hold_when_checkout_fails(env):
+    env.stripe.status = 500
+    with env.app.test_request_context():
+        env.process_booking.process_direct_booking(dict(BOOKING_DATA), SID, env.deadline.Deadline(250))
+    env.socketio.wait()
+
+    _, params = env.stripe.requests[0]
+    assert params['metadata[direct_booking]'] == ['true']
+    reservation_id = env.store_pending_booking.call_args.kwargs['reservation_id']
+    env.delete_pending_booking.assert_called_once_with(reservation_id)
+    spot, booking_date, is_available = env.emit_to_relevant_rooms_about_booking.call_args.args[:3]
+    assert (spot.id, booking_date, is_available) == (3, '2026-10-20', True)
+    assert env.socketio.emitted == [('booking_failed', {'reason': 'Payment system error'}, SID)]
@@ -0,0 +1,52 @@
+from datetime import time
+from types import SimpleNamespace
+from unittest import mock
+import pytest
+
+
+@pytest.fixture
+def dedup(stub_module, isolated_modules):
+    stub_module('config', app=SimpleNamespace(config={'SPOT_EVENT_DEDUP_SECONDS': 5}))
+    from booking.emit_utils import dedup
+    return dedup
+
+
+def test_repeated_event_is_dropped(dedup):
+    events = dedup.RecentSpotEvents(window_seconds=5)
+    taken = dedup.spot_event_id(3, '2026-10-20', time(10), time(11), False)
+
+    assert events.first_time(3, '2026-10-20', taken)
+    assert not events.first_time(3, '2026-10-20', taken)
+
+
+def test_taken_free_taken_emits_every_change(dedup):
+    events = dedup.RecentSpotEvents(window_seconds=5)
+    taken = dedup.spot_event_id(3, '2026-10-20', time(10), time(11), False)
+    # The direct booking fallback's failure paths used to free the spot without a window
+    freed = dedup.spot_event_id(3, '2026-10-20', None, None, True)
+
+    assert events.first_time(3, '2026-10-20', taken)
+    assert events.first_time(3, '2026-10-20', freed)
+    assert events.first_time(3, '2026-10-20', taken)
+
+
+def test_event_is_emitted_again_after_the_window(dedup):
+    events = dedup.RecentSpotEvents(window_seconds=5)
+    taken = dedup.spot_event_id(3, '2026-10-20', '10:00', '11:00', False)
+
+    with mock.patch.object(dedup.time, 'monotonic', side_effect=[100, 106]):
+        assert events.first_time(3, '2026-10-20', taken)
+        assert events.first_time(3, '2026-10-20', taken)
+
+
+def test_string_and_time_windows_share_an_event_id(dedup):
+    assert dedup.spot_event_id(3, '2026-10-20', '9:00', '10:00', False) == \
+        dedup.spot_event_id(3, '2026-10-20', time(9), time(10), False)
+
+
+def test_lru_is_bounded(dedup):
+    events = dedup.RecentSpotEvents(window_seconds=5, max_size=2)
+    for spot_id in (1, 2, 3):
+        events.first_time(spot_id, '2026-10-20', 'event')
+
+    assert list(events.entries) == [(2, '2026-10-20'), (3, '2026-10-20')]
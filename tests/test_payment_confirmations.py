@@ -0,0 +1,236 @@
+import contextlib
+import importlib.util
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+import pytest
+from sqlalchemy import Column, Integer, String, JSON, DateTime, Date, Time, Float
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import DeclarativeBase
+
+MAX_ATTEMPTS = 3
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+class Booking(Base):
+    __tablename__ = 'bookings'
+    id = Column(Integer, primary_key=True)
+    userid = Column(Integer)
+    parking_lot_id = Column(Integer)
+    spot_id = Column(Integer)
+    bookingDate = Column(Date)
+    startTime = Column(Time)
+    endTime = Column(Time)
+    amount = Column(Float)
+
+
+class PendingBooking(Base):
+    __tablename__ = 'pending_bookings'
+    id = Column(Integer, primary_key=True)
+    reservation_id = Column(String(36))
+    parking_lot_id = Column(Integer)
+    spot_id = Column(Integer)
+    booking_date = Column(Date)
+    start_time = Column(Time)
+    end_time = Column(Time)
+
+
+class PaymentConfirmation(Base):
+    __tablename__ = 'payment_confirmations'
+    id = Column(Integer, primary_key=True)
+    stripe_session_id = Column(String(255), unique=True)
+    payment_intent = Column(String(255))
+    amount_total = Column(Integer)
+    session_metadata = Column(JSON)
+    status = Column(String(20))
+    attempts = Column(Integer)
+    booking_id = Column(Integer)
+    message = Column(String(255))
+    created_at = Column(DateTime)
+    claimed_at = Column(DateTime)
+    processed_at = Column(DateTime)
+
+
+class StripeError(Exception):
+    pass
+
+
+class StopWorker(BaseException):
+    """Raised from a patched sleep to get out of the worker's endless loop"""
+
+
+@pytest.fixture
+def env(stub_module, isolated_modules, monkeypatch):
+    db = mock.MagicMock()
+    stripe = stub_module('stripe', Refund=mock.MagicMock(),
+                         error=SimpleNamespace(StripeError=StripeError))
+    stripe.Refund.create.return_value = SimpleNamespace(id='re_1')
+    app = SimpleNamespace(config={'PAYMENT_CONFIRMATION_MAX_ATTEMPTS': MAX_ATTEMPTS,
+                                  'PAYMENT_CONFIRMATION_BATCH_SIZE': 20},
+                          app_context=contextlib.nullcontext)
+    stub_module('config', app=app, db=db, Booking=Booking, PendingBooking=PendingBooking,
+                PaymentConfirmation=PaymentConfirmation)
+    monkeypatch.setattr(PendingBooking, 'query', mock.MagicMock(), raising=False)
+    monkeypatch.setattr(PaymentConfirmation, 'query', mock.MagicMock(), raising=False)
+    PendingBooking.query.filter.return_value.first.return_value = None
+
+    deps = SimpleNamespace(
+        confirm_booking=mock.MagicMock(),
+        catalog_cache=mock.MagicMock(),
+        record_spot_event=mock.MagicMock(),
+        delete_pending_booking=mock.MagicMock(),
+        mark_booked=mock.MagicMock(),
+        disconnect_user=mock.MagicMock(),
+        generate_qr_code=mock.MagicMock()
+    )
+    stub_module('booking.booking.booking_service', confirm_booking=deps.confirm_booking)
+    stub_module('booking.catalog.catalog_cache', catalog_cache=deps.catalog_cache)
+    stub_module('booking.emit_utils.outbox', record_spot_event=deps.record_spot_event)
+    stub_module('booking.pending_bookings.pending_bookings_db', delete_pending_booking=deps.delete_pending_booking)
+    stub_module('booking.redis.occupancy', mark_booked=deps.mark_booked)
+    stub_module('booking.socket.socket_con_management', disconnect_user=deps.disconnect_user)
+    stub_module('booking.utils', generate_qr_code=deps.generate_qr_code,
+                is_exclusion_violation=lambda e: getattr(getattr(e, 'orig', None), 'pgcode', None) == '23P01')
+
+    from booking.stripe import payment_confirmations
+    return SimpleNamespace(module=payment_confirmations, db=db, stripe=stripe, app=app, **vars(deps))
+
+
+def make_confirmation(attempts=1, **metadata):
+    return PaymentConfirmation(
+        id=1, stripe_session_id='cs_1', payment_intent='pi_1', amount_total=500, status='processing',
+        attempts=attempts,
+        session_metadata={'reservation_id': 'res-1', 'spot_id': '3', 'user_id': '9', 'parking_lot_id': '2',
+                          'booking_date': '2026-10-20', 'start_time': '10:00', 'end_time': '11:00', **metadata}
+    )
+
+
+def compiled(statement):
+    return str(statement.compile(dialect=postgresql.dialect()))
+
+
+def test_success_confirms_booking(env):
+    env.confirm_booking.return_value = ({'status': 'success', 'booking_id': 7}, 200)
+    confirmation = make_confirmation()
+
+    env.module.process_confirmation(confirmation)
+
+    assert env.confirm_booking.call_args.kwargs['idempotency_key'] == 'stripe_cs_1'
+    assert confirmation.status == 'confirmed'
+    assert confirmation.booking_id == 7
+    env.generate_qr_code.assert_called_once_with(7)
+    env.disconnect_user.assert_called_once_with('9')
+    env.stripe.Refund.create.assert_not_called()
+
+
+def test_duplicate_webhook_is_ignored(env):
+    checkout_session = {'id': 'cs_1', 'payment_intent': 'pi_1', 'amount_total': 500, 'metadata': {}}
+
+    env.module.enqueue_confirmation(checkout_session)
+    env.module.enqueue_confirmation(checkout_session)
+
+    statements = [compiled(call.args[0]) for call in env.db.session.execute.call_args_list]
+    assert len(statements) == 2
+    for statement in statements:
+        assert statement.startswith('INSERT INTO payment_confirmations')
+        assert 'ON CONFLICT (stripe_session_id) DO NOTHING' in statement
+
+
+def test_direct_booking_exclusion_violation_refunds(env):
+    env.catalog_cache.get_spot.return_value = SimpleNamespace(id=3)
+    env.db.session.flush.side_effect = IntegrityError('INSERT', {}, SimpleNamespace(pgcode='23P01'))
+    confirmation = make_confirmation(direct_booking='true')
+
+    env.module.process_confirmation(confirmation)
+
+    env.db.session.rollback.assert_called_once()
+    env.delete_pending_booking.assert_called_once_with('res-1')
+    env.stripe.Refund.create.assert_called_once_with(payment_intent='pi_1', idempotency_key='refund_cs_1')
+    assert confirmation.status == 'refunded'
+    env.mark_booked.assert_not_called()
+
+
+def test_server_error_retries_until_attempts_run_out(env):
+    env.confirm_booking.return_value = ({'status': 'error'}, 503)
+
+    confirmation = make_confirmation(attempts=MAX_ATTEMPTS - 1)
+    env.module.process_confirmation(confirmation)
+    assert confirmation.status == 'pending'
+    env.stripe.Refund.create.assert_not_called()
+
+    confirmation = make_confirmation(attempts=MAX_ATTEMPTS)
+    env.module.process_confirmation(confirmation)
+    assert confirmation.status == 'refunded'
+    env.stripe.Refund.create.assert_called_once_with(payment_intent='pi_1', idempotency_key='refund_cs_1')
+
+
+def test_failed_refund_marks_confirmation_failed(env):
+    env.confirm_booking.return_value = ({'status': 'error'}, 503)
+    env.stripe.Refund.create.side_effect = StripeError('card declined')
+    confirmation = make_confirmation(attempts=MAX_ATTEMPTS)
+
+    env.module.process_confirmation(confirmation)
+
+    assert confirmation.status == 'failed'
+
+
+def test_claim_batch_uses_skip_locked(env):
+    env.db.session.execute.return_value.scalars.return_value.all.return_value = []
+
+    assert env.module.process_confirmation_batch(5) == 0
+
+    statement, params = env.db.session.execute.call_args.args
+    assert 'FOR UPDATE SKIP LOCKED' in str(statement)
+    assert params == {'batch_size': 5, 'reclaim_after': env.module.RECLAIM_AFTER_SECONDS}
+    env.db.session.commit.assert_called_once()
+    PaymentConfirmation.query.filter.assert_not_called()
+
+
+def test_claim_batch_retries_a_crashed_confirmation(env):
+    env.db.session.execute.return_value.scalars.return_value.all.return_value = [1]
+    confirmation = make_confirmation()
+    PaymentConfirmation.query.filter.return_value.order_by.return_value.all.return_value = [confirmation]
+    env.confirm_booking.side_effect = RuntimeError('database went away')
+
+    assert env.module.process_confirmation_batch(5) == 1
+
+    env.db.session.rollback.assert_called_once()
+    assert confirmation.status == 'pending'
+
+
+def load_payment_worker():
+    path = Path(__file__).resolve().parent.parent / 'misc' / 'payment_worker.py'
+    spec = importlib.util.spec_from_file_location('payment_worker', path)
+    worker = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(worker)
+    return worker
+
+
+def test_payment_worker_drains_in_configured_batches(env, monkeypatch):
+    worker = load_payment_worker()
+    batches = mock.MagicMock(side_effect=[3, 0])
+    sleep = mock.MagicMock(side_effect=StopWorker)
+    monkeypatch.setattr(worker, 'process_confirmation_batch', batches)
+    monkeypatch.setattr(worker.time, 'sleep', sleep)
+
+    with pytest.raises(StopWorker):
+        worker.drain_payment_confirmations()
+
+    assert batches.call_args_list == [mock.call(20), mock.call(20)]
+    sleep.assert_called_once_with(1)
+
+
+def test_payment_worker_backs_off_after_errors(env, monkeypatch):
+    worker = load_payment_worker()
+    sleep = mock.MagicMock(side_effect=StopWorker)
+    monkeypatch.setattr(worker, 'process_confirmation_batch', mock.MagicMock(side_effect=RuntimeError('boom')))
+    monkeypatch.setattr(worker.time, 'sleep', sleep)
+
+    with pytest.raises(StopWorker):
+        worker.drain_payment_confirmations()
+
+    sleep.assert_called_once_with(5)
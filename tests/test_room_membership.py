@@ -0,0 +1,72 @@
+import time
+from types import SimpleNamespace
+from unittest import mock
+import pytest
+import redis
+
+ROOM = 'lot_2_2026-10-20'
+
+
+@pytest.fixture
+def rooms(stub_module, isolated_modules, redis_url, monkeypatch):
+    client = redis.Redis.from_url(redis_url)
+    stub_module('config', redis_client=client)
+    from booking.redis import redis_utils
+    redis_utils.init_redis_scripts(client, SimpleNamespace(logger=mock.MagicMock()))
+    monkeypatch.setattr(redis_utils, 'CONNECTION_TTL', 1)
+    return redis_utils, client
+
+
+def join(redis_utils, client, sid, room=ROOM):
+    return redis_utils.redis_join_lot_room(client, sid, room, 2, '2026-10-20', '10:00', '11:00')
+
+
+def test_joined_sockets_are_counted_until_they_leave(rooms):
+    redis_utils, client = rooms
+    join(redis_utils, client, 'sid-1')
+    join(redis_utils, client, 'sid-2')
+    assert redis_utils.redis_room_size(client, ROOM) == 2
+
+    redis_utils.redis_leave_all_rooms(client, 'sid-1')
+    assert redis_utils.redis_room_size(client, ROOM) == 1
+
+
+def test_moving_to_another_date_leaves_the_old_room(rooms):
+    redis_utils, client = rooms
+    join(redis_utils, client, 'sid-1')
+
+    left, membership = join(redis_utils, client, 'sid-1', 'lot_2_2026-10-21')
+
+    assert left == [ROOM]
+    assert membership == {'lot_2_2026-10-21'}
+    assert redis_utils.redis_room_size(client, ROOM) == 0
+
+
+def test_socket_of_a_dead_pod_drops_out_while_heartbeats_keep_the_rest(rooms):
+    redis_utils, client = rooms
+    join(redis_utils, client, 'sid-alive')
+    join(redis_utils, client, 'sid-crashed')  # never sends another heartbeat or a disconnect
+
+    for _ in range(3):
+        time.sleep(0.5)
+        assert redis_utils.redis_refresh_connection(client, 'sid-alive', 'anonymous')
+
+    assert redis_utils.redis_room_size(client, ROOM) == 1
+    assert client.zrange(redis_utils.room_members_key(ROOM), 0, -1) == [b'sid-alive']
+
+
+def test_abandoned_room_key_expires(rooms):
+    redis_utils, client = rooms
+    join(redis_utils, client, 'sid-crashed')
+
+    time.sleep(1.1)
+
+    assert redis_utils.redis_room_size(client, ROOM) == 0
+    assert not client.exists(redis_utils.room_members_key(ROOM), 'sid_rooms:sid-crashed', 'conn:sid-crashed')
+
+
+def test_refresh_of_an_expired_connection_reports_it_gone(rooms):
+    redis_utils, client = rooms
+
+    assert not redis_utils.redis_refresh_connection(client, 'sid-unknown', '9')
+    assert redis_utils.redis_room_size(client, ROOM) == 0
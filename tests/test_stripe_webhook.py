@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+from unittest import mock
+import pytest
+from flask import Flask, Blueprint
+
+
+class SignatureVerificationError(Exception):
+    pass
+
+
+def make_client(stub_module, webhook_secret):
+    stripe = stub_module('stripe', Webhook=mock.MagicMock(),
+                         error=SimpleNamespace(SignatureVerificationError=SignatureVerificationError))
+    enqueue_confirmation = mock.MagicMock()
+    stub_module('booking.stripe.payment_confirmations', enqueue_confirmation=enqueue_confirmation)
+    booking_bp = Blueprint('booking_bp', __name__)
+    stub_module('booking.routes.views', booking_bp=booking_bp)
+    stub_module('config', PaymentConfirmation=mock.MagicMock(), STRIPE_WEBHOOK_SECRET=webhook_secret)
+
+    import booking.routes.payments  # registers the routes on booking_bp
+    app = Flask(__name__)
+    app.register_blueprint(booking_bp)
+    return app.test_client(), stripe, enqueue_confirmation
+
+
+@pytest.fixture
+def client_factory(stub_module, isolated_modules):
+    return lambda webhook_secret: make_client(stub_module, webhook_secret)
+
+
+def test_missing_webhook_secret_is_reported_as_config_error(client_factory, caplog):
+    client, stripe, enqueue_confirmation = client_factory(None)
+
+    response = client.post('/stripe/webhook', data=b'{}', headers={'Stripe-Signature': 't=1,v1=sig'})
+
+    assert response.status_code == 500
+    assert 'STRIPE_WEBHOOK_SECRET is not configured' in caplog.text
+    stripe.Webhook.construct_event.assert_not_called()
+    enqueue_confirmation.assert_not_called()
+
+
+def test_bad_signature_is_rejected(client_factory):
+    client, stripe, enqueue_confirmation = client_factory('whsec_test')
+    stripe.Webhook.construct_event.side_effect = SignatureVerificationError('bad signature')
+
+    response = client.post('/stripe/webhook', data=b'{}', headers={'Stripe-Signature': 't=1,v1=sig'})
+
+    assert response.status_code == 400
+    enqueue_confirmation.assert_not_called()
+
+
+def test_paid_checkout_is_queued(client_factory):
+    client, stripe, enqueue_confirmation = client_factory('whsec_test')
+    checkout_session = {'id': 'cs_1', 'payment_status': 'paid'}
+    stripe.Webhook.construct_event.return_value = {'type': 'checkout.session.completed',
+                                                   'data': {'object': checkout_session}}
+
+    response = client.post('/stripe/webhook', data=b'{}', headers={'Stripe-Signature': 't=1,v1=sig'})
+
+    assert response.status_code == 200
+    assert stripe.Webhook.construct_event.call_args.args[2] == 'whsec_test'
+    enqueue_confirmation.assert_called_once_with(checkout_session)
@@ -0,0 +1,67 @@
+from datetime import time
+from types import SimpleNamespace
+from unittest import mock
+import pytest
+
+ROOM = 'lot_2_2026-10-20'
+
+
+def minutes(value):
+    if isinstance(value, str):
+        hours, mins = value.split(':')
+        return int(hours) * 60 + int(mins)
+    return value.hour * 60 + value.minute
+
+
+@pytest.fixture
+def emit_factory(stub_module, isolated_modules):
+    def load(bucket_minutes):
+        stub_module('config', app=SimpleNamespace(config={'SPOT_UPDATE_BUCKET_MINUTES': bucket_minutes},
+                                                  logger=mock.MagicMock()),
+                    db=mock.MagicMock(), redis_client=mock.MagicMock(), ActiveConnection=mock.MagicMock(),
+                    socketio=mock.MagicMock())
+        stub_module('booking.emit_utils.aggregator', spot_update_aggregator=mock.MagicMock(),
+                    emit_spot_updates=mock.MagicMock())
+        stub_module('booking.emit_utils.dedup', recent_spot_events=mock.MagicMock(), spot_event_id=mock.MagicMock())
+        stub_module('booking.non_redis_cross_instance_worker.cross_instance_manager',
+                    broadcast_spot_update=mock.MagicMock())
+        stub_module('booking.redis.circuit_breaker', redis_circuit=SimpleNamespace(available=True))
+        stub_module('booking.redis.redis_utils', redis_room_size=mock.MagicMock(return_value=1))
+        stub_module('booking.utils', time_to_minutes=minutes)
+        from booking.emit_utils import emit
+        return emit
+    return load
+
+
+def test_windowless_subscriber_joins_one_room_per_hour(emit_factory):
+    emit = emit_factory(60)
+
+    rooms = emit.time_bucket_rooms(ROOM, '00:00', '23:59')
+
+    assert len(rooms) == 24
+    assert (rooms[0], rooms[-1]) == (f"{ROOM}_t0000", f"{ROOM}_t2300")
+
+
+def test_hour_buckets_cover_partial_hours(emit_factory):
+    emit = emit_factory(60)
+
+    assert emit.time_bucket_rooms(ROOM, time(9, 45), time(11, 15)) == [f"{ROOM}_t0900", f"{ROOM}_t1000",
+                                                                      f"{ROOM}_t1100"]
+    assert emit.time_bucket_rooms(ROOM, '10:00', '11:00') == [f"{ROOM}_t1000"]
+
+
+def test_quarter_hour_buckets_stay_available(emit_factory):
+    emit = emit_factory(15)
+
+    assert emit.time_bucket_rooms(ROOM, '10:00', '10:30') == [f"{ROOM}_t1000", f"{ROOM}_t1015"]
+    assert len(emit.time_bucket_rooms(ROOM, '00:00', '23:59')) == 96
+
+
+def test_all_day_booking_is_queued_for_at_most_24_rooms(emit_factory):
+    emit = emit_factory(60)
+
+    assert emit._emit_using_redis(ROOM, 3, '2026-10-20', False, time(0), time(23, 59))
+
+    lot_room, recipients, spot_id, available = emit.spot_update_aggregator.add.call_args.args
+    assert (lot_room, spot_id, available) == (ROOM, 3, False)
+    assert len(recipients) == 24
@@ -0,0 +1,117 @@
+from types import SimpleNamespace
+from unittest import mock
+import pytest
+import redis
+from conftest import wait_for
+
+
+@pytest.fixture
+def tracked_cache(stub_module, isolated_modules, monkeypatch):
+    stub_module('config', app=SimpleNamespace(config={'REDIS_URL': 'redis://unused', 'REDIS_CLIENT_CACHE_SIZE': 10}),
+                redis_client=mock.MagicMock())
+    from booking.redis import tracked_cache
+    monkeypatch.setattr(tracked_cache, 'RECONNECT_DELAY_SECONDS', 0.05)
+    return tracked_cache
+
+
+@pytest.fixture
+def live_cache(tracked_cache, redis_url):
+    client = redis.Redis.from_url(redis_url)
+    cache = tracked_cache.TrackedHashCache(client, redis_url, 'lease_data:', 10)
+    cache.start()
+    wait_for(lambda: cache.tracking)
+    yield cache, client
+    cache.stop()
+
+
+def test_reads_are_cached_until_the_hash_changes(live_cache):
+    cache, client = live_cache
+    client.hset('lease_data:r1', 'user_id', '9')
+
+    assert cache.hgetall('lease_data:r1') == {b'user_id': b'9'}
+    assert cache.hgetall('lease_data:r1') == {b'user_id': b'9'}
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    client.hset('lease_data:r1', 'stripe_session_id', 'cs_1')
+    wait_for(lambda: 'lease_data:r1' not in cache.entries)
+    assert cache.hgetall('lease_data:r1') == {b'user_id': b'9', b'stripe_session_id': b'cs_1'}
+
+
+def test_deleted_and_expired_hashes_are_dropped(live_cache):
+    cache, client = live_cache
+    client.hset('lease_data:r1', 'user_id', '9')
+    client.hset('lease_data:r2', 'user_id', '9')
+    cache.hgetall('lease_data:r1')
+    cache.hgetall('lease_data:r2')
+
+    client.delete('lease_data:r1')
+    client.pexpire('lease_data:r2', 1)
+    wait_for(lambda: not cache.entries)
+
+    assert cache.hgetall('lease_data:r1') == {}
+
+
+def test_other_prefixes_do_not_invalidate(live_cache):
+    cache, client = live_cache
+    client.hset('lease_data:r1', 'user_id', '9')
+    wait_for(lambda: cache.invalidations == 1)
+    cache.hgetall('lease_data:r1')
+
+    client.hset('conn:sid1', 'user_id', '9')
+    client.hset('lease_data:r2', 'user_id', '9')  # tracked, so it marks when the earlier write was processed
+    wait_for(lambda: cache.invalidations == 2)
+
+    assert 'lease_data:r1' in cache.entries
+
+
+def test_cache_is_bypassed_and_flushed_while_the_stream_is_down(live_cache):
+    cache, client = live_cache
+    client.hset('lease_data:r1', 'user_id', '9')
+    cache.hgetall('lease_data:r1')
+
+    client.client_kill_filter(_type='pubsub')
+    wait_for(lambda: not cache.tracking)
+    assert not cache.entries
+    assert cache.hgetall('lease_data:r1') == {b'user_id': b'9'}
+    assert not cache.entries
+
+    wait_for(lambda: cache.tracking)
+    client.hset('lease_data:r1', 'user_id', '10')
+    assert cache.hgetall('lease_data:r1') == {b'user_id': b'10'}
+
+
+def test_read_racing_an_invalidation_is_not_cached(tracked_cache):
+    client = mock.MagicMock()
+    cache = tracked_cache.TrackedHashCache(client, 'redis://unused', 'lease_data:', 10)
+    cache.tracking = True
+
+    def hgetall(key):
+        cache.invalidate([key])  # the hash changed while this read was on the wire
+        return {b'user_id': b'9'}
+    client.hgetall.side_effect = hgetall
+
+    assert cache.hgetall('lease_data:r1') == {b'user_id': b'9'}
+    assert not cache.entries
+
+
+def test_failed_read_leaves_nothing_behind(tracked_cache):
+    client = mock.MagicMock()
+    client.hgetall.side_effect = redis.ConnectionError('down')
+    cache = tracked_cache.TrackedHashCache(client, 'redis://unused', 'lease_data:', 10)
+    cache.tracking = True
+
+    with pytest.raises(redis.ConnectionError):
+        cache.hgetall('lease_data:r1')
+    assert not cache.entries
+
+
+def test_cache_is_bounded(tracked_cache):
+    client = mock.MagicMock()
+    client.hgetall.return_value = {b'user_id': b'9'}
+    cache = tracked_cache.TrackedHashCache(client, 'redis://unused', 'lease_data:', 2)
+    cache.tracking = True
+
+    for reservation_id in ('r1', 'r2', 'r3'):
+        cache.hgetall(f"lease_data:{reservation_id}")
+
+    assert list(cache.entries) == ['lease_data:r2', 'lease_data:r3']